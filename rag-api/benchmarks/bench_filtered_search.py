@@ -0,0 +1,130 @@
+"""payloadインデックスの有無によるフィルタ付き検索のレイテンシ比較。
+
+稼働中のQdrantに一時コレクションを作って計測する (終了後に削除)。rag-api ディレクトリで実行する:
+
+    python -m benchmarks.bench_filtered_search --url http://localhost:6333 --sizes 10000 100000 1000000
+"""
+import argparse
+import asyncio
+import time
+
+import numpy as np
+
+from qdrant_client import AsyncQdrantClient
+from qdrant_client.models import (
+    Distance,
+    FieldCondition,
+    Filter,
+    MatchValue,
+    PointStruct,
+    Range,
+    VectorParams,
+)
+
+from services import qdrant
+
+_MATERIALS = ["SUS304", "SUS316", "S45C", "SKD11", "A5052", "SUS420J2", "SCM440", "C3604"]
+
+
+def _filters(rng: np.random.Generator, count: int) -> list[Filter]:
+    """extract_filtersが生成するのと同じ形 (材質一致 + 外径・長さの範囲) のフィルタ。"""
+    filters = []
+    for _ in range(count):
+        d = float(rng.integers(5, 200))
+        length = float(rng.integers(10, 1000))
+        filters.append(
+            Filter(
+                must=[
+                    FieldCondition(key="material", match=MatchValue(value=str(rng.choice(_MATERIALS)))),
+                    FieldCondition(key="diameter_mm", range=Range(gte=d * 0.8, lte=d * 1.2)),
+                    FieldCondition(key="length_mm", range=Range(gte=length * 0.8, lte=length * 1.2)),
+                ]
+            )
+        )
+    return filters
+
+
+async def _load(client: AsyncQdrantClient, name: str, size: int, dim: int, rng: np.random.Generator) -> None:
+    await client.create_collection(
+        name,
+        vectors_config=VectorParams(size=dim, distance=Distance.COSINE),
+        hnsw_config=qdrant._hnsw_config(),
+        optimizers_config=qdrant._optimizers_config(),
+    )
+    batch = 1000
+    semaphore = asyncio.Semaphore(4)
+
+    async def upload(start: int) -> None:
+        n = min(batch, size - start)
+        vectors = rng.standard_normal((n, dim), dtype=np.float32)
+        points = [
+            PointStruct(
+                id=start + i,
+                vector=vectors[i].tolist(),
+                payload={
+                    "material": _MATERIALS[(start + i) % len(_MATERIALS)],
+                    "diameter_mm": float(rng.integers(5, 200)),
+                    "length_mm": float(rng.integers(10, 1000)),
+                    "weight_kg": float(rng.random() * 10),
+                },
+            )
+            for i in range(n)
+        ]
+        async with semaphore:
+            await client.upsert(name, points=points, wait=False)
+
+    await asyncio.gather(*(upload(start) for start in range(0, size, batch)))
+    await _wait_green(client, name)
+
+
+async def _wait_green(client: AsyncQdrantClient, name: str) -> None:
+    while (await client.get_collection(name)).status.value != "green":
+        await asyncio.sleep(1)
+
+
+async def _measure(
+    client: AsyncQdrantClient, name: str, queries: np.ndarray, filters: list[Filter]
+) -> tuple[float, float]:
+    latencies = []
+    for vector, query_filter in zip(queries, filters):
+        start = time.perf_counter()
+        await client.query_points(name, query=vector.tolist(), query_filter=query_filter, limit=5)
+        latencies.append((time.perf_counter() - start) * 1000)
+    return float(np.percentile(latencies, 50)), float(np.percentile(latencies, 95))
+
+
+async def main() -> None:
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--url", default="http://localhost:6333")
+    ap.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    ap.add_argument("--dim", type=int, default=768)
+    ap.add_argument("--queries", type=int, default=200)
+    args = ap.parse_args()
+
+    client = AsyncQdrantClient(url=args.url, timeout=600)
+    rng = np.random.default_rng(0)
+
+    print(f"{'points':>9} {'no index p50/p95 (ms)':>24} {'indexed p50/p95 (ms)':>24}")
+    for size in args.sizes:
+        name = f"bench_filtered_{size}"
+        await client.delete_collection(name)
+        try:
+            await _load(client, name, size, args.dim, rng)
+            queries = rng.standard_normal((args.queries, args.dim), dtype=np.float32)
+            filters = _filters(rng, args.queries)
+
+            plain = await _measure(client, name, queries, filters)
+            for field_name, field_type in qdrant._PAYLOAD_INDEXES.items():
+                await client.create_payload_index(name, field_name=field_name, field_schema=field_type, wait=True)
+            await _wait_green(client, name)
+            indexed = await _measure(client, name, queries, filters)
+
+            print(
+                f"{size:>9} {plain[0]:>11.2f} / {plain[1]:>8.2f}   {indexed[0]:>11.2f} / {indexed[1]:>8.2f}"
+            )
+        finally:
+            await client.delete_collection(name)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,105 @@
+"""見積ファイルの行単位処理 (列単位処理の導入前の実装) と列単位処理を比較するベンチマーク。
+
+rag-api ディレクトリで実行する:
+
+    python -m benchmarks.bench_parser --rows 10000 100000
+"""
+import argparse
+import io
+import random
+import time
+
+import pandas as pd
+from pydantic import ValidationError
+
+from models.estimate import EstimateRecord
+from services import parser
+
+_MATERIALS = ["SUS304", "SUS316", "S45C", "SKD11", "A5052", "SUS420J2", "SCM440", "C3604"]
+_NAMES = ["回転シャフト", "固定ピン", "ガイドピン", "スペーサー", "カラー", "連結シャフト"]
+
+
+def generate_csv(rows: int, error_rate: float = 0.01, seed: int = 0) -> bytes:
+    """ダミーの見積CSVを生成する。error_rateの割合で不正な行を混ぜる。"""
+    rng = random.Random(seed)
+    lines = [
+        "id,name,material,diameter_mm,length_mm,weight_kg,application,grade,"
+        "price,quantity,unit_price,customer,notes,estimate_date"
+    ]
+    for i in range(rows):
+        d = rng.randint(5, 200)
+        length = rng.randint(10, 1000)
+        qty = rng.randint(1, 200)
+        unit = rng.randint(5, 20000)
+        price: object = unit * qty
+        material = rng.choice(_MATERIALS)
+        notes = rng.choice(["", "焼入れ", "バフ仕上げ"])
+        estimate_date = f"2024-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}"
+        if rng.random() < error_rate:
+            kind = rng.randrange(3)
+            if kind == 0:
+                price = "要見積"
+            elif kind == 1:
+                material = ""
+            else:
+                estimate_date = "2024-13-45"
+        lines.append(
+            f"{100000 + i},{rng.choice(_NAMES)},{material},{d},{length},"
+            f"{round(d * d * length * 6.2e-6, 2)},用途{i % 50},一般,{price},{qty},{unit},"
+            f"{rng.choice('ABCDE')}社,{notes},{estimate_date}"
+        )
+    return ("\n".join(lines) + "\n").encode("utf-8")
+
+
+def _read(content: bytes) -> pd.DataFrame:
+    df = pd.read_csv(io.StringIO(content.decode("utf-8-sig")))
+    df.columns = [col.strip() for col in df.columns]
+    return df
+
+
+def _parse_rowwise(df: pd.DataFrame) -> tuple[list[EstimateRecord], list[str]]:
+    """1行ずつ型変換・バリデーションする（列単位処理導入前の実装）。"""
+    records: list[EstimateRecord] = []
+    errors: list[str] = []
+
+    for idx, row in df.iterrows():
+        row_num = idx + 2  # ヘッダー行 + 0-indexed → 実際の行番号
+        try:
+            records.append(parser._parse_row(row))
+        except (ValidationError, ValueError, TypeError) as e:
+            errors.append(f"行{row_num}: {e}")
+
+    return records, errors
+
+
+def _timeit(func, *args) -> tuple[float, object]:
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--rows", type=int, nargs="+", default=[10_000, 100_000])
+    ap.add_argument("--error-rate", type=float, default=0.01)
+    args = ap.parse_args()
+
+    print(f"{'rows':>8} {'iterrows(s)':>12} {'columnar(s)':>12} {'speedup':>8} {'records':>8} {'errors':>7}")
+    for rows in args.rows:
+        content = generate_csv(rows, args.error_rate)
+        df = _read(content)
+
+        old_time, (old_records, old_errors) = _timeit(_parse_rowwise, df)
+        new_time, (new_records, new_errors) = _timeit(parser._parse_dataframe, df)
+
+        if old_records != new_records or old_errors != new_errors:
+            raise SystemExit(f"結果が一致しません (rows={rows})")
+
+        print(
+            f"{rows:>8} {old_time:>12.3f} {new_time:>12.3f} {old_time / new_time:>7.1f}x"
+            f" {len(new_records):>8} {len(new_errors):>7}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+"""起動時間の計測と回帰チェック。
+
+- `python -X importtime -c "import main"` を別プロセスで --runs 回実行し、main の読み込み時間 (中央値) と
+  読み込みに時間のかかるモジュールを表示する
+- 起動時には読み込まないはずのモジュール (pandas・google.genai など) が読み込まれていないか確認する
+- uvicorn で起動し、liveness (/api/v1/health/live) と readiness (/api/v1/health/ready) が
+  応答するまでの時間を計る (Qdrantはインメモリ、Embeddingは hashing)
+
+rag-api ディレクトリで実行する:
+
+    python -m benchmarks.bench_startup --runs 5 --target-ms 2000
+
+読み込み時間の中央値が --target-ms を超えるか、遅延読み込みのモジュールが読み込まれていると終了コード1。
+"""
+import argparse
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+
+import httpx
+
+# 起動時には読み込まず、初回の使用時に読み込むモジュール
+_LAZY_MODULES = ("pandas", "google.genai", "sentence_transformers", "torch")
+
+
+def _env() -> dict:
+    # APIキーなし・接続先のないQdrantでも読み込みが終わること (ネットワークに出ないこと) を確認する
+    env = {k: v for k, v in os.environ.items() if k != "GEMINI_API_KEY"}
+    env.update(QDRANT_HOST="127.0.0.1", QDRANT_PORT="9", QDRANT_LOCATION="")
+    return env
+
+
+def _importtime() -> tuple[float, dict[str, tuple[int, int]]]:
+    """main を読み込み、(全体の秒数, {モジュール: (自身のµs, 累積µs)}) を返す。"""
+    start = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import main"],
+        capture_output=True, text=True, env=_env(), check=True,
+    )
+    elapsed = time.perf_counter() - start
+    modules = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        parts = [p.strip() for p in line[len("import time:"):].split("|")]
+        if parts[0].isdigit():
+            modules[parts[2]] = (int(parts[0]), int(parts[1]))
+    return elapsed, modules
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _time_to_ready() -> tuple[float, float]:
+    """uvicornを起動し、liveness・readinessが200を返すまでの秒数を返す。"""
+    port = _free_port()
+    env = {**_env(), "QDRANT_LOCATION": ":memory:", "EMBEDDING_BACKEND": "hashing",
+           "EMBEDDING_CACHE_PATH": "", "JOB_STORE_PATH": ""}
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--log-level", "warning"],
+        env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    live = None
+    try:
+        with httpx.Client(timeout=1.0) as client:
+            while time.perf_counter() - start < 60:
+                if process.poll() is not None:
+                    raise SystemExit("rag-api の起動に失敗しました")
+                try:
+                    if live is None and client.get(f"http://127.0.0.1:{port}/api/v1/health/live").is_success:
+                        live = time.perf_counter() - start
+                    if live is not None and client.get(f"http://127.0.0.1:{port}/api/v1/health/ready").is_success:
+                        return live, time.perf_counter() - start
+                except httpx.TransportError:
+                    pass
+                time.sleep(0.02)
+        raise SystemExit("rag-api が60秒以内にreadyになりません")
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--runs", type=int, default=5)
+    ap.add_argument("--target-ms", type=float, default=2000.0, help="main の読み込み時間 (importtimeの累積) の上限")
+    ap.add_argument("--top", type=int, default=10, help="表示する累積時間の大きいモジュール数")
+    ap.add_argument("--no-server", action="store_true", help="uvicornでの起動時間を計測しない")
+    args = ap.parse_args()
+
+    runs = [_importtime() for _ in range(args.runs)]
+    main_ms = statistics.median(modules["main"][1] / 1000 for _, modules in runs)
+    wall_ms = statistics.median(elapsed * 1000 for elapsed, _ in runs)
+    _, modules = runs[-1]
+
+    print(f"import main: {main_ms:.0f} ms (importtime, median of {args.runs}), process {wall_ms:.0f} ms")
+    print(f"\n{'cumulative ms':>14} {'self ms':>8}  module")
+    top_level = {name: times for name, times in modules.items() if "." not in name and name != "main"}
+    for name, (own, cumulative) in sorted(top_level.items(), key=lambda kv: -kv[1][1])[: args.top]:
+        print(f"{cumulative / 1000:>14.0f} {own / 1000:>8.0f}  {name}")
+
+    if not args.no_server:
+        live, ready = _time_to_ready()
+        print(f"\nliveness: {live * 1000:.0f} ms, readiness: {ready * 1000:.0f} ms after process start")
+
+    failed = False
+    eager = [m for m in _LAZY_MODULES if m in modules]
+    if eager:
+        print(f"\nNG: modules that should be imported lazily were loaded at startup: {', '.join(eager)}")
+        failed = True
+    if main_ms > args.target_ms:
+        print(f"\nNG: import main took {main_ms:.0f} ms (target {args.target_ms:.0f} ms)")
+        failed = True
+    if failed:
+        sys.exit(1)
+    print(f"\nOK: within {args.target_ms:.0f} ms, no eager imports of {', '.join(_LAZY_MODULES)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+"""ストレージプロファイル (量子化・ディスク配置・次元削減) ごとの Recall@k とレイテンシの比較。
+
+稼働中のQdrantに一時コレクションを作って計測する (終了後に削除)。正解は全次元float32の
+総当たり検索 (NumPy) とする。rag-api ディレクトリで実行する:
+
+    python -m benchmarks.bench_storage_profiles --url http://localhost:6333 --points 100000
+    python -m benchmarks.bench_storage_profiles --vectors vectors.npy --dims 768 256
+
+--vectors を省略した場合は、合成カタログを hashing バックエンドでベクトル化して使う。
+実運用の品質を見積もるには、エクスポートした本番ベクトル (.npy) を指定すること。
+"""
+import argparse
+import asyncio
+import io
+import time
+
+import numpy as np
+
+from qdrant_client import AsyncQdrantClient
+from qdrant_client.models import Distance, PointStruct, VectorParams
+
+import config
+from benchmarks.bench_parser import generate_csv
+from services import parser, qdrant
+from services.embedders import HashingEmbedder
+
+_BYTES_PER_DIM = {"default": 4.0, "scalar": 1.0, "binary": 1 / 8}
+
+
+def _synthetic_vectors(points: int, dim: int) -> np.ndarray:
+    content = io.BytesIO(generate_csv(points, error_rate=0))
+    records = [r for chunk, _ in parser.iter_file_chunks(content, "bench.csv", points) for r in chunk]
+    return HashingEmbedder(dim).embed_array([r.to_embedding_text() for r in records])
+
+
+def _normalize(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.where(norms == 0, 1.0, norms)
+
+
+def _ram_mb(points: int, dim: int, profile: str, on_disk: bool) -> float:
+    """ベクトルがRAMに占める量の概算 (HNSWグラフ・payloadは除く)。"""
+    ram = points * dim * _BYTES_PER_DIM[profile] if profile != "default" else 0.0
+    if not on_disk:
+        ram += points * dim * 4
+    return ram / 2**20
+
+
+async def _run_profile(
+    client: AsyncQdrantClient,
+    vectors: np.ndarray,
+    queries: np.ndarray,
+    truth: np.ndarray,
+    profile: str,
+    dim: int,
+    on_disk: bool,
+    k: int,
+) -> tuple[float, float, float]:
+    config.QDRANT_STORAGE_PROFILE = profile
+    name = f"bench_profile_{profile}_{dim}_{int(on_disk)}"
+    await client.delete_collection(name)
+    await client.create_collection(
+        name,
+        vectors_config=VectorParams(size=dim, distance=Distance.COSINE, on_disk=on_disk),
+        hnsw_config=qdrant._hnsw_config(),
+        optimizers_config=qdrant._optimizers_config(),
+        quantization_config=qdrant._quantization_config(),
+    )
+    try:
+        stored = _normalize(vectors[:, :dim])
+        for start in range(0, len(stored), 1000):
+            await client.upsert(
+                name,
+                points=[
+                    PointStruct(id=start + i, vector=v.tolist())
+                    for i, v in enumerate(stored[start : start + 1000])
+                ],
+                wait=False,
+            )
+        while (await client.get_collection(name)).status.value != "green":
+            await asyncio.sleep(1)
+
+        latencies = []
+        hits = 0
+        for query, expected in zip(_normalize(queries[:, :dim]), truth):
+            start = time.perf_counter()
+            result = await client.query_points(
+                name, query=query.tolist(), search_params=qdrant._search_params(), limit=k
+            )
+            latencies.append((time.perf_counter() - start) * 1000)
+            hits += len({p.id for p in result.points} & set(expected.tolist()))
+        return hits / truth.size, float(np.percentile(latencies, 50)), float(np.percentile(latencies, 95))
+    finally:
+        await client.delete_collection(name)
+
+
+async def main() -> None:
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--url", default="http://localhost:6333")
+    ap.add_argument("--vectors", help="ベクトルの .npy ファイル (省略時は合成データ)")
+    ap.add_argument("--points", type=int, default=100_000)
+    ap.add_argument("--dims", type=int, nargs="+", help="比較する次元数 (Matryoshka切り詰め)")
+    ap.add_argument("--profiles", nargs="+", default=["default", "scalar", "binary"])
+    ap.add_argument("--queries", type=int, default=200)
+    ap.add_argument("-k", type=int, default=5)
+    args = ap.parse_args()
+
+    if args.vectors:
+        vectors = np.load(args.vectors, mmap_mode="r")[: args.points].astype(np.float32)
+    else:
+        vectors = _synthetic_vectors(args.points, config.EMBEDDING_DIMENSION)
+    full_dim = vectors.shape[1]
+    dims = args.dims or [full_dim]
+
+    # クエリは格納ベクトルにノイズを加えたもの。正解は全次元float32での総当たり上位k件
+    rng = np.random.default_rng(0)
+    base = vectors[rng.choice(len(vectors), size=args.queries, replace=False)]
+    queries = base + rng.normal(scale=0.3 / np.sqrt(full_dim), size=base.shape).astype(np.float32)
+    scores = _normalize(queries) @ _normalize(vectors).T
+    truth = np.argsort(-scores, axis=1)[:, : args.k]
+
+    client = AsyncQdrantClient(url=args.url, timeout=600)
+    print(
+        f"{'profile':>8} {'dim':>5} {'on_disk':>7} {'recall@' + str(args.k):>9}"
+        f" {'p50(ms)':>8} {'p95(ms)':>8} {'vector RAM(MB)':>15}"
+    )
+    for dim in dims:
+        for profile in args.profiles:
+            for on_disk in ([False, True] if profile != "default" else [False]):
+                recall, p50, p95 = await _run_profile(
+                    client, vectors, queries, truth, profile, dim, on_disk, args.k
+                )
+                print(
+                    f"{profile:>8} {dim:>5} {str(on_disk):>7} {recall:>9.3f}"
+                    f" {p50:>8.2f} {p95:>8.2f} {_ram_mb(len(vectors), dim, profile, on_disk):>15.1f}"
+                )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
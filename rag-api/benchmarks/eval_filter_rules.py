@@ -0,0 +1,85 @@
+"""規則ベースのフィルタ抽出の回帰テストと、LLM呼び出しの削減効果の計測。
+
+filter_corpus.jsonl の各クエリについて、規則で確定すべきか (rule) と期待するフィルタ (expected) を
+検証する。不一致があれば終了コード1で終わる。rag-api ディレクトリで実行する:
+
+    python -m benchmarks.eval_filter_rules
+    python -m benchmarks.eval_filter_rules --llm   # LLM抽出との一致率とレイテンシも計測 (要 GEMINI_API_KEY)
+"""
+import argparse
+import asyncio
+import json
+import sys
+import time
+from pathlib import Path
+
+import config
+from services import filter as filters
+
+_CORPUS = Path(__file__).with_name("filter_corpus.jsonl")
+
+# コーパスの前提とする材質辞書 (本番ではコレクションのmaterial値から作られる)
+_MATERIALS = [
+    "SUS304", "SUS316", "SUS316L", "S45C", "SKD11", "A5052", "SCM440", "C3604", "SS400", "POM",
+]
+
+
+async def _llm_extract(query: str) -> tuple[object, float]:
+    config.FILTER_RULES = False
+    start = time.perf_counter()
+    result = await filters.extract_filters(query)
+    return result, (time.perf_counter() - start) * 1000
+
+
+async def main() -> int:
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--corpus", type=Path, default=_CORPUS)
+    ap.add_argument("--llm", action="store_true", help="LLM抽出も実行して比較する")
+    args = ap.parse_args()
+
+    filters._set_materials(_MATERIALS)
+    cases = [json.loads(line) for line in args.corpus.read_text(encoding="utf-8").splitlines() if line.strip()]
+
+    failures = []
+    rule_hits = 0
+    rule_ms = 0.0
+    for case in cases:
+        start = time.perf_counter()
+        raw = filters.extract_by_rules(case["query"])
+        rule_ms += (time.perf_counter() - start) * 1000
+        if raw is None:
+            if case["rule"]:
+                failures.append((case["query"], "expected rule match, got LLM fallback"))
+            continue
+        rule_hits += 1
+        if not case["rule"]:
+            failures.append((case["query"], f"expected LLM fallback, got {raw}"))
+            continue
+        expected = filters.build_filter(case["expected"] or {})
+        actual = filters.build_filter(raw)
+        if actual != expected:
+            failures.append((case["query"], f"expected {expected}, got {actual}"))
+
+    print(f"cases:            {len(cases)}")
+    print(f"rule match rate:  {rule_hits / len(cases):.1%} ({rule_hits}/{len(cases)})")
+    print(f"avg rule latency: {rule_ms / len(cases) * 1000:.1f} µs")
+
+    if args.llm:
+        agree = 0
+        llm_ms = []
+        for case in cases:
+            result, elapsed = await _llm_extract(case["query"])
+            llm_ms.append(elapsed)
+            agree += result == filters.build_filter(case["expected"] or {})
+        avg_llm = sum(llm_ms) / len(llm_ms)
+        print(f"LLM agreement:    {agree / len(cases):.1%}")
+        print(f"avg LLM latency:  {avg_llm:.0f} ms")
+        print(f"saved per query:  {rule_hits / len(cases) * avg_llm:.0f} ms (average over corpus)")
+
+    for query, reason in failures:
+        print(f"FAIL {query!r}: {reason}", file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
@@ -0,0 +1,152 @@
+"""負荷試験用のGemini・Mattermostの代替サーバー。
+
+- Gemini: 決定的なEmbedding (文字n-gramの特徴ハッシング)・固定の回答を返す。
+  レイテンシと429の発生率を指定できる。rag-apiの GEMINI_BASE_URL に向けて使う。
+- Mattermost: Incoming Webhook・REST APIの投稿を記録し、取り込み用のファイルを配信する。
+"""
+import asyncio
+import json
+import random
+import time
+from collections import defaultdict
+
+from fastapi import FastAPI, Request, Response
+from fastapi.responses import JSONResponse, StreamingResponse
+
+from services.embedders import HashingEmbedder
+
+_ANSWER = "過去の類似案件から、概算で1個あたり3,000〜4,000円程度と見込まれます。"
+
+
+def gemini_app(dimension: int, latency_ms: float = 0.0, rate_limit_ratio: float = 0.0) -> FastAPI:
+    """Gemini API (v1beta) の batchEmbedContents / generateContent / streamGenerateContent の代替。"""
+    app = FastAPI()
+    embedder = HashingEmbedder(dimension)
+    app.state.calls = defaultdict(int)
+
+    async def delay_or_429(kind: str) -> Response | None:
+        app.state.calls[kind] += 1
+        if latency_ms:
+            await asyncio.sleep(random.expovariate(1 / latency_ms) / 1000)
+        if random.random() < rate_limit_ratio:
+            app.state.calls["rate_limited"] += 1
+            return JSONResponse(
+                {"error": {"code": 429, "message": "Resource exhausted", "status": "RESOURCE_EXHAUSTED"}},
+                status_code=429,
+            )
+        return None
+
+    @app.get("/v1beta/models")
+    async def list_models():
+        return {"models": [{"name": "models/fake"}]}
+
+    @app.get("/v1beta/models/{model}")
+    async def get_model(model: str):
+        return {"name": f"models/{model}"}
+
+    @app.post("/v1beta/models/{model}:batchEmbedContents")
+    async def batch_embed(model: str, request: Request):
+        if (error := await delay_or_429("embed")) is not None:
+            return error
+        body = await request.json()
+        texts = [" ".join(p.get("text", "") for p in r["content"]["parts"]) for r in body["requests"]]
+        vectors = embedder.embed_array(texts)
+        size = body["requests"][0].get("outputDimensionality") or dimension
+        return {"embeddings": [{"values": v[:size].tolist()} for v in vectors]}
+
+    @app.post("/v1beta/models/{model}:generateContent")
+    async def generate(model: str, request: Request):
+        if (error := await delay_or_429("generate")) is not None:
+            return error
+        body = await request.json()
+        generation = body.get("generationConfig", {})
+        if generation.get("responseMimeType") != "application/json":
+            return _candidate(_ANSWER)
+        # 回答と条件の同時生成 (LLM_COMBINED_MODE) には回答と条件なしを、フィルタ抽出には条件なしを返す
+        if "answer" in (generation.get("responseSchema") or {}).get("properties", {}):
+            return _candidate(json.dumps({"answer": _ANSWER, "filters": None}, ensure_ascii=False))
+        return _candidate("{}")
+
+    @app.post("/v1beta/cachedContents")
+    async def create_cache(request: Request):
+        body = await request.json()
+        app.state.calls["cache"] += 1
+        return {"name": f"cachedContents/fake-{app.state.calls['cache']}", "model": body["model"]}
+
+    @app.post("/v1beta/models/{model}:streamGenerateContent")
+    async def stream_generate(model: str, request: Request):
+        if (error := await delay_or_429("stream")) is not None:
+            return error
+
+        async def events():
+            for i in range(0, len(_ANSWER), 8):
+                await asyncio.sleep(latency_ms / 10000)
+                chunk = _candidate(_ANSWER[i : i + 8], final=i + 8 >= len(_ANSWER))
+                yield f"data: {json.dumps(chunk, ensure_ascii=False)}\r\n\r\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    return app
+
+
+def mattermost_app(files: dict[str, tuple[str, bytes]] | None = None) -> FastAPI:
+    """Incoming Webhook・REST API (投稿・更新・ファイル) の代替。投稿はチャンネルごとに時刻付きで記録する。"""
+    app = FastAPI()
+    app.state.posts = defaultdict(list)  # channel_id -> [(monotonic, text)]
+    app.state.edits = 0
+    app.state.waiters = {}
+    files = files or {}
+
+    def record(channel_id: str, text: str) -> None:
+        app.state.posts[channel_id].append((time.monotonic(), text))
+        waiter = app.state.waiters.pop(channel_id, None)
+        if waiter is not None and not waiter.done():
+            waiter.set_result(time.monotonic())
+
+    @app.get("/api/v4/system/ping")
+    async def ping():
+        return {"status": "OK"}
+
+    @app.post("/hooks/{hook_id}")
+    async def incoming_webhook(hook_id: str, request: Request):
+        body = await request.json()
+        record(body["channel_id"], body["text"])
+        return Response("ok")
+
+    @app.post("/api/v4/posts")
+    async def create_post(request: Request):
+        body = await request.json()
+        record(body["channel_id"], body["message"])
+        return {"id": f"post-{body['channel_id']}"}
+
+    @app.put("/api/v4/posts/{post_id}/patch")
+    async def patch_post(post_id: str):
+        app.state.edits += 1
+        return {"id": post_id}
+
+    @app.get("/api/v4/files/{file_id}/info")
+    async def file_info(file_id: str):
+        return {"name": files[file_id][0]}
+
+    @app.get("/api/v4/files/{file_id}")
+    async def file_body(file_id: str):
+        return Response(files[file_id][1], media_type="application/octet-stream")
+
+    return app
+
+
+def wait_for_post(app: FastAPI, channel_id: str) -> asyncio.Future:
+    """チャンネルへの次の投稿を待つFuture (結果は投稿を受けた時刻)。"""
+    future = asyncio.get_running_loop().create_future()
+    app.state.waiters[channel_id] = future
+    return future
+
+
+def _candidate(text: str, final: bool = True) -> dict:
+    candidate = {"content": {"role": "model", "parts": [{"text": text}]}, "index": 0}
+    if final:
+        candidate["finishReason"] = "STOP"
+    return {
+        "candidates": [candidate],
+        "usageMetadata": {"promptTokenCount": 100, "candidatesTokenCount": len(text), "totalTokenCount": 100 + len(text)},
+    }
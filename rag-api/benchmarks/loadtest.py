@@ -0,0 +1,253 @@
+"""rag-api の負荷試験。Gemini・Mattermostは代替サーバー (benchmarks.fakes)、Qdrantはインメモリで動かす。
+
+rag-api を別プロセス (uvicorn) で起動し、以下のシナリオを計測する:
+
+- import:  POST /api/v1/data/import に生成したCSVを送る (--rows ごと)。rows/s
+- search:  GET /api/v1/data/search を --concurrency 並列で --searches 回。p50/p95/p99
+- webhook: Outgoing Webhook を送り、代替Mattermostに返信が投稿されるまでの時間。p50/p95/p99
+
+rag-api ディレクトリで実行する:
+
+    python -m benchmarks.loadtest --rows 1000 100000 --searches 500 --webhooks 200 \\
+        --concurrency 20 --latency-ms 300 --rate-limit-ratio 0.05
+
+実際のQdrantに向ける場合は --qdrant-host を指定する (コレクションは上書きされるので検証用のものを使う)。
+"""
+import argparse
+import asyncio
+import os
+import random
+import socket
+import statistics
+import sys
+import time
+
+import httpx
+import uvicorn
+
+import config
+from benchmarks import fakes
+from benchmarks.bench_parser import generate_csv
+
+_QUERIES = [
+    "SUS304 Φ50×200 のシャフトの見積もり",
+    "S45C 外径30くらいのピン",
+    "アルミのスペーサー 長さ100以下",
+    "φ20 L150 SCM440",
+    "真鍮の小さいカラーはいくら?",
+    "SKD11 ガイドピン 100個",
+]
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def _serve(app, port: int) -> tuple[uvicorn.Server, asyncio.Task]:
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.05)
+    return server, task
+
+
+async def _start_api(args, port: int, gemini_port: int, mattermost_port: int) -> asyncio.subprocess.Process:
+    env = {
+        **os.environ,
+        "GEMINI_API_KEY": "loadtest",
+        "GEMINI_BASE_URL": f"http://127.0.0.1:{gemini_port}",
+        "EMBEDDING_BACKEND": "gemini",
+        "EMBEDDING_CACHE_PATH": "",
+        "JOB_STORE_PATH": "",
+        "MATTERMOST_INCOMING_WEBHOOK_URL": f"http://127.0.0.1:{mattermost_port}/hooks/loadtest",
+        "MATTERMOST_API_URL": f"http://127.0.0.1:{mattermost_port}/api/v4",
+        "MATTERMOST_BOT_TOKEN": "loadtest",
+        "MATTERMOST_OUTGOING_WEBHOOK_TOKEN": "",
+        "MATTERMOST_STREAMING": "true" if args.streaming else "false",
+    }
+    if args.qdrant_host:
+        env.update(QDRANT_HOST=args.qdrant_host, QDRANT_PORT=str(args.qdrant_port), QDRANT_LOCATION="")
+    else:
+        env["QDRANT_LOCATION"] = ":memory:"
+    if args.no_answer_cache:
+        env["ANSWER_CACHE_SIZE"] = "0"
+
+    # rag-apiのログはINFOで大量に出るため、指定がなければ捨てる
+    log = open(args.api_log, "ab") if args.api_log else asyncio.subprocess.DEVNULL
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, "-m", "uvicorn", "main:app",
+        "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning",
+        env=env, stdout=log, stderr=log,
+    )
+    async with httpx.AsyncClient() as client:
+        for _ in range(300):
+            if process.returncode is not None:
+                raise SystemExit("rag-api の起動に失敗しました (--api-log でログを確認してください)")
+            try:
+                response = await client.get(f"http://127.0.0.1:{port}/api/v1/health/ready")
+                if response.is_success:
+                    return process
+            except httpx.TransportError:
+                pass
+            await asyncio.sleep(0.1)
+    process.terminate()
+    raise SystemExit("rag-api が起動しません")
+
+
+def _peak_rss_mb(pid: int) -> float | None:
+    """プロセスの最大常駐メモリ (VmHWM)。Linux以外では None。"""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def _report(name: str, latencies: list[float], errors: int, elapsed: float, extra: str = "") -> None:
+    if len(latencies) >= 2:
+        q = statistics.quantiles(latencies, n=100, method="inclusive")
+        p50, p95, p99 = q[49], q[94], q[98]
+    else:
+        p50 = p95 = p99 = latencies[0] if latencies else float("nan")
+    print(
+        f"{name:<8} {len(latencies):>6} {errors:>6} {len(latencies) / elapsed:>8.1f}"
+        f" {p50 * 1000:>8.0f} {p95 * 1000:>8.0f} {p99 * 1000:>8.0f}  {extra}"
+    )
+
+
+async def _run_concurrently(count: int, concurrency: int, func) -> tuple[list[float], int, float]:
+    """func(i) を最大concurrency並列でcount回実行し、成功分の所要時間・エラー数・全体の経過時間を返す。"""
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies: list[float] = []
+    errors = 0
+
+    async def one(i: int) -> None:
+        nonlocal errors
+        async with semaphore:
+            start = time.monotonic()
+            try:
+                ok = await func(i)
+            except Exception:
+                ok = False
+            if ok:
+                latencies.append(time.monotonic() - start)
+            else:
+                errors += 1
+
+    start = time.monotonic()
+    await asyncio.gather(*(one(i) for i in range(count)))
+    return latencies, errors, time.monotonic() - start
+
+
+async def _import(client: httpx.AsyncClient, base: str, rows: int) -> None:
+    content = generate_csv(rows)
+    start = time.monotonic()
+    response = await client.post(
+        f"{base}/api/v1/data/import",
+        files={"file": (f"loadtest_{rows}.csv", content, "text/csv")},
+        timeout=None,
+    )
+    elapsed = time.monotonic() - start
+    if response.is_error:
+        print(f"import   {rows:>8} rows: HTTP {response.status_code} {response.text[:200]}")
+        return
+    body = response.json()
+    print(
+        f"import   {rows:>8} rows: {elapsed:>7.1f}s {rows / elapsed:>9.0f} rows/s"
+        f"  (new {body.get('new_count', 0)}, updated {body.get('updated_count', 0)},"
+        f" unchanged {body.get('unchanged_count', 0)}, errors {len(body.get('errors', []))})"
+    )
+
+
+async def main_async(args) -> None:
+    dimension = config.EMBEDDING_OUTPUT_DIMENSION or config.EMBEDDING_DIMENSION
+    gemini = fakes.gemini_app(dimension, args.latency_ms, args.rate_limit_ratio)
+    mattermost = fakes.mattermost_app()
+    gemini_port, mattermost_port, api_port = _free_port(), _free_port(), _free_port()
+    servers = [await _serve(gemini, gemini_port), await _serve(mattermost, mattermost_port)]
+
+    process = await _start_api(args, api_port, gemini_port, mattermost_port)
+    base = f"http://127.0.0.1:{api_port}"
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    try:
+        async with httpx.AsyncClient(limits=limits, timeout=args.timeout) as client:
+            for rows in args.rows:
+                await _import(client, base, rows)
+
+            print(f"{'scenario':<8} {'ok':>6} {'errors':>6} {'req/s':>8} {'p50ms':>8} {'p95ms':>8} {'p99ms':>8}")
+
+            async def search(i: int) -> bool:
+                response = await client.get(
+                    f"{base}/api/v1/data/search", params={"q": random.choice(_QUERIES)}
+                )
+                return response.is_success
+
+            if args.searches:
+                _report("search", *await _run_concurrently(args.searches, args.concurrency, search))
+
+            busy = 0
+
+            async def webhook(i: int) -> bool:
+                nonlocal busy
+                channel_id = f"loadtest-{i}"
+                posted = fakes.wait_for_post(mattermost, channel_id)
+                response = await client.post(
+                    f"{base}/api/v1/webhook/mattermost",
+                    json={
+                        "text": f"@見積 {random.choice(_QUERIES)}",
+                        "channel_id": channel_id,
+                        "post_id": f"loadtest-post-{i}",
+                    },
+                )
+                if response.is_error or "混雑中" in response.json().get("text", ""):
+                    busy += "混雑中" in response.text
+                    posted.cancel()
+                    return False
+                await asyncio.wait_for(posted, args.timeout)
+                return True
+
+            if args.webhooks:
+                latencies, errors, elapsed = await _run_concurrently(args.webhooks, args.concurrency, webhook)
+                _report("webhook", latencies, errors, elapsed, f"busy {busy}")
+
+            stats = (await client.get(f"{base}/api/v1/data/stats")).json()
+    finally:
+        rss = _peak_rss_mb(process.pid)
+        process.terminate()
+        await process.wait()
+        for server, task in servers:
+            server.should_exit = True
+            await task
+
+    print()
+    print(f"rag-api peak RSS: {f'{rss:.0f} MB' if rss is not None else 'n/a'}")
+    print(f"fake Gemini calls: {dict(gemini.state.calls)}")
+    print(f"fake Mattermost post edits: {mattermost.state.edits}")
+    print(f"answer cache: {stats['answer_cache']}")
+    print(f"filter extraction: {stats['filter_extraction']}")
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--rows", type=int, nargs="*", default=[1_000, 10_000])
+    ap.add_argument("--searches", type=int, default=200)
+    ap.add_argument("--webhooks", type=int, default=100)
+    ap.add_argument("--concurrency", type=int, default=10)
+    ap.add_argument("--latency-ms", type=float, default=200.0, help="代替Geminiの平均レイテンシ (指数分布)")
+    ap.add_argument("--rate-limit-ratio", type=float, default=0.0, help="代替Geminiが429を返す割合")
+    ap.add_argument("--streaming", action="store_true", help="MATTERMOST_STREAMING を有効にする")
+    ap.add_argument("--no-answer-cache", action="store_true", help="回答キャッシュを無効にする")
+    ap.add_argument("--qdrant-host", default="", help="省略時はインメモリのQdrantを使う")
+    ap.add_argument("--qdrant-port", type=int, default=6333)
+    ap.add_argument("--timeout", type=float, default=120.0)
+    ap.add_argument("--api-log", default="", help="rag-apiのログの出力先ファイル")
+    asyncio.run(main_async(ap.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,14 @@
 import os
 
 
-GEMINI_API_KEY = os.environ["GEMINI_API_KEY"]
+# Geminiを使う処理の初回呼び出し時に必要になる (起動時には検査しない)
+GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY", "")
 QDRANT_HOST = os.environ.get("QDRANT_HOST", "qdrant")
 QDRANT_PORT = int(os.environ.get("QDRANT_PORT", "6333"))
+# 指定するとQDRANT_HOST/PORTの代わりに使う (":memory:" またはローカルのパス。負荷試験・開発用)
+QDRANT_LOCATION = os.environ.get("QDRANT_LOCATION", "")
+# Gemini APIの接続先の上書き (負荷試験用の代替サーバーなど)
+GEMINI_BASE_URL = os.environ.get("GEMINI_BASE_URL", "")
 
 MATTERMOST_API_URL = os.environ.get("MATTERMOST_API_URL", "")
 MATTERMOST_BOT_TOKEN = os.environ.get("MATTERMOST_BOT_TOKEN", "")
@@ -16,3 +21,133 @@ EMBEDDING_DIMENSION = 768
 LLM_MODEL = "gemini-2.0-flash"
 SEARCH_LIMIT = 5
 EMBEDDING_BATCH_SIZE = 100
+
+# 検索パイプラインの各ステージのタイムアウト (秒)
+EMBED_TIMEOUT = float(os.environ.get("EMBED_TIMEOUT", "10"))
+FILTER_EXTRACTION_TIMEOUT = float(os.environ.get("FILTER_EXTRACTION_TIMEOUT", "8"))
+QDRANT_SEARCH_TIMEOUT = float(os.environ.get("QDRANT_SEARCH_TIMEOUT", "5"))
+LLM_TIMEOUT = float(os.environ.get("LLM_TIMEOUT", "60"))
+
+# Embeddingキャッシュ (メモリLRUの最大件数 / SQLite永続化先。空なら永続化しない / SQLiteの最大件数。0なら無制限)
+EMBEDDING_CACHE_SIZE = int(os.environ.get("EMBEDDING_CACHE_SIZE", "5000"))
+EMBEDDING_CACHE_PATH = os.environ.get("EMBEDDING_CACHE_PATH", "")
+EMBEDDING_CACHE_MAX_DISK_ENTRIES = int(os.environ.get("EMBEDDING_CACHE_MAX_DISK_ENTRIES", "100000"))
+
+# コレクションのエクスポート (ベクトルの.npy + payloadのJSONL) の保存先と、読み込み時のupsertの並列数
+EXPORT_DIR = os.environ.get("EXPORT_DIR", "data/exports")
+EXPORT_UPSERT_CONCURRENCY = int(os.environ.get("EXPORT_UPSERT_CONCURRENCY", "4"))
+
+# 再インデックス (QDRANT_COLLECTION はエイリアスで、実体は "<名前>_v<N>" のコレクション)
+# 1バッチの件数 / upsertの並列数 / 検証に使うサンプル数と必要なRecall / インデックス構築の待ち時間 (秒) /
+# ロールバック用に残す過去バージョン数
+REINDEX_BATCH_SIZE = int(os.environ.get("REINDEX_BATCH_SIZE", "500"))
+REINDEX_UPSERT_CONCURRENCY = int(os.environ.get("REINDEX_UPSERT_CONCURRENCY", "4"))
+REINDEX_VERIFY_SAMPLES = int(os.environ.get("REINDEX_VERIFY_SAMPLES", "50"))
+REINDEX_MIN_RECALL = float(os.environ.get("REINDEX_MIN_RECALL", "0.9"))
+REINDEX_INDEX_TIMEOUT = float(os.environ.get("REINDEX_INDEX_TIMEOUT", "3600"))
+REINDEX_KEEP_VERSIONS = int(os.environ.get("REINDEX_KEEP_VERSIONS", "1"))
+
+# ストリーミング取り込み (1チャンクの行数 / パイプライン各段の最大待ちチャンク数)
+IMPORT_CHUNK_SIZE = int(os.environ.get("IMPORT_CHUNK_SIZE", "1000"))
+IMPORT_PIPELINE_DEPTH = int(os.environ.get("IMPORT_PIPELINE_DEPTH", "2"))
+
+# Embeddingバッチのスケジューリング (0以下のレート上限は無制限)
+EMBEDDING_MAX_CONCURRENCY = int(os.environ.get("EMBEDDING_MAX_CONCURRENCY", "4"))
+EMBEDDING_REQUESTS_PER_MINUTE = float(os.environ.get("EMBEDDING_REQUESTS_PER_MINUTE", "1500"))
+EMBEDDING_TOKENS_PER_MINUTE = float(os.environ.get("EMBEDDING_TOKENS_PER_MINUTE", "0"))
+EMBEDDING_MAX_RETRIES = int(os.environ.get("EMBEDDING_MAX_RETRIES", "5"))
+EMBEDDING_RETRY_BASE_DELAY = float(os.environ.get("EMBEDDING_RETRY_BASE_DELAY", "1"))
+EMBEDDING_RETRY_MAX_DELAY = float(os.environ.get("EMBEDDING_RETRY_MAX_DELAY", "60"))
+
+# Embeddingバックエンド: "gemini" / "hashing" (決定的・オフライン) / "sentence-transformers" (CPUローカル)
+EMBEDDING_BACKEND = os.environ.get("EMBEDDING_BACKEND", "gemini")
+LOCAL_EMBEDDING_MODEL = os.environ.get(
+    "LOCAL_EMBEDDING_MODEL", "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2"
+)
+LOCAL_EMBEDDING_DIMENSION = int(os.environ.get("LOCAL_EMBEDDING_DIMENSION", "768"))
+
+# ハイブリッド検索 (密ベクトル + 文字n-gramの疎ベクトルをRRFで融合)
+HYBRID_SEARCH = os.environ.get("HYBRID_SEARCH", "true").lower() == "true"
+SPARSE_VECTOR_NAME = "text"
+HYBRID_PREFETCH_FACTOR = int(os.environ.get("HYBRID_PREFETCH_FACTOR", "4"))
+
+# Qdrantコレクションのチューニング (起動時に既存コレクションにも反映される)
+HNSW_M = int(os.environ.get("HNSW_M", "16"))
+HNSW_EF_CONSTRUCT = int(os.environ.get("HNSW_EF_CONSTRUCT", "100"))
+HNSW_FULL_SCAN_THRESHOLD = int(os.environ.get("HNSW_FULL_SCAN_THRESHOLD", "10000"))
+QDRANT_INDEXING_THRESHOLD = int(os.environ.get("QDRANT_INDEXING_THRESHOLD", "10000"))
+QDRANT_DEFAULT_SEGMENT_NUMBER = int(os.environ.get("QDRANT_DEFAULT_SEGMENT_NUMBER", "2"))
+
+# ストレージプロファイル: "default" (float32) / "scalar" (int8量子化) / "binary" (1bit量子化)
+QDRANT_STORAGE_PROFILE = os.environ.get("QDRANT_STORAGE_PROFILE", "default")
+QDRANT_VECTORS_ON_DISK = os.environ.get("QDRANT_VECTORS_ON_DISK", "false").lower() == "true"
+QUANTIZATION_RESCORE = os.environ.get("QUANTIZATION_RESCORE", "true").lower() == "true"
+QUANTIZATION_OVERSAMPLING = float(os.environ.get("QUANTIZATION_OVERSAMPLING", "2.0"))
+# Matryoshka表現の次元削減 (0なら削減しない)。変更するとコレクションの作り直しが必要
+EMBEDDING_OUTPUT_DIMENSION = int(os.environ.get("EMBEDDING_OUTPUT_DIMENSION", "0"))
+
+# フィルタ抽出: 規則ベースで確定できないクエリだけをLLMに送る
+FILTER_RULES = os.environ.get("FILTER_RULES", "true").lower() == "true"
+
+# LLM回答キャッシュ (件数上限0で無効)。類似度閾値 (0〜1) を設定すると言い回し違いの質問にも流用する
+ANSWER_CACHE_SIZE = int(os.environ.get("ANSWER_CACHE_SIZE", "1000"))
+ANSWER_CACHE_TTL = float(os.environ.get("ANSWER_CACHE_TTL", "21600"))
+ANSWER_CACHE_SIMILARITY = float(os.environ.get("ANSWER_CACHE_SIMILARITY", "0"))
+
+# 検索回答のストリーミング投稿 (要 MATTERMOST_BOT_TOKEN)。投稿の更新は最短でもこの間隔 (秒) で行う
+MATTERMOST_STREAMING = os.environ.get("MATTERMOST_STREAMING", "false").lower() == "true"
+MATTERMOST_STREAM_EDIT_INTERVAL = float(os.environ.get("MATTERMOST_STREAM_EDIT_INTERVAL", "1.0"))
+
+# Mattermostへの共有HTTPクライアント (接続プール・keep-alive・HTTP/2) とリトライ
+MATTERMOST_HTTP2 = os.environ.get("MATTERMOST_HTTP2", "false").lower() == "true"
+MATTERMOST_MAX_CONNECTIONS = int(os.environ.get("MATTERMOST_MAX_CONNECTIONS", "20"))
+MATTERMOST_MAX_KEEPALIVE_CONNECTIONS = int(os.environ.get("MATTERMOST_MAX_KEEPALIVE_CONNECTIONS", "10"))
+# keep-alive接続の保持時間 (秒) は、Mattermost・リバースプロキシのアイドルタイムアウトより短くする
+MATTERMOST_KEEPALIVE_EXPIRY = float(os.environ.get("MATTERMOST_KEEPALIVE_EXPIRY", "5"))
+MATTERMOST_MAX_RETRIES = int(os.environ.get("MATTERMOST_MAX_RETRIES", "3"))
+MATTERMOST_RETRY_BASE_DELAY = float(os.environ.get("MATTERMOST_RETRY_BASE_DELAY", "0.5"))
+MATTERMOST_RETRY_MAX_DELAY = float(os.environ.get("MATTERMOST_RETRY_MAX_DELAY", "10"))
+# ダウンロードしたファイルをメモリ上に保持する上限 (超えると一時ファイルに書き出す)
+MATTERMOST_DOWNLOAD_SPOOL_BYTES = int(os.environ.get("MATTERMOST_DOWNLOAD_SPOOL_BYTES", str(16 * 1024 * 1024)))
+
+# 検索後の再ランキングと価格統計。RERANK_CANDIDATES件の候補を取得し、ベクトル類似度と寸法の近さの
+# 合成スコアで並べ替える (0なら候補を増やさない)。価格統計は上位PRICE_STATS_SIZE件から計算する (0で無効)
+RERANK_CANDIDATES = int(os.environ.get("RERANK_CANDIDATES", "30"))
+RERANK_SIZE_WEIGHT = float(os.environ.get("RERANK_SIZE_WEIGHT", "0.3"))
+PRICE_STATS_SIZE = int(os.environ.get("PRICE_STATS_SIZE", "10"))
+
+# LLM回答のプロンプト。システムプロンプトとfew-shot例をGeminiのコンテキストキャッシュに置く (TTLは秒)。
+# 検索結果のコンテキストは文字数の上限 (0で無制限) に収まる件数だけ送る。トークン数ではない
+# (日本語と英数字が混ざる行では1トークンあたり約1.5〜2文字。実際のトークン数は回答生成のログで確認できる)
+LLM_CONTEXT_CACHE = os.environ.get("LLM_CONTEXT_CACHE", "false").lower() == "true"
+LLM_CONTEXT_CACHE_TTL = int(os.environ.get("LLM_CONTEXT_CACHE_TTL", "3600"))
+LLM_CONTEXT_CHAR_BUDGET = int(os.environ.get("LLM_CONTEXT_CHAR_BUDGET", "1500"))
+# 規則で確定できないクエリのフィルタ抽出を回答生成と1回の呼び出しにまとめる (webhookの非ストリーミング検索・/search)
+LLM_COMBINED_MODE = os.environ.get("LLM_COMBINED_MODE", "false").lower() == "true"
+
+# Webhookのジョブキュー (検索と取り込みで別々のキュー・ワーカー)。満杯時は「混雑中」と返信する
+SEARCH_WORKERS = int(os.environ.get("SEARCH_WORKERS", "4"))
+SEARCH_QUEUE_SIZE = int(os.environ.get("SEARCH_QUEUE_SIZE", "50"))
+IMPORT_WORKERS = int(os.environ.get("IMPORT_WORKERS", "1"))
+IMPORT_QUEUE_SIZE = int(os.environ.get("IMPORT_QUEUE_SIZE", "5"))
+# シャットダウン時に処理中のジョブを待つ最大秒数
+JOB_DRAIN_TIMEOUT = float(os.environ.get("JOB_DRAIN_TIMEOUT", "30"))
+# 未完了の取り込みジョブの保存先 (SQLite)。空なら永続化しない
+JOB_STORE_PATH = os.environ.get("JOB_STORE_PATH", "")
+
+# OpenTelemetryのトレース送信 (要 opentelemetry-sdk / opentelemetry-exporter-otlp)。送信先は OTEL_EXPORTER_OTLP_ENDPOINT
+OTEL_ENABLED = os.environ.get("OTEL_ENABLED", "false").lower() == "true"
+OTEL_SERVICE_NAME = os.environ.get("OTEL_SERVICE_NAME", "estimate-rag")
+
+# 依存サービスのヘルスチェック。バックグラウンドで間隔 (秒) ごとに確認し、/api/v1/health は結果のキャッシュを返す。
+# 確認結果は「間隔の2倍 + タイムアウト」を過ぎると古いもの (stale) として扱う。Geminiの確認はAPIの割り当てを使うため間隔を長めにする
+HEALTH_QDRANT_INTERVAL = float(os.environ.get("HEALTH_QDRANT_INTERVAL", "15"))
+HEALTH_QDRANT_TIMEOUT = float(os.environ.get("HEALTH_QDRANT_TIMEOUT", "2"))
+HEALTH_GEMINI_INTERVAL = float(os.environ.get("HEALTH_GEMINI_INTERVAL", "300"))
+HEALTH_GEMINI_TIMEOUT = float(os.environ.get("HEALTH_GEMINI_TIMEOUT", "5"))
+HEALTH_MATTERMOST_INTERVAL = float(os.environ.get("HEALTH_MATTERMOST_INTERVAL", "60"))
+HEALTH_MATTERMOST_TIMEOUT = float(os.environ.get("HEALTH_MATTERMOST_TIMEOUT", "5"))
+
+# バッチ検索API (1リクエストの最大クエリ数 / フィルタ抽出・回答生成のLLM同時呼び出し数)
+SEARCH_BATCH_MAX_QUERIES = int(os.environ.get("SEARCH_BATCH_MAX_QUERIES", "1000"))
+SEARCH_BATCH_CONCURRENCY = int(os.environ.get("SEARCH_BATCH_CONCURRENCY", "8"))
@@ -1,25 +1,39 @@
 import logging
 from contextlib import asynccontextmanager
 
-from fastapi import FastAPI
+from fastapi import FastAPI, Response
+from fastapi.responses import JSONResponse
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 
-from services.qdrant import ensure_collection, is_healthy
-from services.gemini_client import client as gemini_client
 from routers import search, webhook
+from services import health, jobs, mattermost, metrics, qdrant, warmup
 
 logging.basicConfig(
     level=logging.INFO,
-    format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+    format="%(asctime)s %(levelname)s %(name)s [%(request_id)s]: %(message)s",
 )
+for _handler in logging.getLogger().handlers:
+    _handler.addFilter(metrics.RequestIdLogFilter())
 logger = logging.getLogger(__name__)
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    logger.info("Starting up — ensuring Qdrant collection exists")
-    await ensure_collection()
-    logger.info("Startup complete")
+    metrics.setup_tracing()
+    await qdrant.start()
+    await mattermost.start()
+    await jobs.start()
+    # コレクションの確認などのネットワーク往復は待たずに受け付けを始める (完了まで readiness は503)
+    warmup_task = warmup.start()
+    health.start()
+    logger.info("Startup complete — warming up in the background")
     yield
+    logger.info("Shutting down — draining background jobs")
+    warmup_task.cancel()
+    await health.close()
+    await jobs.shutdown()
+    await mattermost.close()
+    await qdrant.close()
 
 
 app = FastAPI(title="Estimate RAG API", lifespan=lifespan)
@@ -27,19 +41,40 @@ app.include_router(search.router)
 app.include_router(webhook.router)
 
 
-@app.get("/api/v1/health")
-async def health():
-    qdrant_ok = await is_healthy()
+@app.get("/metrics", include_in_schema=False)
+async def prometheus_metrics():
+    """Prometheusのスクレイプ用エンドポイント。"""
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
+@app.get("/api/v1/health/live")
+async def liveness():
+    """プロセスが応答できるか (liveness)。外部サービスには接続しない。"""
+    return {"status": "ok"}
+
 
-    gemini_ok = True
-    try:
-        gemini_client.models.list()
-    except Exception:
-        gemini_ok = False
+@app.get("/api/v1/health/ready")
+async def readiness():
+    """起動後の準備が終わり、問い合わせを処理できるか (readiness)。準備中・失敗時は503。"""
+    status = warmup.status()
+    return JSONResponse(status, status_code=200 if status["ready"] else 503)
+
+
+@app.get("/api/v1/health")
+async def health_check():
+    """依存サービスの状態。バックグラウンドの定期確認の結果を返すだけで、リクエストごとには接続しない。"""
+    checks = health.snapshot()
+    qdrant_ok = checks["qdrant"]["status"] == health.UP
+    gemini_ok = checks["gemini"]["status"] == health.UP
+    mattermost_ok = checks["mattermost"]["status"] in (health.UP, health.NOT_CONFIGURED)
 
-    status = "ok" if (qdrant_ok and gemini_ok) else "degraded"
+    status = "ok" if (qdrant_ok and gemini_ok and mattermost_ok) else "degraded"
     return {
         "status": status,
         "qdrant": "connected" if qdrant_ok else "disconnected",
         "gemini": "available" if gemini_ok else "unavailable",
+        "mattermost": {health.UP: "connected", health.NOT_CONFIGURED: "not_configured"}.get(
+            checks["mattermost"]["status"], "disconnected"
+        ),
+        "checks": checks,
     }
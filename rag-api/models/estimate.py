@@ -1,3 +1,5 @@
+import hashlib
+import json
 from datetime import date, datetime
 from typing import Optional
 
@@ -36,16 +38,33 @@ class EstimateRecord(BaseModel):
             parts.append(self.notes)
         return " ".join(parts)
 
+    def text_fingerprint(self) -> str:
+        """Embedding対象テキストのフィンガープリント。変化した場合のみベクトルの再計算が必要。"""
+        return _fingerprint(self.to_embedding_text())
+
+    def payload_fingerprint(self) -> str:
+        """Embedding対象外を含む全フィールドのフィンガープリント。"""
+        fields = self.model_dump(mode="json")
+        fields.pop("id")
+        return _fingerprint(json.dumps(fields, ensure_ascii=False, sort_keys=True))
+
     def to_payload(self) -> dict:
         """Qdrantに格納するpayloadを生成する。"""
         payload = self.model_dump(mode="json")
         payload.pop("id")
         payload["text"] = self.to_embedding_text()
+        payload["text_hash"] = _fingerprint(payload["text"])
+        payload["payload_hash"] = self.payload_fingerprint()
         return payload
 
 
+def _fingerprint(value: str) -> str:
+    return hashlib.sha256(value.encode("utf-8")).hexdigest()[:32]
+
+
 class ImportResult(BaseModel):
     new_count: int = 0
     updated_count: int = 0
+    unchanged_count: int = 0
     errors: list[str] = Field(default_factory=list)
     total_count: int = 0
@@ -1,8 +1,14 @@
+import asyncio
+import json
+from collections.abc import AsyncIterator
 from typing import Optional
 
-from fastapi import APIRouter, UploadFile, File
+from fastapi import APIRouter, HTTPException, UploadFile, File
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel
 
-from services import rag, qdrant, parser
+import config
+from services import answer_cache, backup, embedding, filter, jobs, rag, qdrant, reindex
 
 router = APIRouter(prefix="/api/v1/data")
 
@@ -11,7 +17,77 @@ router = APIRouter(prefix="/api/v1/data")
 async def search(q: str, material: Optional[str] = None, limit: int = 5):
     """デバッグ・管理用の直接検索API。"""
     result = await rag.search(q, limit=limit, material_filter=material)
-    return {"results": result["results"]}
+    return {
+        "results": result["results"],
+        "price_stats": result.get("price_stats"),
+        "timings": result["timings"],
+    }
+
+
+class BatchSearchRequest(BaseModel):
+    queries: list[str]
+    limit: int = 5
+    material: Optional[str] = None
+    answer: bool = False
+
+
+@router.post("/search/batch")
+async def search_batch(request: BatchSearchRequest):
+    """複数クエリの一括検索 (夜間の品質チェック・回答キャッシュのウォームアップ用)。
+
+    結果はNDJSONで1クエリ1行 ({"index", "query", "results", "price_stats", "timings"}) ずつ返す。
+    answer=true の場合はLLM回答も生成し、生成できた順に返す (回答はキャッシュされる)。
+    """
+    if len(request.queries) > config.SEARCH_BATCH_MAX_QUERIES:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Too many queries (max {config.SEARCH_BATCH_MAX_QUERIES})",
+        )
+    retrievals = await rag.retrieve_batch(
+        request.queries, limit=request.limit, material_filter=request.material
+    )
+    return StreamingResponse(
+        _batch_lines(retrievals, request.answer), media_type="application/x-ndjson"
+    )
+
+
+async def _batch_lines(retrievals: list[rag.Retrieval], answer: bool) -> AsyncIterator[str]:
+    def line(index: int, retrieval: rag.Retrieval, **extra) -> str:
+        item = {
+            "index": index,
+            "query": retrieval.query,
+            "results": retrieval.results,
+            "price_stats": retrieval.price_stats,
+            **extra,
+            "timings": retrieval.timings,
+        }
+        return json.dumps(item, ensure_ascii=False, default=str) + "\n"
+
+    if not answer:
+        for i, retrieval in enumerate(retrievals):
+            yield line(i, retrieval)
+        return
+
+    semaphore = asyncio.Semaphore(config.SEARCH_BATCH_CONCURRENCY)
+
+    async def answer_one(i: int, retrieval: rag.Retrieval) -> tuple[int, dict]:
+        if not retrieval.results:
+            return i, {"answer": rag.NO_RESULTS_MESSAGE}
+        async with semaphore:
+            try:
+                return i, {"answer": await rag.answer_retrieval(retrieval)}
+            except Exception as e:
+                return i, {"error": str(e) or type(e).__name__}
+
+    tasks = [asyncio.create_task(answer_one(i, r)) for i, r in enumerate(retrievals)]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            i, extra = await next_done
+            yield line(i, retrievals[i], **extra)
+    finally:
+        # クライアントが切断した場合は残りの生成を打ち切る
+        for task in tasks:
+            task.cancel()
 
 
 @router.get("/count")
@@ -20,20 +96,134 @@ async def count():
     return {"count": await qdrant.count()}
 
 
+@router.get("/stats")
+async def stats():
+    """キャッシュ等の内部統計を取得。"""
+    return {
+        "embedding_cache": embedding.cache_stats(),
+        "embedding_backend": embedding.backend_stats(),
+        "filter_extraction": filter.stats(),
+        "answer_cache": answer_cache.cache_stats(),
+        "jobs": jobs.stats(),
+    }
+
+
 @router.post("/import")
 async def import_csv(file: UploadFile = File(...)):
     """デバッグ用: CSVファイルを直接アップロードして取り込む。"""
-    content = await file.read()
-    records, errors = parser.parse_file(content, file.filename or "upload.csv")
+    # pandasを読み込むため、取り込みが必要になるまでimportしない
+    from services import parser
+
+    chunks = parser.iter_file_chunks(
+        file.file, file.filename or "upload.csv", config.IMPORT_CHUNK_SIZE
+    )
+    result = await rag.import_stream(chunks)
 
-    if not records and errors:
-        return {"status": "error", "errors": errors}
+    processed = result.new_count + result.updated_count + result.unchanged_count
+    if not processed and result.errors:
+        return {"status": "error", "errors": result.errors}
 
-    result = await rag.import_records(records)
     return {
         "status": "ok",
         "new_count": result.new_count,
         "updated_count": result.updated_count,
-        "errors": errors + result.errors,
+        "unchanged_count": result.unchanged_count,
+        "errors": result.errors,
         "total_count": result.total_count,
     }
+
+
+class RecoverRequest(BaseModel):
+    location: str
+
+
+@router.get("/exports")
+async def list_exports():
+    """デバッグ用: 完了したエクスポートの一覧。"""
+    return {"exports": backup.list_exports()}
+
+
+@router.post("/exports")
+async def export_collection(name: Optional[str] = None):
+    """デバッグ用: コレクション全体を EXPORT_DIR/<name>/ に書き出す (省略時は日時)。"""
+    try:
+        return await backup.export_collection(name)
+    except FileExistsError:
+        raise HTTPException(status_code=409, detail=f"Export '{name}' already exists")
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@router.post("/exports/{name}/load")
+async def load_export(name: str):
+    """デバッグ用: エクスポートを読み込む。Embeddingは再計算しない。"""
+    try:
+        return await backup.load_export(name)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail=f"Export '{name}' not found")
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@router.get("/snapshots")
+async def list_snapshots():
+    """デバッグ用: Qdrantのスナップショット一覧。"""
+    return {"snapshots": await qdrant.list_snapshots()}
+
+
+@router.post("/snapshots")
+async def create_snapshot():
+    """デバッグ用: Qdrantのスナップショットを作成する。"""
+    return await qdrant.create_snapshot()
+
+
+@router.post("/snapshots/recover")
+async def recover_snapshot(request: RecoverRequest):
+    """デバッグ用: スナップショットから復元する (Qdrantから見えるURLまたはfile://パス)。"""
+    await qdrant.recover_snapshot(request.location)
+    await filter.refresh_materials()
+    return {"status": "ok", "total_count": await qdrant.count()}
+
+
+@router.get("/collections")
+async def list_collections():
+    """デバッグ用: バージョン付きコレクションの一覧と、再インデックスの進捗。"""
+    return {
+        "active": await qdrant.active_collection(),
+        "versions": await qdrant.list_versions(),
+        "reindex": reindex.status(),
+    }
+
+
+@router.post("/reindex", status_code=202)
+async def start_reindex():
+    """デバッグ用: 現在の設定で新しいバージョンを作る再インデックスをバックグラウンドで開始する。"""
+    try:
+        reindex.start()
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return {"status": "started"}
+
+
+@router.post("/collections/{version}/activate")
+async def activate_collection(version: int):
+    """デバッグ用: 検証済みのバージョンにエイリアスを切り替える。"""
+    try:
+        return await reindex.activate(version)
+    except LookupError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@router.post("/collections/rollback")
+async def rollback_collection():
+    """デバッグ用: ひとつ前の検証済みバージョンに戻す。"""
+    try:
+        return await reindex.rollback()
+    except LookupError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
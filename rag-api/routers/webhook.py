@@ -1,23 +1,16 @@
 import asyncio
+import importlib
 import logging
+from typing import BinaryIO
 
 from fastapi import APIRouter, HTTPException, Request
 
 import config
-from services import rag, qdrant, mattermost, parser
+from services import answer_cache, jobs, metrics, rag, qdrant, mattermost, warmup
 
 logger = logging.getLogger(__name__)
 router = APIRouter(prefix="/api/v1")
 
-_background_tasks: set[asyncio.Task] = set()
-
-
-def _track_task(coro) -> None:
-    """バックグラウンドタスクを作成し、参照を保持する。"""
-    task = asyncio.create_task(coro)
-    _background_tasks.add(task)
-    task.add_done_callback(_background_tasks.discard)
-
 
 @router.post("/webhook/mattermost")
 async def mattermost_webhook(request: Request):
@@ -30,6 +23,14 @@ async def mattermost_webhook(request: Request):
         logger.warning("Invalid webhook token received")
         raise HTTPException(status_code=403, detail="Invalid token")
 
+    # 以降の処理 (バックグラウンドのジョブを含む) のログ・トレースにMattermostの投稿IDを付ける
+    metrics.new_request_id(body.get("post_id") or None)
+    with metrics.span("webhook.mattermost"):
+        return await _dispatch(body)
+
+
+async def _dispatch(body: dict) -> dict:
+    """メッセージの内容に応じてジョブを投入し、即時返信の内容を返す。"""
     text = body.get("text", "")
     channel_id = body.get("channel_id", "")
     file_ids = body.get("file_ids") or []
@@ -41,21 +42,42 @@ async def mattermost_webhook(request: Request):
 
     # コマンド判定
     if "インポート" in query and file_ids:
-        _track_task(_handle_import(channel_id, file_ids))
-        return {"text": "📥 取り込み中..."}
+        status = await _import_jobs.submit(
+            {"channel_id": channel_id, "file_ids": file_ids},
+            dedup_key=f"{channel_id}\0{','.join(file_ids)}",
+        )
+        return _job_reply(status, "📥 取り込み中...")
 
     if "件数" in query:
         total = await qdrant.count()
         return {"text": f"📊 現在の登録データ件数: {total:,}件"}
 
     # RAG検索
-    _track_task(_handle_search(channel_id, query))
-    return {"text": "🔍 検索中..."}
+    status = await _search_jobs.submit(
+        {"channel_id": channel_id, "query": query},
+        dedup_key=f"{channel_id}\0{answer_cache.normalize_query(query)}",
+    )
+    return _job_reply(status, "🔍 検索中...")
+
+
+def _job_reply(status: str, accepted: str) -> dict:
+    """ジョブ投入結果に応じたWebhookの即時返信。"""
+    if status == jobs.BUSY:
+        return {"text": "⏳ 混雑中です。しばらくしてから再度お試しください。"}
+    if status == jobs.DUPLICATE:
+        return {"text": "🔁 同じ内容を処理中です。結果が投稿されるまでお待ちください。"}
+    return {"text": accepted}
 
 
 async def _handle_search(channel_id: str, query: str) -> None:
     """RAG検索を実行し、結果をMattermostに投稿する。"""
+    if config.MATTERMOST_STREAMING:
+        await _handle_search_streaming(channel_id, query)
+        return
+
     try:
+        # 起動直後に受け付けた問い合わせは、コレクションの準備ができてから処理する
+        await warmup.wait_ready()
         logger.info("Search request: %s", query)
         result = await rag.search(query)
         answer = _format_search_response(query, result)
@@ -66,29 +88,89 @@ async def _handle_search(channel_id: str, query: str) -> None:
     await mattermost.post_message(channel_id, answer)
 
 
+async def _handle_search_streaming(channel_id: str, query: str) -> None:
+    """類似案件の一覧を検索直後に投稿し、LLM回答は生成に合わせて同じ投稿を書き換えていく。"""
+    editor: mattermost.PostEditor | None = None
+    results: list[dict] = []
+    stats: dict | None = None
+    answer = ""
+    try:
+        await warmup.wait_ready()
+        logger.info("Search request (streaming): %s", query)
+        retrieval = await rag.retrieve(query)
+        results, stats = retrieval.results, retrieval.price_stats
+        if not results:
+            await mattermost.post_message(
+                channel_id,
+                _format_search_response(query, {"results": [], "answer": rag.NO_RESULTS_MESSAGE}),
+            )
+            return
+
+        post_id = await mattermost.create_post(
+            channel_id, _format_search_response(query, {"results": results, "price_stats": stats, "answer": "⏳ 回答を生成中..."})
+        )
+        editor = mattermost.PostEditor(post_id, config.MATTERMOST_STREAM_EDIT_INTERVAL)
+        async for answer in rag.stream_answer(retrieval):
+            editor.update(_format_search_response(query, {"results": results, "price_stats": stats, "answer": answer + " ▌"}))
+        await editor.close(_format_search_response(query, {"results": results, "price_stats": stats, "answer": answer}))
+        logger.info(
+            "Search completed: %d results, %d edits, timings (ms): %s",
+            len(results), editor.edits, retrieval.timings,
+        )
+    except Exception as e:
+        logger.exception("Search failed for query: %s", query)
+        error = f"⚠️ 検索中にエラーが発生しました: {e}"
+        if editor is None:
+            await mattermost.post_message(channel_id, error)
+        else:
+            # 途中まで生成できた回答は残し、その後ろにエラーを追記する
+            partial = f"{answer}\n\n{error}" if answer else error
+            await editor.close(_format_search_response(query, {"results": results, "price_stats": stats, "answer": partial}))
+
+
 async def _handle_import(channel_id: str, file_ids: list[str]) -> None:
     """CSVインポートを実行し、結果をMattermostに投稿する。"""
     all_new = 0
     all_updated = 0
+    all_unchanged = 0
     all_errors: list[str] = []
 
     try:
-        for file_id in file_ids:
-            logger.info("Importing file: %s", file_id)
-            content, filename = await mattermost.download_file(file_id)
-            records, parse_errors = parser.parse_file(content, filename)
-            all_errors.extend(parse_errors)
-
-            if records:
-                logger.info("Parsed %d records from %s", len(records), filename)
-                result = await rag.import_records(records)
+        await warmup.wait_ready()
+    except RuntimeError as e:
+        # 設定を直して再起動すれば取り込めるため、永続化されたジョブは残して再起動後に再実行する
+        logger.error("Import deferred: %s", e)
+        retry = "再起動後に再実行します。" if config.JOB_STORE_PATH else "再起動後にもう一度送信してください。"
+        await mattermost.post_message(channel_id, f"⚠️ 起動時の準備に失敗したため取り込めませんでした ({e})。{retry}")
+        raise jobs.Deferred(str(e)) from e
+
+    try:
+        # pandasを読み込むため取り込み時まで遅らせる。読み込み中もイベントループを止めないようスレッドで行う
+        parser = await asyncio.to_thread(importlib.import_module, "services.parser")
+        downloads = await _download_files(file_ids)
+        try:
+            for file, filename in downloads:
+                logger.info("Importing file: %s", filename)
+                chunks = parser.iter_file_chunks(file, filename, config.IMPORT_CHUNK_SIZE)
+                result = await rag.import_stream(chunks)
+                logger.info(
+                    "Imported %s: new=%d, updated=%d, unchanged=%d",
+                    filename, result.new_count, result.updated_count, result.unchanged_count,
+                )
                 all_new += result.new_count
                 all_updated += result.updated_count
+                all_unchanged += result.unchanged_count
                 all_errors.extend(result.errors)
+        finally:
+            for file, _ in downloads:
+                file.close()
 
         total = await qdrant.count()
-        logger.info("Import complete: new=%d, updated=%d, errors=%d", all_new, all_updated, len(all_errors))
-        answer = _format_import_response(all_new, all_updated, all_errors, total)
+        logger.info(
+            "Import complete: new=%d, updated=%d, unchanged=%d, errors=%d",
+            all_new, all_updated, all_unchanged, len(all_errors),
+        )
+        answer = _format_import_response(all_new, all_updated, all_unchanged, all_errors, total)
     except Exception as e:
         logger.exception("Import failed")
         answer = f"⚠️ 取り込み中にエラーが発生しました: {e}"
@@ -96,6 +178,34 @@ async def _handle_import(channel_id: str, file_ids: list[str]) -> None:
     await mattermost.post_message(channel_id, answer)
 
 
+async def _download_files(file_ids: list[str]) -> list[tuple[BinaryIO, str]]:
+    """添付ファイルを並行してダウンロードする。1つでも失敗した場合は取得済みのファイルも閉じる。"""
+    downloads = await asyncio.gather(
+        *(mattermost.download_file(file_id) for file_id in file_ids), return_exceptions=True
+    )
+    failures = [d for d in downloads if isinstance(d, BaseException)]
+    if failures:
+        for d in downloads:
+            if not isinstance(d, BaseException):
+                d[0].close()
+        raise failures[0]
+    return downloads
+
+
+# 検索はユーザーが待っているため、取り込みより優先する
+_search_jobs = jobs.JobQueue(
+    "search", _handle_search, config.SEARCH_WORKERS, config.SEARCH_QUEUE_SIZE
+)
+_import_jobs = jobs.JobQueue(
+    "import",
+    _handle_import,
+    config.IMPORT_WORKERS,
+    config.IMPORT_QUEUE_SIZE,
+    persistent=True,
+    yield_to=_search_jobs,
+)
+
+
 def _format_search_response(query: str, result: dict) -> str:
     """検索結果をMattermost向けメッセージにフォーマットする。"""
     lines = [f"📋 **見積検索結果**\n"]
@@ -115,7 +225,24 @@ def _format_search_response(query: str, result: dict) -> str:
             app = r.get("application", "")
 
             price_str = f"単価 {unit_price:,}円 ({qty}個)" if unit_price and qty else f"{price:,}円"
-            lines.append(f"{i}. {name} {material} Φ{d}×{l}mm | {price_str} | {app}")
+            mark = " _(条件外)_" if r.get("filter_matched") is False else ""
+            lines.append(f"{i}. {name} {material} Φ{d}×{l}mm | {price_str} | {app}{mark}")
+        if any(r.get("filter_matched") is False for r in results):
+            lines.append("_(条件外) は材質・寸法の条件に一致するデータが少ないため参考に表示しています_")
+        lines.append("")
+
+    stats = result.get("price_stats")
+    if stats:
+        lines.append(f"**■ 価格の目安** (類似{stats['count']}件から算出)")
+        line = (
+            f"単価 中央値 {stats['unit_price_median']:,}円"
+            f" (中央50%: {stats['unit_price_q1']:,}〜{stats['unit_price_q3']:,}円)"
+        )
+        if "price_per_kg_median" in stats:
+            line += f" | kg単価 {stats['price_per_kg_median']:,}円/kg"
+        if "estimated_unit_price" in stats:
+            line += f" | 指定寸法での推定 {stats['estimated_unit_price']:,}円"
+        lines.append(line)
         lines.append("")
 
     answer = result.get("answer", "")
@@ -127,12 +254,13 @@ def _format_search_response(query: str, result: dict) -> str:
 
 
 def _format_import_response(
-    new: int, updated: int, errors: list[str], total: int
+    new: int, updated: int, unchanged: int, errors: list[str], total: int
 ) -> str:
     """インポート結果をMattermost向けメッセージにフォーマットする。"""
     lines = ["📥 **データ取り込み完了**\n"]
     lines.append(f"新規登録: {new}件")
     lines.append(f"更新: {updated}件")
+    lines.append(f"変更なし: {unchanged}件")
 
     if errors:
         lines.append(f"エラー: {len(errors)}件")
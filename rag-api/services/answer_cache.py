@@ -0,0 +1,195 @@
+import hashlib
+import json
+import time
+import unicodedata
+from collections import OrderedDict
+from dataclasses import dataclass
+
+import numpy as np
+from qdrant_client.models import Filter
+
+import config
+
+
+@dataclass
+class _Entry:
+    answer: str
+    vector: np.ndarray
+    expires_at: float
+    # 回答と同時に抽出した条件 (LLM_COMBINED_MODE)。ヒット時にも同じ絞り込みを適用する
+    filters: dict | None = None
+
+
+class AnswerCache:
+    """LLM回答のキャッシュ。TTLと件数上限 (LRU) で追い出す。
+
+    キーは「実効フィルタ + 検索結果のID・バージョン」(コンテキストキー) と正規化したクエリ。
+    再取り込みで検索結果の内容が変わるとコンテキストキーが変わるため、古い回答は参照されない。
+    similarity > 0 の場合は、同じコンテキストキーを持つエントリのうちクエリベクトルの
+    コサイン類似度が閾値以上のものも流用する (言い回しが違うだけの質問)。
+    """
+
+    def __init__(self, max_entries: int, ttl: float, similarity: float = 0.0) -> None:
+        self._entries: OrderedDict[tuple[str, str], _Entry] = OrderedDict()
+        self._by_context: dict[str, set[str]] = {}
+        self._max_entries = max_entries
+        self._ttl = ttl
+        self._similarity = similarity
+
+        self.hits = 0
+        self.near_hits = 0
+        self.misses = 0
+        self.expirations = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self._max_entries > 0
+
+    def get(self, query: str, vector: list[float], context_key: str) -> tuple[str, dict | None] | None:
+        """キャッシュ済みの (回答, 回答と同時に抽出した条件) を返す。なければ None。"""
+        now = time.monotonic()
+        key = (context_key, normalize_query(query))
+        entry = self._live_entry(key, now)
+        if entry is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry.answer, entry.filters
+
+        if self._similarity > 0:
+            query_vector = _unit(vector)
+            best: tuple[float, tuple[str, str]] | None = None
+            for other in list(self._by_context.get(context_key, ())):
+                candidate_key = (context_key, other)
+                candidate = self._live_entry(candidate_key, now)
+                if candidate is None:
+                    continue
+                score = float(candidate.vector @ query_vector)
+                if score >= self._similarity and (best is None or score > best[0]):
+                    best = (score, candidate_key)
+            if best is not None:
+                self._entries.move_to_end(best[1])
+                self.near_hits += 1
+                entry = self._entries[best[1]]
+                return entry.answer, entry.filters
+
+        self.misses += 1
+        return None
+
+    def put(
+        self, query: str, vector: list[float], context_key: str, answer: str, filters: dict | None = None
+    ) -> None:
+        """回答をキャッシュに格納する。"""
+        key = (context_key, normalize_query(query))
+        self._entries[key] = _Entry(answer, _unit(vector), time.monotonic() + self._ttl, filters)
+        self._entries.move_to_end(key)
+        self._by_context.setdefault(context_key, set()).add(key[1])
+        while len(self._entries) > self._max_entries:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        """ヒット率・追い出し件数などを返す。"""
+        lookups = self.hits + self.near_hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self._max_entries,
+            "ttl_seconds": self._ttl,
+            "similarity_threshold": self._similarity or None,
+            "hits": self.hits,
+            "near_hits": self.near_hits,
+            "misses": self.misses,
+            "hit_ratio": round((self.hits + self.near_hits) / lookups, 3) if lookups else None,
+            "expirations": self.expirations,
+            "evictions": self.evictions,
+        }
+
+    def _live_entry(self, key: tuple[str, str], now: float) -> _Entry | None:
+        entry = self._entries.get(key)
+        if entry is not None and entry.expires_at <= now:
+            self._remove(key)
+            self.expirations += 1
+            return None
+        return entry
+
+    def _remove(self, key: tuple[str, str]) -> None:
+        del self._entries[key]
+        queries = self._by_context.get(key[0])
+        if queries is not None:
+            queries.discard(key[1])
+            if not queries:
+                del self._by_context[key[0]]
+
+
+_cache = AnswerCache(
+    config.ANSWER_CACHE_SIZE, config.ANSWER_CACHE_TTL, config.ANSWER_CACHE_SIMILARITY
+)
+
+
+def lookup(
+    query: str,
+    vector: list[float],
+    query_filter: Filter | None,
+    results: list[dict],
+    price_stats: dict | None = None,
+) -> tuple[str, dict | None] | None:
+    """同じ条件・同じ検索結果に対する (回答, 回答と同時に抽出した条件) がキャッシュにあれば返す。"""
+    if not _cache.enabled:
+        return None
+    return _cache.get(query, vector, context_key(query_filter, results, price_stats))
+
+
+def store(
+    query: str,
+    vector: list[float],
+    query_filter: Filter | None,
+    results: list[dict],
+    answer: str,
+    price_stats: dict | None = None,
+    filters: dict | None = None,
+) -> None:
+    """生成した回答と、回答と同時に抽出した条件 (あれば) をキャッシュする。"""
+    if _cache.enabled:
+        _cache.put(query, vector, context_key(query_filter, results, price_stats), answer, filters)
+
+
+def cache_stats() -> dict:
+    """回答キャッシュの統計を返す。"""
+    return _cache.stats()
+
+
+def normalize_query(query: str) -> str:
+    """表記揺れ (全角/半角・大文字小文字・空白) を吸収したクエリ文字列。"""
+    return " ".join(unicodedata.normalize("NFKC", query).lower().split())
+
+
+def context_key(
+    query_filter: Filter | None, results: list[dict], price_stats: dict | None = None
+) -> str:
+    """回答の前提となる検索条件・検索結果 (ID・内容のバージョン)・価格統計のキー。"""
+    versions = []
+    for r in results:
+        if r.get("text_hash") and r.get("payload_hash"):
+            version = f"{r['text_hash']}:{r['payload_hash']}"
+        else:
+            # フィンガープリント導入前のポイントはpayloadそのものから作る
+            payload = {k: v for k, v in r.items() if k not in ("score", "rerank_score")}
+            version = hashlib.sha256(
+                json.dumps(payload, sort_keys=True, ensure_ascii=False, default=str).encode("utf-8")
+            ).hexdigest()[:32]
+        versions.append([r["id"], version])
+    source = {
+        "model": config.LLM_MODEL,
+        "filter": query_filter.model_dump(mode="json", exclude_none=True) if query_filter else None,
+        "results": versions,
+        "price_stats": price_stats,
+    }
+    return hashlib.sha256(
+        json.dumps(source, sort_keys=True, ensure_ascii=False).encode("utf-8")
+    ).hexdigest()
+
+
+def _unit(vector: list[float]) -> np.ndarray:
+    array = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(array)
+    return array / norm if norm else array
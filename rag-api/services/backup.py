@@ -0,0 +1,199 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import re
+import time
+from datetime import datetime, timezone
+from typing import BinaryIO, TextIO
+
+import numpy as np
+
+import config
+from services import embedding, qdrant
+from services.filter import refresh_materials
+
+logger = logging.getLogger(__name__)
+
+FORMAT_VERSION = 1
+_MANIFEST = "manifest.json"
+_VECTORS = "vectors.npy"
+_POINTS = "points.jsonl"
+
+_SCROLL_BATCH_SIZE = 1000
+_LOAD_BATCH_SIZE = 5000
+# 書き出し後に件数を書き込むため、.npyのヘッダーは固定長 (64の倍数) にする
+_NPY_HEADER_SIZE = 128
+_NAME = re.compile(r"[A-Za-z0-9_.\-]+")
+# 読み込み時に付け直すpayloadのフィールド
+_DERIVED_FIELDS = ("vector_schema",)
+
+
+async def export_collection(name: str | None = None) -> dict:
+    """コレクションの全ポイントを EXPORT_DIR/<name>/ に書き出し、マニフェストを返す。
+
+    ベクトルはfloat32の vectors.npy、payloadは同じ順序で1行1ポイントの points.jsonl に、
+    scrollのページ単位で追記する (メモリ使用量は件数に依存しない)。
+    manifest.json は最後に書くため、これがあるエクスポートは完全に書き出されている。
+    """
+    name = name or datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+    directory = _export_path(name)
+    os.makedirs(directory)
+    dimension = embedding.dimension()
+    start = time.perf_counter()
+    count = 0
+
+    with (
+        open(os.path.join(directory, _VECTORS), "wb") as vectors_file,
+        open(os.path.join(directory, _POINTS), "w", encoding="utf-8") as points_file,
+    ):
+        _write_npy_header(vectors_file, 0, dimension)
+        async for batch in qdrant.scroll_points(_SCROLL_BATCH_SIZE):
+            await asyncio.to_thread(_write_batch, vectors_file, points_file, batch, dimension)
+            count += len(batch)
+        vectors_file.seek(0)
+        _write_npy_header(vectors_file, count, dimension)
+
+    manifest = {
+        "format": FORMAT_VERSION,
+        "name": name,
+        "collection": config.QDRANT_COLLECTION,
+        "count": count,
+        "dimension": dimension,
+        "embedding_model": embedding.model_name(),
+        "exported_at": datetime.now(timezone.utc).isoformat(),
+    }
+    with open(os.path.join(directory, _MANIFEST), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    logger.info("Exported %d points to %s in %.1fs", count, directory, time.perf_counter() - start)
+    return manifest
+
+
+async def load_export(name: str, concurrency: int = config.EXPORT_UPSERT_CONCURRENCY) -> dict:
+    """エクスポートをコレクションに読み込む。ベクトルはそのまま使うためEmbeddingは呼ばない。
+
+    エクスポート時と現在のEmbeddingモデル・次元数が異なる場合は ValueError。
+    """
+    directory = _export_path(name)
+    manifest = list_exports(name)[0]
+    if manifest["dimension"] != embedding.dimension() or manifest["embedding_model"] != embedding.model_name():
+        raise ValueError(
+            f"Export '{name}' was made with {manifest['embedding_model']} ({manifest['dimension']} dims), "
+            f"but the current embedding model is {embedding.model_name()} ({embedding.dimension()} dims)"
+        )
+
+    vectors = np.load(os.path.join(directory, _VECTORS), mmap_mode="r")
+    if vectors.shape != (manifest["count"], manifest["dimension"]):
+        raise ValueError(f"Export '{name}' is incomplete: vectors.npy has shape {vectors.shape}")
+
+    start = time.perf_counter()
+    loaded = 0
+    with open(os.path.join(directory, _POINTS), encoding="utf-8") as points_file:
+        while records := await asyncio.to_thread(_read_records, points_file, _LOAD_BATCH_SIZE):
+            await qdrant.upsert_points(
+                [r["id"] for r in records],
+                vectors[loaded : loaded + len(records)].tolist(),
+                [r["payload"] for r in records],
+                concurrency=concurrency,
+            )
+            loaded += len(records)
+    if loaded != manifest["count"]:
+        logger.warning("Export '%s' lists %d points but %d were loaded", name, manifest["count"], loaded)
+
+    elapsed = time.perf_counter() - start
+    logger.info("Loaded %d points from %s in %.1fs (%.0f points/s)", loaded, directory, elapsed, loaded / elapsed if elapsed else 0)
+    await refresh_materials()
+    return {"name": name, "loaded": loaded, "seconds": round(elapsed, 1), "total_count": await qdrant.count()}
+
+
+def list_exports(name: str | None = None) -> list[dict]:
+    """完了したエクスポートのマニフェストを新しい順に返す。nameを指定するとその1件 (なければ FileNotFoundError)。"""
+    if name is not None:
+        with open(os.path.join(_export_path(name), _MANIFEST), encoding="utf-8") as f:
+            return [json.load(f)]
+    if not os.path.isdir(config.EXPORT_DIR):
+        return []
+    manifests = []
+    for entry in sorted(os.listdir(config.EXPORT_DIR), reverse=True):
+        path = os.path.join(config.EXPORT_DIR, entry, _MANIFEST)
+        if os.path.isfile(path):
+            with open(path, encoding="utf-8") as f:
+                manifests.append(json.load(f))
+    return manifests
+
+
+def _export_path(name: str) -> str:
+    if not _NAME.fullmatch(name) or name in (".", ".."):
+        raise ValueError(f"Invalid export name: {name!r}")
+    return os.path.join(config.EXPORT_DIR, name)
+
+
+def _write_npy_header(f: BinaryIO, rows: int, dimension: int) -> None:
+    header = f"{{'descr': '<f4', 'fortran_order': False, 'shape': ({rows}, {dimension}), }}"
+    # マジック(6) + バージョン(2) + ヘッダー長(2) + ヘッダー (空白で埋めて改行で終える)
+    header = header.ljust(_NPY_HEADER_SIZE - 10 - 1) + "\n"
+    f.write(b"\x93NUMPY\x01\x00" + len(header).to_bytes(2, "little") + header.encode("latin1"))
+
+
+def _write_batch(
+    vectors_file: BinaryIO, points_file: TextIO, batch: list[tuple[int, list[float], dict]], dimension: int
+) -> None:
+    vectors = np.asarray([vector for _, vector, _ in batch], dtype="<f4")
+    if vectors.shape[1] != dimension:
+        raise RuntimeError(f"Point vectors have {vectors.shape[1]} dims, expected {dimension}")
+    vectors_file.write(vectors.tobytes())
+    for id_, _, payload in batch:
+        payload = {k: v for k, v in payload.items() if k not in _DERIVED_FIELDS}
+        points_file.write(json.dumps({"id": id_, "payload": payload}, ensure_ascii=False) + "\n")
+
+
+def _read_records(f: TextIO, size: int) -> list[dict]:
+    records = []
+    for line in f:
+        records.append(json.loads(line))
+        if len(records) >= size:
+            break
+    return records
+
+
+def main() -> None:
+    """コマンドラインからのエクスポート・読み込み・スナップショット操作。rag-api ディレクトリで実行する:
+
+        python -m services.backup export [name]
+        python -m services.backup load <name>
+        python -m services.backup list
+        python -m services.backup snapshot
+        python -m services.backup snapshots
+        python -m services.backup recover <location>
+    """
+    ap = argparse.ArgumentParser(prog="python -m services.backup")
+    ap.add_argument("command", choices=["export", "load", "list", "snapshot", "snapshots", "recover"])
+    ap.add_argument("target", nargs="?", help="エクスポート名、またはrecoverのスナップショットの場所")
+    args = ap.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    async def run():
+        if args.command == "list":
+            return list_exports()
+        if args.command == "recover":
+            if not args.target:
+                ap.error("recover requires a snapshot location")
+            await qdrant.recover_snapshot(args.target)
+            return {"recovered": args.target, "total_count": await qdrant.count()}
+        await qdrant.ensure_collection()
+        if args.command == "export":
+            return await export_collection(args.target)
+        if args.command == "load":
+            if not args.target:
+                ap.error("load requires an export name")
+            return await load_export(args.target)
+        if args.command == "snapshot":
+            return (await qdrant.create_snapshot()).model_dump(mode="json")
+        return [s.model_dump(mode="json") for s in await qdrant.list_snapshots()]
+
+    print(json.dumps(asyncio.run(run()), ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
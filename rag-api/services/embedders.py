@@ -0,0 +1,177 @@
+import asyncio
+import logging
+import unicodedata
+import zlib
+from abc import ABC, abstractmethod
+
+import numpy as np
+
+import config
+from services import metrics, ratelimit
+
+logger = logging.getLogger(__name__)
+
+
+class Embedder(ABC):
+    """Embeddingバックエンドの共通インターフェース。"""
+
+    #: モデルの識別子。キャッシュキーに含め、バックエンド間でベクトルが混ざらないようにする
+    name: str
+    #: 出力ベクトルの次元数。Qdrantコレクションの次元数はこれに従う
+    dimension: int
+    #: Embeddingキャッシュを使うか。キャッシュ参照より計算が速いバックエンドはFalse
+    cacheable: bool = True
+
+    @abstractmethod
+    async def embed(self, texts: list[str]) -> list[list[float]]:
+        """テキストのリストを入力順のベクトルのリストに変換する。"""
+
+    def stats(self) -> dict:
+        """バックエンド固有の統計を返す。"""
+        return {}
+
+
+class GeminiEmbedder(Embedder):
+    """Gemini Embedding API。RPM/TPMのトークンバケットと適応的な同時実行数制御の下でバッチを並行送信する。"""
+
+    def __init__(self) -> None:
+        from services.gemini_client import get_client
+
+        self._client = get_client()
+        self.name = config.EMBEDDING_MODEL
+        self.dimension = config.EMBEDDING_DIMENSION
+        self._embed_config = None
+        if config.EMBEDDING_OUTPUT_DIMENSION:
+            # Matryoshka表現の先頭次元だけをAPI側で切り出す
+            from google.genai.types import EmbedContentConfig
+
+            self.dimension = config.EMBEDDING_OUTPUT_DIMENSION
+            self.name = f"{config.EMBEDDING_MODEL}@{self.dimension}"
+            self._embed_config = EmbedContentConfig(output_dimensionality=self.dimension)
+        self._request_bucket = ratelimit.TokenBucket(config.EMBEDDING_REQUESTS_PER_MINUTE)
+        self._token_bucket = ratelimit.TokenBucket(config.EMBEDDING_TOKENS_PER_MINUTE)
+        self._concurrency = ratelimit.AdaptiveLimiter(config.EMBEDDING_MAX_CONCURRENCY)
+        self._stats = {"rate_limited": 0, "retries": 0}
+
+    async def embed(self, texts: list[str]) -> list[list[float]]:
+        batches = [
+            texts[i : i + config.EMBEDDING_BATCH_SIZE]
+            for i in range(0, len(texts), config.EMBEDDING_BATCH_SIZE)
+        ]
+        async with asyncio.TaskGroup() as tg:
+            tasks = [tg.create_task(self._embed_batch_with_retry(batch)) for batch in batches]
+        return [vector for task in tasks for vector in task.result()]
+
+    def stats(self) -> dict:
+        return {
+            "concurrency_limit": self._concurrency.limit,
+            "in_flight": self._concurrency.in_flight,
+            **self._stats,
+        }
+
+    async def _embed_batch_with_retry(self, texts: list[str]) -> list[list[float]]:
+        """バッチEmbedding。429・5xx・通信エラーはジッタ付きバックオフでリトライし、429では同時実行数を下げる。"""
+        attempt = 0
+        while True:
+            await self._request_bucket.acquire(1)
+            await self._token_bucket.acquire(_estimate_tokens(texts))
+            async with self._concurrency:
+                try:
+                    response = await asyncio.to_thread(
+                        self._client.models.embed_content,
+                        model=config.EMBEDDING_MODEL,
+                        contents=texts,
+                        config=self._embed_config,
+                    )
+                except Exception as e:
+                    metrics.record_gemini("embed", metrics.gemini_outcome(e))
+                    if not ratelimit.is_retryable(e) or attempt == config.EMBEDDING_MAX_RETRIES:
+                        raise
+                    if ratelimit.is_rate_limited(e):
+                        self._stats["rate_limited"] += 1
+                        self._concurrency.on_rate_limited()
+                    delay = ratelimit.retry_delay(
+                        e, attempt, config.EMBEDDING_RETRY_BASE_DELAY, config.EMBEDDING_RETRY_MAX_DELAY
+                    )
+                else:
+                    self._concurrency.on_success()
+                    metrics.record_gemini("embed", "ok", input_tokens=_estimate_tokens(texts))
+                    return [e.values for e in response.embeddings]
+
+            attempt += 1
+            self._stats["retries"] += 1
+            logger.warning("Embedding batch failed, retrying in %.1fs (attempt %d)", delay, attempt)
+            await asyncio.sleep(delay)
+
+
+class HashingEmbedder(Embedder):
+    """文字n-gramの特徴ハッシングによる決定的なベクトル化。ネットワーク不要でオフライン・テスト用途向け。"""
+
+    cacheable = False
+
+    def __init__(self, dimension: int, ngram_range: tuple[int, int] = (1, 3)) -> None:
+        self.name = f"hashing-char{ngram_range[0]}{ngram_range[1]}-{dimension}"
+        self.dimension = dimension
+        self._ngram_range = ngram_range
+
+    async def embed(self, texts: list[str]) -> list[list[float]]:
+        return (await asyncio.to_thread(self.embed_array, texts)).tolist()
+
+    def embed_array(self, texts: list[str]) -> np.ndarray:
+        """(len(texts), dimension) のL2正規化済みfloat32配列を返す。"""
+        rows: list[int] = []
+        cols: list[int] = []
+        signs: list[float] = []
+        lo, hi = self._ngram_range
+        for row, text in enumerate(texts):
+            normalized = " ".join(unicodedata.normalize("NFKC", text).lower().split())
+            for n in range(lo, hi + 1):
+                for i in range(len(normalized) - n + 1):
+                    h = zlib.crc32(normalized[i : i + n].encode("utf-8"))
+                    rows.append(row)
+                    cols.append(h % self.dimension)
+                    signs.append(1.0 if h & 0x80000000 else -1.0)
+
+        matrix = np.zeros((len(texts), self.dimension), dtype=np.float32)
+        np.add.at(matrix, (np.asarray(rows, dtype=np.int64), np.asarray(cols, dtype=np.int64)), signs)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        return matrix / np.where(norms == 0, 1.0, norms)
+
+
+class SentenceTransformerEmbedder(Embedder):
+    """sentence-transformersのモデルをCPUで実行するローカルバックエンド (要 `pip install sentence-transformers`)。"""
+
+    def __init__(self, model_name: str, truncate_dim: int | None = None) -> None:
+        from sentence_transformers import SentenceTransformer
+
+        self._model = SentenceTransformer(model_name, device="cpu", truncate_dim=truncate_dim)
+        self.name = f"st-{model_name}" + (f"@{truncate_dim}" if truncate_dim else "")
+        self.dimension = self._model.get_sentence_embedding_dimension()
+
+    async def embed(self, texts: list[str]) -> list[list[float]]:
+        vectors = await asyncio.to_thread(
+            self._model.encode,
+            texts,
+            batch_size=config.EMBEDDING_BATCH_SIZE,
+            normalize_embeddings=True,
+            convert_to_numpy=True,
+        )
+        return vectors.astype(np.float32).tolist()
+
+
+def create_embedder(backend: str) -> Embedder:
+    """設定名からEmbeddingバックエンドを生成する。"""
+    if backend == "gemini":
+        return GeminiEmbedder()
+    if backend == "hashing":
+        return HashingEmbedder(config.LOCAL_EMBEDDING_DIMENSION)
+    if backend == "sentence-transformers":
+        return SentenceTransformerEmbedder(
+            config.LOCAL_EMBEDDING_MODEL, config.EMBEDDING_OUTPUT_DIMENSION or None
+        )
+    raise ValueError(f"Unknown EMBEDDING_BACKEND: {backend}")
+
+
+def _estimate_tokens(texts: list[str]) -> int:
+    # 日本語は概ね1文字1トークン以下のため、文字数を上限の目安とする
+    return sum(len(t) for t in texts)
@@ -1,42 +1,227 @@
 import asyncio
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from array import array
+from collections import OrderedDict
 
 import config
-from services.gemini_client import client as _client
+from services.embedders import Embedder, create_embedder
+
+
+class EmbeddingCache:
+    """Embeddingベクトルのキャッシュ。メモリ上のLRU層と、任意のSQLite永続層を持つ。
+
+    ベクトルはfloat32で保持する（APIの返す精度と同等で、メモリ使用量はlist[float]の約1/8）。
+    SQLite層は最大 max_disk_entries 件で、超えたら最後に使った時刻の古いものから削除する。
+    現在のモデル以外で作られたベクトルは、そのモデルで最初に書き込むときに削除する。
+    """
+
+    def __init__(self, max_entries: int, path: str = "", max_disk_entries: int = 0) -> None:
+        self._memory: OrderedDict[str, array] = OrderedDict()
+        self._max_entries = max_entries
+        self._max_disk_entries = max_disk_entries
+        self._lock = threading.Lock()
+        self._db: sqlite3.Connection | None = None
+        self._disk_entries = 0
+        self._pruned_model: str | None = None
+        if path:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            columns = [row[1] for row in self._db.execute("PRAGMA table_info(embeddings)")]
+            if columns and "last_used" not in columns:
+                # モデル名・最終使用時刻のない古い形式のキャッシュは作り直す
+                self._db.execute("DROP TABLE embeddings")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                "key TEXT PRIMARY KEY, model TEXT NOT NULL, vector BLOB NOT NULL, last_used REAL NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+            self._db.commit()
+            self._disk_entries = self._db.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.disk_evictions = 0
+
+    def get_many(self, keys: list[str]) -> dict[str, list[float]]:
+        """キーに対応するベクトルを返す。メモリ→ディスクの順に探す。"""
+        found: dict[str, list[float]] = {}
+        with self._lock:
+            pending = []
+            for key in dict.fromkeys(keys):
+                vector = self._memory.get(key)
+                if vector is not None:
+                    self._memory.move_to_end(key)
+                    found[key] = vector.tolist()
+                    self.hits += 1
+                else:
+                    pending.append(key)
+
+            if pending and self._db is not None:
+                for i in range(0, len(pending), 500):
+                    chunk = pending[i : i + 500]
+                    rows = self._db.execute(
+                        f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(chunk))})",
+                        chunk,
+                    ).fetchall()
+                    for key, blob in rows:
+                        vector = array("f")
+                        vector.frombytes(blob)
+                        self._remember(key, vector)
+                        found[key] = vector.tolist()
+                        self.disk_hits += 1
+                    if rows:
+                        self._db.execute(
+                            f"UPDATE embeddings SET last_used = ? WHERE key IN ({','.join('?' * len(rows))})",
+                            [time.time(), *(key for key, _ in rows)],
+                        )
+                self._db.commit()
+
+            self.misses += sum(1 for key in pending if key not in found)
+        return found
+
+    def put_many(self, items: dict[str, list[float]], model: str) -> None:
+        """modelで作ったベクトルをキャッシュに格納する。"""
+        with self._lock:
+            now = time.time()
+            rows = []
+            for key, values in items.items():
+                vector = array("f", values)
+                self._remember(key, vector)
+                rows.append((key, model, vector.tobytes(), now))
+            if self._db is not None and rows:
+                if model != self._pruned_model:
+                    self._prune_models(model)
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO embeddings (key, model, vector, last_used) VALUES (?, ?, ?, ?)", rows
+                )
+                self._disk_entries += len(rows)
+                if self._max_disk_entries and self._disk_entries > self._max_disk_entries:
+                    self._evict_disk()
+                self._db.commit()
+
+    def stats(self) -> dict:
+        """ヒット/ミス/追い出しの件数を返す。"""
+        with self._lock:
+            return {
+                "entries": len(self._memory),
+                "max_entries": self._max_entries,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "persistent": self._db is not None,
+                "disk_entries": self._disk_entries,
+                "max_disk_entries": self._max_disk_entries,
+                "disk_evictions": self.disk_evictions,
+            }
+
+    def _remember(self, key: str, vector: array) -> None:
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self._max_entries:
+            self._memory.popitem(last=False)
+            self.evictions += 1
+
+    def _prune_models(self, model: str) -> None:
+        # モデルを変えた後 (再インデックス後など) は古いモデルのベクトルが使われることはないため削除する
+        removed = self._db.execute("DELETE FROM embeddings WHERE model != ?", (model,)).rowcount
+        self._disk_entries -= removed
+        self._pruned_model = model
+
+    def _evict_disk(self) -> None:
+        # INSERT OR REPLACE の置き換え分は件数に含めていないため、数え直してから削除する。
+        # 書き込みのたびに削除しないよう、上限の9割まで減らす
+        self._disk_entries = self._db.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        if self._disk_entries <= self._max_disk_entries:
+            return
+        excess = self._disk_entries - self._max_disk_entries * 9 // 10
+        self._db.execute(
+            "DELETE FROM embeddings WHERE key IN (SELECT key FROM embeddings ORDER BY last_used LIMIT ?)",
+            (excess,),
+        )
+        self._disk_entries -= excess
+        self.disk_evictions += excess
+
+
+_cache = EmbeddingCache(
+    config.EMBEDDING_CACHE_SIZE, config.EMBEDDING_CACHE_PATH, config.EMBEDDING_CACHE_MAX_DISK_ENTRIES
+)
+
+# バックエンドは初回使用時に生成する (sentence-transformersのモデル読み込みなどを起動時に行わない)
+_embedder: Embedder | None = None
+_embedder_lock = threading.Lock()
+
+
+def backend() -> Embedder:
+    """使用中のEmbeddingバックエンド。未生成なら生成する。"""
+    global _embedder
+    if _embedder is None:
+        with _embedder_lock:
+            if _embedder is None:
+                _embedder = create_embedder(config.EMBEDDING_BACKEND)
+    return _embedder
+
+
+def dimension() -> int:
+    """使用中のEmbeddingバックエンドの出力次元数。"""
+    return backend().dimension
+
+
+def model_name() -> str:
+    """使用中のEmbeddingモデル名 (バックエンド・次元数を含む)。"""
+    return backend().name
+
+
+def cache_key(text: str) -> str:
+    """正規化したテキストとEmbeddingモデル名からキャッシュキーを生成する。"""
+    normalized = " ".join(unicodedata.normalize("NFKC", text).split())
+    return hashlib.sha256(f"{backend().name}\0{normalized}".encode("utf-8")).hexdigest()
+
+
+def cache_stats() -> dict:
+    """Embeddingキャッシュの統計を返す。"""
+    return _cache.stats()
+
+
+def backend_stats() -> dict:
+    """Embeddingバックエンドの名前と統計を返す。"""
+    embedder = backend()
+    return {"name": embedder.name, "dimension": embedder.dimension, **embedder.stats()}
 
 
 async def embed_texts(texts: list[str]) -> list[list[float]]:
-    """テキストのリストをEmbeddingベクトルに変換する。バッチ処理+リトライ対応。"""
-    all_vectors: list[list[float]] = []
+    """テキストのリストをEmbeddingベクトルに変換する。キャッシュ+バッチ処理+リトライ対応。"""
+    embedder = backend()
+    if not embedder.cacheable:
+        return await embedder.embed(texts)
+
+    keys = [cache_key(t) for t in texts]
+    vectors_by_key = await asyncio.to_thread(_cache.get_many, keys)
 
-    for i in range(0, len(texts), config.EMBEDDING_BATCH_SIZE):
-        batch = texts[i : i + config.EMBEDDING_BATCH_SIZE]
-        vectors = await _embed_batch_with_retry(batch)
-        all_vectors.extend(vectors)
+    # キャッシュにないテキストだけを（重複を除いて）バックエンドに送る
+    missing: dict[str, str] = {}
+    for key, text in zip(keys, texts):
+        if key not in vectors_by_key and key not in missing:
+            missing[key] = text
 
-    return all_vectors
+    if missing:
+        new_vectors = await embedder.embed(list(missing.values()))
+        computed = dict(zip(missing.keys(), new_vectors))
+        await asyncio.to_thread(_cache.put_many, computed, embedder.name)
+        vectors_by_key.update(computed)
+
+    return [vectors_by_key[key] for key in keys]
 
 
 async def embed_text(text: str) -> list[float]:
     """単一テキストをEmbeddingベクトルに変換する。"""
     result = await embed_texts([text])
     return result[0]
-
-
-async def _embed_batch_with_retry(
-    texts: list[str], max_retries: int = 3
-) -> list[list[float]]:
-    """バッチEmbedding。429エラー時は指数バックオフでリトライ。"""
-    for attempt in range(max_retries):
-        try:
-            response = await asyncio.to_thread(
-                _client.models.embed_content,
-                model=config.EMBEDDING_MODEL,
-                contents=texts,
-            )
-            return [e.values for e in response.embeddings]
-        except Exception as e:
-            if "429" in str(e) and attempt < max_retries - 1:
-                wait = 2 ** (attempt + 1)
-                await asyncio.sleep(wait)
-                continue
-            raise
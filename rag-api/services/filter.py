@@ -1,11 +1,17 @@
 import asyncio
 import json
+import logging
+import re
+import time
+import unicodedata
 
-from google.genai.types import GenerateContentConfig
 from qdrant_client.models import FieldCondition, Filter, MatchValue, Range
 
 import config
-from services.gemini_client import client as _client
+from services import metrics, qdrant
+from services.gemini_client import get_client
+
+logger = logging.getLogger(__name__)
 
 _EXTRACTION_PROMPT = """\
 ユーザーの問い合わせから、以下の検索条件を抽出してJSON形式で返してください。
@@ -26,12 +32,69 @@ JSON以外のテキストは出力しないでください。
 ユーザーの問い合わせ:
 """
 
+# 「くらい」「約」などの曖昧な表現に付ける幅 (LLMプロンプトの ±20% と揃える)
+_APPROX_TOLERANCE = 0.2
+
+_NUMBER = r"\d+(?:\.\d+)?"
+_APPROX_PREFIX = r"約|およそ|だいたい|大体"
+_APPROX_SUFFIX = r"くらい|ぐらい|位|程度|前後|ほど|付近|近辺"
+_BOUND_SUFFIX = r"以上|以下"
+# mm以外の単位 (1m, 30cm) や未対応の比較表現 (未満, 超) が続く数値は規則では解釈しない
+_UNSUPPORTED_TAIL = r"(?![0-9.]|\s*(?:cm|m(?![a-z])|未満|超))"
+
+
+def _value(name: str) -> str:
+    # 「50」「50mm」「30〜40」「30-40mm」
+    return rf"(?P<{name}>{_NUMBER})(?:\s*[~〜\-]\s*(?P<{name}_to>{_NUMBER}))?\s*(?:mm)?"
+
+
+# 「Φ50×200」「φ30くらい」「外径は50mm」「約Φ50x200」
+_DIAMETER = re.compile(
+    rf"(?P<approx>{_APPROX_PREFIX})?\s*(?:[φø⌀]|外径|直径|径)\s*(?:は|が|=|:)?\s*{_value('d')}"
+    rf"(?:\s*[x×*]\s*{_value('l')})?"
+    rf"\s*(?P<suffix>{_APPROX_SUFFIX}|{_BOUND_SUFFIX})?{_UNSUPPORTED_TAIL}"
+)
+# 「L200」「L=200」「長さ200くらい」「全長は300mm以下」
+_LENGTH = re.compile(
+    rf"(?P<approx>{_APPROX_PREFIX})?\s*(?:(?<![a-z0-9])l|全長|長さ)\s*(?:は|が|=|:)?\s*{_value('l')}"
+    rf"\s*(?P<suffix>{_APPROX_SUFFIX}|{_BOUND_SUFFIX})?{_UNSUPPORTED_TAIL}"
+)
+# 材質記号の候補 (SUS304, S45C, A5052-T6 など英字で始まるトークン)
+_CODE_TOKEN = re.compile(r"(?<![a-z0-9])[a-z][a-z0-9\-]*[a-z0-9]|(?<![a-z0-9])[a-z](?![a-z0-9])")
+# 寸法として解釈しない数値 (数量・日付・金額)
+_STRAY_NUMBER = re.compile(
+    rf"{_NUMBER}\s*(?P<unit>個|本|台|枚|点|セット|set|pcs|ヶ|ケ|件|年|月|日|円|万|社|回)?"
+)
+# 規則で解釈しきれずに残っていたらLLMに回す語
+_MATERIAL_HINTS = ("材質", "材料", "ステンレス", "ステン", "sus", "鉄", "鋼", "アルミ", "真鍮", "黄銅", "銅", "樹脂", "チタン")
+_DIMENSION_HINTS = ("φ", "ø", "⌀", "径", "長さ", "全長", "寸法", "サイズ", "×", "mm")
+
+# 材質辞書 {正規化キー: コレクション上の表記}。refresh_materialsで更新する
+_materials: dict[str, str] = {}
+
+_stats = {"rule_hits": 0, "rule_ms": 0.0, "llm_calls": 0, "llm_errors": 0, "llm_ms": 0.0}
+
 
 async def extract_filters(query: str) -> Filter | None:
-    """ユーザーのクエリからQdrantフィルタ条件を抽出する。"""
+    """ユーザーのクエリからQdrantフィルタ条件を抽出する。
+
+    まず規則ベースで抽出し、規則で確定できないクエリだけをLLMに送る。
+    """
+    if config.FILTER_RULES:
+        start = time.perf_counter()
+        raw = extract_by_rules(query)
+        if raw is not None:
+            _stats["rule_hits"] += 1
+            _stats["rule_ms"] += (time.perf_counter() - start) * 1000
+            return build_filter(raw)
+
+    from google.genai.types import GenerateContentConfig
+
+    _stats["llm_calls"] += 1
+    start = time.perf_counter()
     try:
         response = await asyncio.to_thread(
-            _client.models.generate_content,
+            get_client().models.generate_content,
             model=config.LLM_MODEL,
             contents=_EXTRACTION_PROMPT + query,
             config=GenerateContentConfig(
@@ -39,10 +102,166 @@ async def extract_filters(query: str) -> Filter | None:
                 response_mime_type="application/json",
             ),
         )
+    except Exception as e:
+        metrics.record_gemini("extract_filters", metrics.gemini_outcome(e))
+        _stats["llm_errors"] += 1
+        return None
+    finally:
+        _stats["llm_ms"] += (time.perf_counter() - start) * 1000
+    metrics.record_gemini("extract_filters", "ok", response.usage_metadata)
+
+    try:
         raw = json.loads(response.text)
-    except Exception:
+    except (TypeError, ValueError):
+        _stats["llm_errors"] += 1
+        return None
+
+    return build_filter(raw)
+
+
+def extract_by_rules(query: str) -> dict | None:
+    """規則ベースで検索条件を抽出する。
+
+    LLMと同じ形の辞書 (material, diameter_min, ...) を返す。条件がなければ空の辞書。
+    未知の材質記号や解釈できない数値・寸法表現が残った場合は None を返す (LLMに任せる)。
+    """
+    text = " ".join(unicodedata.normalize("NFKC", query).lower().split())
+    raw: dict = {}
+
+    diameters, text = _take(_DIAMETER, text)
+    lengths, text = _take(_LENGTH, text)
+    if len(diameters) > 1 or len(lengths) > 1:
+        return None
+    if diameters:
+        m = diameters[0]
+        raw["diameter_min"], raw["diameter_max"] = _bounds(m, "d")
+        if m.group("l"):
+            if lengths:
+                return None
+            raw["length_min"], raw["length_max"] = _bounds(m, "l")
+    if lengths:
+        raw["length_min"], raw["length_max"] = _bounds(lengths[0], "l")
+
+    materials: set[str] = set()
+    for m in list(_CODE_TOKEN.finditer(text)):
+        canonical = _materials.get(_material_key(m.group()))
+        if canonical is not None:
+            materials.add(canonical)
+            text = _blank(text, m.start(), m.end())
+        elif any(c.isdigit() for c in m.group()):
+            return None
+    for key, canonical in _materials.items():
+        if not key.isascii() and (pos := text.upper().find(key)) >= 0:
+            materials.add(canonical)
+            text = _blank(text, pos, pos + len(key))
+    if len(materials) > 1:
+        return None
+    if materials:
+        raw["material"] = materials.pop()
+    elif any(hint in text for hint in _MATERIAL_HINTS):
         return None
 
+    if any(hint in text for hint in _DIMENSION_HINTS):
+        return None
+    if any(m.group("unit") is None for m in _STRAY_NUMBER.finditer(text)):
+        return None
+    return raw
+
+
+async def refresh_materials() -> None:
+    """コレクションに登録済みの材質から、規則ベース抽出の材質辞書を作り直す。"""
+    try:
+        values = await qdrant.distinct_values("material")
+    except Exception:
+        logger.warning("Failed to load known materials, keeping the current dictionary", exc_info=True)
+        return
+    _set_materials(values)
+    logger.info("Loaded %d known materials for filter extraction", len(_materials))
+
+
+def stats() -> dict:
+    """規則ベース抽出の一致率と、LLM呼び出しを省いたことによる推定短縮時間を返す。"""
+    rule_hits = _stats["rule_hits"]
+    llm_calls = _stats["llm_calls"]
+    total = rule_hits + llm_calls
+    avg_rule_ms = _stats["rule_ms"] / rule_hits if rule_hits else 0.0
+    avg_llm_ms = _stats["llm_ms"] / llm_calls if llm_calls else None
+    return {
+        "rules_enabled": config.FILTER_RULES,
+        "known_materials": len(_materials),
+        "rule_hits": rule_hits,
+        "llm_calls": llm_calls,
+        "llm_errors": _stats["llm_errors"],
+        "rule_match_rate": round(rule_hits / total, 3) if total else None,
+        "avg_rule_ms": round(avg_rule_ms, 3),
+        "avg_llm_ms": round(avg_llm_ms, 1) if avg_llm_ms is not None else None,
+        "estimated_saved_ms": (
+            round(rule_hits * (avg_llm_ms - avg_rule_ms), 1) if avg_llm_ms is not None else None
+        ),
+    }
+
+
+def canonical_material(value: str) -> str:
+    """材質の表記をコレクション上の表記に揃える (未知の材質はそのまま)。"""
+    return _materials.get(_material_key(value), value)
+
+
+def matches(raw: dict, payload: dict) -> bool:
+    """抽出結果 (build_filterに渡す辞書) の条件をpayloadが満たすか。"""
+    if raw.get("material") and payload.get("material") != raw["material"]:
+        return False
+    for name, key in (("diameter", "diameter_mm"), ("length", "length_mm")):
+        lo, hi = raw.get(f"{name}_min"), raw.get(f"{name}_max")
+        if lo is None and hi is None:
+            continue
+        value = payload.get(key)
+        if value is None or (lo is not None and value < lo) or (hi is not None and value > hi):
+            return False
+    return True
+
+
+def _set_materials(values: list[str]) -> None:
+    global _materials
+    materials: dict[str, str] = {}
+    # 表記揺れで同じキーになる場合は件数の多い (facetで先に返る) 表記を採る
+    for value in values:
+        if key := _material_key(value):
+            materials.setdefault(key, value)
+    _materials = materials
+
+
+def _material_key(value: str) -> str:
+    return re.sub(r"[\s\-]", "", unicodedata.normalize("NFKC", value).upper())
+
+
+def _take(pattern: re.Pattern, text: str) -> tuple[list[re.Match], str]:
+    """パターンに一致した箇所を返し、後続の規則が再解釈しないよう空白で塗りつぶす。"""
+    matches = list(pattern.finditer(text))
+    for m in matches:
+        text = _blank(text, m.start(), m.end())
+    return matches, text
+
+
+def _blank(text: str, start: int, end: int) -> str:
+    return text[:start] + " " * (end - start) + text[end:]
+
+
+def _bounds(m: re.Match, name: str) -> tuple[float | None, float | None]:
+    lo = float(m.group(name))
+    hi = float(m.group(f"{name}_to") or lo)
+    lo, hi = min(lo, hi), max(lo, hi)
+    suffix = m.group("suffix")
+    if suffix == "以上":
+        return lo, None
+    if suffix == "以下":
+        return None, hi
+    if m.group("approx") or suffix:
+        return round(lo * (1 - _APPROX_TOLERANCE), 3), round(hi * (1 + _APPROX_TOLERANCE), 3)
+    return lo, hi
+
+
+def build_filter(raw: dict) -> Filter | None:
+    """抽出結果 (LLMのJSON / 規則ベースの辞書) をQdrantフィルタに変換する。"""
     conditions = []
 
     if raw.get("material"):
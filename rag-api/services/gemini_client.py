@@ -1,5 +1,36 @@
-from google import genai
+import asyncio
+import threading
 
 import config
 
-client = genai.Client(api_key=config.GEMINI_API_KEY)
+_client = None
+_lock = threading.Lock()
+
+
+def get_client():
+    """共有のGeminiクライアント (google.genai.Client)。
+
+    google.genai の読み込みとクライアントの生成は初回呼び出しまで遅らせる。
+    GEMINI_API_KEY が未設定なら RuntimeError。
+    """
+    global _client
+    if _client is None:
+        with _lock:
+            if _client is None:
+                if not config.GEMINI_API_KEY:
+                    raise RuntimeError("GEMINI_API_KEY is not set")
+                from google import genai
+                from google.genai.types import HttpOptions
+
+                _client = genai.Client(
+                    api_key=config.GEMINI_API_KEY,
+                    http_options=HttpOptions(base_url=config.GEMINI_BASE_URL) if config.GEMINI_BASE_URL else None,
+                )
+    return _client
+
+
+async def ping() -> None:
+    """Gemini APIに接続できるか確認する (ヘルスチェック用)。生成は行わず、LLM_MODELの情報を取得する。"""
+    # 初回は google.genai の読み込みを伴うため、イベントループを止めないようスレッドで生成する
+    client = await asyncio.to_thread(get_client)
+    await client.aio.models.get(model=config.LLM_MODEL)
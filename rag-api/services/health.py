@@ -0,0 +1,128 @@
+import asyncio
+import contextlib
+import logging
+import time
+from collections.abc import Awaitable, Callable
+from datetime import datetime, timezone
+
+import config
+from services import gemini_client, mattermost, metrics, qdrant
+
+logger = logging.getLogger(__name__)
+
+# 確認結果の状態
+UP = "up"
+DOWN = "down"
+STALE = "stale"  # 最後の確認から時間が経ちすぎている (確認のループが止まっているなど)
+UNKNOWN = "unknown"  # 起動後まだ確認していない
+NOT_CONFIGURED = "not_configured"
+
+# 最後の確認からこの回数分の間隔 (+タイムアウト) が過ぎた結果は古いものとして扱う
+_STALE_INTERVALS = 2
+
+# 依存サービス -> (確認処理, 確認間隔, タイムアウト, 設定済みか)
+_PROBES: dict[str, tuple[Callable[[], Awaitable[None]], float, float, Callable[[], bool]]] = {
+    "qdrant": (
+        qdrant.ping,
+        config.HEALTH_QDRANT_INTERVAL,
+        config.HEALTH_QDRANT_TIMEOUT,
+        lambda: True,
+    ),
+    "gemini": (
+        gemini_client.ping,
+        config.HEALTH_GEMINI_INTERVAL,
+        config.HEALTH_GEMINI_TIMEOUT,
+        lambda: bool(config.GEMINI_API_KEY),
+    ),
+    "mattermost": (
+        lambda: mattermost.ping(config.HEALTH_MATTERMOST_TIMEOUT),
+        config.HEALTH_MATTERMOST_INTERVAL,
+        config.HEALTH_MATTERMOST_TIMEOUT,
+        lambda: bool(config.MATTERMOST_API_URL),
+    ),
+}
+
+_results: dict[str, dict] = {name: {"status": UNKNOWN} for name in _PROBES}
+_tasks: list[asyncio.Task] = []
+
+
+def start() -> None:
+    """依存サービスごとに、バックグラウンドで定期的に確認するタスクを開始する。"""
+    if _tasks:
+        return
+    for name in _PROBES:
+        _tasks.append(asyncio.create_task(_run(name)))
+
+
+async def close() -> None:
+    """確認のタスクを止める。"""
+    tasks = list(_tasks)
+    _tasks.clear()
+    for task in tasks:
+        task.cancel()
+    for task in tasks:
+        with contextlib.suppress(asyncio.CancelledError):
+            await task
+
+
+def snapshot() -> dict[str, dict]:
+    """最新の確認結果。ネットワークには出ず、キャッシュした結果だけを返す。
+
+    各サービスについて status (up / down / stale / unknown / not_configured)、確認時刻 (checked_at)、
+    経過秒数 (age_seconds)、確認にかかった時間 (latency_ms)、失敗時の理由 (error) を返す。
+    """
+    now = time.monotonic()
+    checks = {}
+    for name, result in _results.items():
+        check = {k: v for k, v in result.items() if k != "monotonic"}
+        if "monotonic" in result:
+            _, interval, timeout, _ = _PROBES[name]
+            age = now - result["monotonic"]
+            check["age_seconds"] = round(age, 1)
+            if age > interval * _STALE_INTERVALS + timeout:
+                check["status"] = STALE
+        checks[name] = check
+    return checks
+
+
+async def check(name: str) -> dict:
+    """1つの依存サービスをタイムアウト付きで確認し、結果を記録して返す。"""
+    probe, _, timeout, configured = _PROBES[name]
+    if not configured():
+        _results[name] = {"status": NOT_CONFIGURED}
+        return _results[name]
+
+    start = time.perf_counter()
+    error = None
+    try:
+        await asyncio.wait_for(probe(), timeout)
+    except asyncio.TimeoutError:
+        error = f"Timed out after {timeout:g}s"
+    except Exception as e:
+        error = str(e) or type(e).__name__
+    seconds = time.perf_counter() - start
+    metrics.record_health_probe(name, error is None, seconds)
+
+    previous = _results[name]["status"]
+    if error is not None and previous != DOWN:
+        logger.warning("Health check of %s failed: %s", name, error)
+    elif error is None and previous == DOWN:
+        logger.info("Health check of %s recovered", name)
+    _results[name] = {
+        "status": UP if error is None else DOWN,
+        "checked_at": datetime.now(timezone.utc).isoformat(),
+        "latency_ms": round(seconds * 1000, 1),
+        "error": error,
+        "monotonic": time.monotonic(),
+    }
+    return _results[name]
+
+
+async def _run(name: str) -> None:
+    _, interval, _, _ = _PROBES[name]
+    while True:
+        try:
+            await check(name)
+        except Exception:
+            logger.exception("Health check of %s raised unexpectedly", name)
+        await asyncio.sleep(interval)
@@ -0,0 +1,245 @@
+import asyncio
+import contextvars
+import itertools
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections.abc import Awaitable, Callable
+from dataclasses import dataclass
+
+import config
+from services import metrics
+
+logger = logging.getLogger(__name__)
+
+# submitの結果
+QUEUED = "queued"
+DUPLICATE = "duplicate"
+BUSY = "busy"
+
+
+class Deferred(Exception):
+    """ハンドラがこの例外を送出したジョブは失敗として数えるが、永続化されたジョブは削除せず再起動後に再実行する。"""
+
+
+@dataclass
+class _Job:
+    id: int
+    payload: dict
+    dedup_key: str | None
+    enqueued_at: float
+    # 投入元のコンテキスト (リクエストID・トレース)。再起動後に戻したジョブは新しいコンテキストで実行する
+    context: contextvars.Context | None = None
+
+
+class JobStore:
+    """未完了ジョブのSQLite永続化。再起動後にキューへ戻すために使う。"""
+
+    def __init__(self, path: str) -> None:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, queue TEXT NOT NULL, "
+            "payload TEXT NOT NULL, dedup_key TEXT)"
+        )
+        self._db.commit()
+
+    def add(self, queue: str, payload: dict, dedup_key: str | None) -> int:
+        with self._lock:
+            cursor = self._db.execute(
+                "INSERT INTO jobs (queue, payload, dedup_key) VALUES (?, ?, ?)",
+                (queue, json.dumps(payload, ensure_ascii=False), dedup_key),
+            )
+            self._db.commit()
+            return cursor.lastrowid
+
+    def remove(self, job_id: int) -> None:
+        with self._lock:
+            self._db.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+            self._db.commit()
+
+    def pending(self, queue: str) -> list[tuple[int, dict, str | None]]:
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT id, payload, dedup_key FROM jobs WHERE queue = ? ORDER BY id", (queue,)
+            ).fetchall()
+        return [(job_id, json.loads(payload), dedup_key) for job_id, payload, dedup_key in rows]
+
+
+class JobQueue:
+    """有界キューと固定数のワーカーでジョブを処理する。
+
+    - キューが満杯の場合は受け付けずに BUSY を返す (呼び出し側で「混雑中」と返信する)
+    - 同じ dedup_key のジョブが待機中・実行中の場合は DUPLICATE を返す
+    - yield_to を指定すると、そのキューに待ちがある間は新しいジョブを開始しない (優先度)
+    - persistent の場合、未完了のジョブはJobStoreに保存され、再起動後に再実行される
+      (ハンドラが Deferred を送出したジョブも、JobStoreに残して再起動後に再実行する)
+    """
+
+    def __init__(
+        self,
+        name: str,
+        handler: Callable[..., Awaitable[None]],
+        workers: int,
+        max_size: int,
+        persistent: bool = False,
+        yield_to: "JobQueue | None" = None,
+    ) -> None:
+        self.name = name
+        self._handler = handler
+        self._worker_count = workers
+        # 上限はsubmitで判定する (再起動後に戻すジョブは上限を超えても受け入れるため)
+        self._queue: asyncio.Queue[_Job] = asyncio.Queue()
+        self._max_size = max_size
+        self._persistent = persistent
+        self._yield_to = yield_to
+        self._keys: set[str] = set()
+        self._ids = itertools.count(1)
+        self._workers: list[asyncio.Task] = []
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._closing = False
+
+        self.running = 0
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.deduplicated = 0
+        self.recovered = 0
+        self._wait_ms_total = 0.0
+
+        _queues.append(self)
+
+    async def submit(self, payload: dict, dedup_key: str | None = None) -> str:
+        """ジョブを投入する。QUEUED / DUPLICATE / BUSY のいずれかを返す。"""
+        if dedup_key is not None and dedup_key in self._keys:
+            self.deduplicated += 1
+            return DUPLICATE
+        if self._closing or self._queue.qsize() >= self._max_size:
+            self.rejected += 1
+            return BUSY
+
+        job_id = next(self._ids)
+        if self._persistent and _store is not None:
+            job_id = await asyncio.to_thread(_store.add, self.name, payload, dedup_key)
+        self._enqueue(
+            _Job(job_id, payload, dedup_key, time.monotonic(), contextvars.copy_context())
+        )
+        self.submitted += 1
+        return QUEUED
+
+    def stats(self) -> dict:
+        """キューの深さ・実行中件数・処理件数などを返す。"""
+        started = self.completed + self.failed + self.running
+        return {
+            "depth": self._queue.qsize(),
+            "max_size": self._max_size,
+            "workers": self._worker_count,
+            "running": self.running,
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "deduplicated": self.deduplicated,
+            "recovered": self.recovered,
+            "avg_wait_ms": round(self._wait_ms_total / started, 1) if started else None,
+            "persistent": self._persistent and _store is not None,
+        }
+
+    async def _start(self) -> None:
+        self._closing = False
+        self._workers = [
+            asyncio.create_task(self._work(), name=f"{self.name}-worker-{i}")
+            for i in range(self._worker_count)
+        ]
+        if self._persistent and _store is not None:
+            for job_id, payload, dedup_key in await asyncio.to_thread(_store.pending, self.name):
+                self._enqueue(_Job(job_id, payload, dedup_key, time.monotonic()))
+                self.recovered += 1
+            if self.recovered:
+                logger.info("Recovered %d pending %s jobs", self.recovered, self.name)
+
+    async def _drain(self, timeout: float) -> None:
+        """新規受付を止め、待機中・実行中のジョブの完了を待ってからワーカーを止める。"""
+        self._closing = True
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except TimeoutError:
+            logger.warning(
+                "Shutting down with %d queued and %d running %s jobs",
+                self._queue.qsize(), self.running, self.name,
+            )
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    def _enqueue(self, job: _Job) -> None:
+        self._queue.put_nowait(job)
+        if job.dedup_key is not None:
+            self._keys.add(job.dedup_key)
+        self._idle.clear()
+
+    async def _work(self) -> None:
+        while True:
+            job = await self._queue.get()
+            if self._queue.empty():
+                self._idle.set()
+            try:
+                if self._yield_to is not None:
+                    await self._yield_to._idle.wait()
+                self._wait_ms_total += (time.monotonic() - job.enqueued_at) * 1000
+                self.running += 1
+                deferred = False
+                try:
+                    await asyncio.create_task(self._run(job), context=job.context)
+                    self.completed += 1
+                except Deferred as e:
+                    self.failed += 1
+                    deferred = True
+                    logger.warning("%s job %d deferred until restart: %s", self.name, job.id, e)
+                except Exception:
+                    self.failed += 1
+                    logger.exception("%s job %d failed", self.name, job.id)
+                finally:
+                    self.running -= 1
+                # 失敗したジョブも再実行はしない (ハンドラ側でユーザーに通知済み)
+                if self._persistent and _store is not None and not deferred:
+                    await asyncio.to_thread(_store.remove, job.id)
+            finally:
+                if job.dedup_key is not None:
+                    self._keys.discard(job.dedup_key)
+                self._queue.task_done()
+
+    async def _run(self, job: _Job) -> None:
+        if job.context is None:
+            metrics.new_request_id()
+        with metrics.span(f"job.{self.name}"):
+            await self._handler(**job.payload)
+
+
+_queues: list[JobQueue] = []
+_store: JobStore | None = JobStore(config.JOB_STORE_PATH) if config.JOB_STORE_PATH else None
+
+
+async def start() -> None:
+    """全キューのワーカーを起動し、永続化された未完了ジョブを戻す。"""
+    for queue in _queues:
+        await queue._start()
+
+
+async def shutdown(timeout: float = config.JOB_DRAIN_TIMEOUT) -> None:
+    """全キューの受付を止め、最大timeout秒まで処理中のジョブの完了を待つ。"""
+    await asyncio.gather(*(queue._drain(timeout) for queue in _queues))
+
+
+def stats() -> dict:
+    """キューごとの統計を返す。"""
+    return {queue.name: queue.stats() for queue in _queues}
@@ -1,29 +1,219 @@
 import asyncio
+import json
+import logging
+import time
+from collections.abc import AsyncIterator
 from pathlib import Path
 
-from google.genai.types import GenerateContentConfig
-
 import config
-from services.gemini_client import client as _client
-_system_prompt = (Path(__file__).parent.parent / "prompts" / "system.txt").read_text(
-    encoding="utf-8"
-)
+from services import metrics
+from services.gemini_client import get_client
+
+logger = logging.getLogger(__name__)
+
+_PROMPTS = Path(__file__).parent.parent / "prompts"
+_system_prompt = (_PROMPTS / "system.txt").read_text(encoding="utf-8")
+# few-shot例はコンテキストキャッシュが有効な場合のみ送る (キャッシュなしでは毎回の入力が増えるため)
+_few_shot = json.loads((_PROMPTS / "few_shot.json").read_text(encoding="utf-8"))
+
+_COMBINED_INSTRUCTION = """
+[出力形式]
+JSONで返してください。
+- answer: ルールに従った回答
+- filters: 質問から読み取れる検索条件。material (材質), diameter_min / diameter_max / length_min / length_max (mm, 数値)。
+  「Φ30くらい」のような曖昧な表現は ±20% の範囲、正確な値はmin/maxを同じ値にする。該当しない項目はnull
+検索結果はこの条件で絞り込まれていないため、条件に合うデータを優先して回答してください。"""
+
+# 回答と検索条件を1回で返す場合の応答スキーマ
+_COMBINED_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "answer": {"type": "STRING"},
+        "filters": {
+            "type": "OBJECT",
+            "nullable": True,
+            "properties": {
+                "material": {"type": "STRING", "nullable": True},
+                "diameter_min": {"type": "NUMBER", "nullable": True},
+                "diameter_max": {"type": "NUMBER", "nullable": True},
+                "length_min": {"type": "NUMBER", "nullable": True},
+                "length_max": {"type": "NUMBER", "nullable": True},
+            },
+        },
+    },
+    "required": ["answer"],
+}
+
+
+class _ContextCache:
+    """システムプロンプトとfew-shot例のGeminiコンテキストキャッシュ。
+
+    TTLが切れる前に作り直す。作成に失敗した場合 (モデルが未対応・最小トークン数に満たないなど) は
+    TTLの間はキャッシュなし (system_instructionを毎回送る) で動作し、その後に再試行する。
+    """
+
+    def __init__(self, ttl: int) -> None:
+        self._ttl = ttl
+        self._name: str | None = None
+        self._expires_at = 0.0
+        self._retry_at = 0.0
+        self._lock = asyncio.Lock()
+
+    async def name(self) -> str | None:
+        if not config.LLM_CONTEXT_CACHE:
+            return None
+        async with self._lock:
+            now = time.monotonic()
+            # 使用中に期限が切れないよう、1分前には作り直す
+            if self._name is not None and now < self._expires_at - 60:
+                return self._name
+            if now < self._retry_at:
+                return None
+            from google.genai.types import CreateCachedContentConfig
+
+            try:
+                cache = await get_client().aio.caches.create(
+                    model=config.LLM_MODEL,
+                    config=CreateCachedContentConfig(
+                        system_instruction=_system_prompt,
+                        contents=_few_shot_contents(),
+                        ttl=f"{self._ttl}s",
+                        display_name="estimate-rag-answer",
+                    ),
+                )
+            except Exception:
+                logger.warning("Context cache unavailable, sending the system prompt inline", exc_info=True)
+                self._name = None
+                self._retry_at = now + self._ttl
+                return None
+            logger.info("Created context cache %s", cache.name)
+            self._name = cache.name
+            self._expires_at = now + self._ttl
+            return self._name
+
+    def invalidate(self) -> None:
+        self._name = None
+
+
+_context_cache = _ContextCache(config.LLM_CONTEXT_CACHE_TTL)
 
 
 async def generate_answer(query: str, context: str) -> str:
     """検索結果コンテキストとユーザー質問からLLM回答を生成する。"""
-    prompt = f"""[検索結果]
+    response = await _generate(_build_prompt(query, context), "generate_answer")
+    return response.text
+
+
+async def generate_answer_with_filters(query: str, context: str) -> tuple[str, dict]:
+    """回答と、質問から読み取れる検索条件 (filter.build_filterに渡せる辞書) を1回の呼び出しで生成する。"""
+    response = await _generate(
+        _build_prompt(query, context) + _COMBINED_INSTRUCTION,
+        "generate_answer",
+        response_mime_type="application/json",
+        response_schema=_COMBINED_SCHEMA,
+    )
+    try:
+        data = json.loads(response.text)
+        answer = data["answer"]
+    except (TypeError, ValueError, KeyError):
+        logger.warning("Combined answer was not valid JSON, using it as plain text")
+        return response.text or "", {}
+    return answer, data.get("filters") or {}
+
+
+async def stream_answer(query: str, context: str) -> AsyncIterator[str]:
+    """generate_answerのストリーミング版。生成されたテキストを断片ごとに返す。"""
+    usage = None
+    start = time.perf_counter()
+    try:
+        stream = await get_client().aio.models.generate_content_stream(
+            model=config.LLM_MODEL,
+            contents=_build_prompt(query, context),
+            config=await _answer_config(),
+        )
+        async for chunk in stream:
+            # トークン数は最後の断片のusage_metadataが累計になる
+            usage = chunk.usage_metadata or usage
+            if chunk.text:
+                yield chunk.text
+    except Exception as e:
+        metrics.record_gemini("generate_answer", metrics.gemini_outcome(e))
+        raise
+    metrics.record_gemini("generate_answer", "ok", usage)
+    _log_usage("generate_answer (stream)", usage, start)
+
+
+async def _generate(contents: str, kind: str, **options):
+    from google.genai.types import GenerateContentConfig
+
+    start = time.perf_counter()
+    generation_config = await _answer_config(**options)
+    try:
+        try:
+            response = await asyncio.to_thread(
+                get_client().models.generate_content,
+                model=config.LLM_MODEL,
+                contents=contents,
+                config=generation_config,
+            )
+        except Exception:
+            if generation_config.cached_content is None:
+                raise
+            # キャッシュがサーバー側で消えている場合に備え、1度だけキャッシュなしで再試行する
+            logger.warning("Generation with context cache failed, retrying inline", exc_info=True)
+            _context_cache.invalidate()
+            response = await asyncio.to_thread(
+                get_client().models.generate_content,
+                model=config.LLM_MODEL,
+                contents=contents,
+                config=GenerateContentConfig(system_instruction=_system_prompt, **options),
+            )
+    except Exception as e:
+        metrics.record_gemini(kind, metrics.gemini_outcome(e))
+        raise
+    metrics.record_gemini(kind, "ok", response.usage_metadata)
+    _log_usage(kind, response.usage_metadata, start)
+    return response
+
+
+async def _answer_config(**options):
+    from google.genai.types import GenerateContentConfig
+
+    cache_name = await _context_cache.name()
+    if cache_name is not None:
+        return GenerateContentConfig(cached_content=cache_name, **options)
+    return GenerateContentConfig(system_instruction=_system_prompt, **options)
+
+
+def _log_usage(kind: str, usage, start: float) -> None:
+    """1リクエスト分の入力・キャッシュ済み・出力トークン数と所要時間をログに出す。"""
+    logger.info(
+        "LLM %s: input=%s cached=%s output=%s tokens, %.0f ms",
+        kind,
+        getattr(usage, "prompt_token_count", None),
+        getattr(usage, "cached_content_token_count", None),
+        getattr(usage, "candidates_token_count", None),
+        (time.perf_counter() - start) * 1000,
+    )
+
+
+def _few_shot_contents() -> list:
+    from google.genai.types import Content, Part
+
+    contents = []
+    for example in _few_shot:
+        contents.append(
+            Content(role="user", parts=[Part(text=_build_prompt(example["question"], example["context"]))])
+        )
+        contents.append(Content(role="model", parts=[Part(text=example["answer"])]))
+    return contents
+
+
+def _build_prompt(query: str, context: str) -> str:
+    return f"""[検索結果]
 以下は過去の見積データから類似する案件を検索した結果です:
 
 {context}
 
 [ユーザーの質問]
 {query}"""
-
-    response = await asyncio.to_thread(
-        _client.models.generate_content,
-        model=config.LLM_MODEL,
-        contents=prompt,
-        config=GenerateContentConfig(system_instruction=_system_prompt),
-    )
-    return response.text
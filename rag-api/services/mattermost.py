@@ -1,39 +1,215 @@
+import asyncio
+import contextlib
 import logging
+import tempfile
+from typing import BinaryIO
 
 import httpx
 
 import config
+from services import metrics, ratelimit
 
 logger = logging.getLogger(__name__)
 
 _TIMEOUT = httpx.Timeout(30.0)
 
+# アプリ全体で共有するHTTPクライアント (lifespanのstart/closeで生成・破棄する)
+_client: httpx.AsyncClient | None = None
 
-async def download_file(file_id: str) -> tuple[bytes, str]:
-    """Mattermost APIからファイルをダウンロードする。(content, filename)を返す。"""
-    async with httpx.AsyncClient(timeout=_TIMEOUT) as client:
-        # ファイル情報を取得
-        info_resp = await client.get(
-            f"{config.MATTERMOST_API_URL}/files/{file_id}/info",
-            headers={"Authorization": f"Bearer {config.MATTERMOST_BOT_TOKEN}"},
-        )
-        info_resp.raise_for_status()
-        filename = info_resp.json().get("name", "unknown.csv")
 
-        # ファイル本体をダウンロード
-        file_resp = await client.get(
-            f"{config.MATTERMOST_API_URL}/files/{file_id}",
-            headers={"Authorization": f"Bearer {config.MATTERMOST_BOT_TOKEN}"},
-        )
-        file_resp.raise_for_status()
-        return file_resp.content, filename
+async def start() -> None:
+    """接続プール付きの共有HTTPクライアントを作成する。"""
+    global _client
+    if _client is None:
+        _client = _new_client()
+
+
+async def close() -> None:
+    """共有HTTPクライアントを閉じ、プール中の接続を解放する。"""
+    global _client
+    if _client is not None:
+        client, _client = _client, None
+        await client.aclose()
+
+
+async def download_file(file_id: str) -> tuple[BinaryIO, str]:
+    """Mattermost APIからファイルをダウンロードする。(file, filename)を返す。
+
+    本体はメモリに載せずに一時ファイル (一定サイズまではメモリ上) へストリーミングで書き出す。
+    返したファイルは呼び出し側で閉じること。
+    """
+    info_resp = await _request(
+        "GET", f"{config.MATTERMOST_API_URL}/files/{file_id}/info", headers=_auth_headers()
+    )
+    filename = info_resp.json().get("name", "unknown.csv")
+
+    spool = tempfile.SpooledTemporaryFile(max_size=config.MATTERMOST_DOWNLOAD_SPOOL_BYTES)
+    try:
+        async with _get_client().stream(
+            "GET", f"{config.MATTERMOST_API_URL}/files/{file_id}", headers=_auth_headers()
+        ) as file_resp:
+            file_resp.raise_for_status()
+            async for chunk in file_resp.aiter_bytes():
+                spool.write(chunk)
+        spool.seek(0)
+    except BaseException:
+        spool.close()
+        raise
+    return spool, filename
 
 
 async def post_message(channel_id: str, text: str) -> None:
     """Incoming Webhookでメッセージを投稿する。"""
-    async with httpx.AsyncClient(timeout=_TIMEOUT) as client:
-        resp = await client.post(
+    with metrics.stage("post_message"):
+        await _request(
+            "POST",
             config.MATTERMOST_INCOMING_WEBHOOK_URL,
             json={"channel_id": channel_id, "text": text},
         )
-        resp.raise_for_status()
+
+
+async def create_post(channel_id: str, message: str) -> str:
+    """REST API (Botトークン) でメッセージを投稿し、投稿IDを返す。"""
+    with metrics.stage("create_post"):
+        resp = await _request(
+            "POST",
+            f"{config.MATTERMOST_API_URL}/posts",
+            headers=_auth_headers(),
+            json={"channel_id": channel_id, "message": message},
+        )
+    return resp.json()["id"]
+
+
+async def update_post(post_id: str, message: str) -> None:
+    """REST API (Botトークン) で投稿の本文を書き換える。"""
+    with metrics.stage("update_post"):
+        await _request(
+            "PUT",
+            f"{config.MATTERMOST_API_URL}/posts/{post_id}/patch",
+            headers=_auth_headers(),
+            json={"message": message},
+        )
+
+
+async def ping(timeout: float) -> None:
+    """Mattermost APIに接続できるか確認する (ヘルスチェック用、リトライしない)。失敗時は例外。"""
+    resp = await _get_client().get(f"{config.MATTERMOST_API_URL}/system/ping", timeout=timeout)
+    resp.raise_for_status()
+
+
+class PostEditor:
+    """1つの投稿を繰り返し書き換える。
+
+    更新は最短 interval 秒間隔に間引き、送信待ちの間に届いた更新は最新の1件だけを送る。
+    """
+
+    def __init__(self, post_id: str, interval: float) -> None:
+        self.post_id = post_id
+        self.edits = 0
+        self._interval = interval
+        self._pending: str | None = None
+        self._changed = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    def update(self, message: str) -> None:
+        """投稿内容を更新する (実際の送信はバックグラウンドで行う)。"""
+        self._pending = message
+        self._changed.set()
+
+    async def close(self, message: str) -> None:
+        """送信待ちの更新を破棄し、最終的な内容で投稿を書き換える。"""
+        self._task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await self._task
+        await update_post(self.post_id, message)
+        self.edits += 1
+
+    async def _run(self) -> None:
+        while True:
+            await self._changed.wait()
+            self._changed.clear()
+            message, self._pending = self._pending, None
+            try:
+                await update_post(self.post_id, message)
+                self.edits += 1
+            except Exception:
+                logger.warning("Failed to update post %s", self.post_id, exc_info=True)
+            await asyncio.sleep(self._interval)
+
+
+def _new_client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        timeout=_TIMEOUT,
+        http2=config.MATTERMOST_HTTP2,
+        limits=httpx.Limits(
+            max_connections=config.MATTERMOST_MAX_CONNECTIONS,
+            max_keepalive_connections=config.MATTERMOST_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=config.MATTERMOST_KEEPALIVE_EXPIRY,
+        ),
+    )
+
+
+def _get_client() -> httpx.AsyncClient:
+    # lifespan外 (スクリプトなど) から呼ばれた場合も使えるよう、未作成なら作る
+    global _client
+    if _client is None:
+        _client = _new_client()
+    return _client
+
+
+def _auth_headers() -> dict[str, str]:
+    return {"Authorization": f"Bearer {config.MATTERMOST_BOT_TOKEN}"}
+
+
+async def _request(method: str, url: str, **kwargs) -> httpx.Response:
+    """リクエストを送信する。429・5xx・通信エラーはジッタ付きバックオフでリトライする。
+
+    POSTは接続エラーと429だけリトライする (_is_retryable)。ただし再利用した接続がサーバー側で
+    既に閉じられていた場合は、メソッドによらず新しい接続で1回だけ送り直す (_send)。
+    """
+    attempt = 0
+    while True:
+        try:
+            resp = await _send(method, url, **kwargs)
+            resp.raise_for_status()
+            return resp
+        except Exception as e:
+            if not _is_retryable(method, e) or attempt == config.MATTERMOST_MAX_RETRIES:
+                raise
+            delay = ratelimit.retry_delay(
+                e, attempt, config.MATTERMOST_RETRY_BASE_DELAY, config.MATTERMOST_RETRY_MAX_DELAY
+            )
+        attempt += 1
+        logger.warning("Mattermost %s %s failed, retrying in %.1fs (attempt %d)", method, url, delay, attempt)
+        await asyncio.sleep(delay)
+
+
+async def _send(method: str, url: str, **kwargs) -> httpx.Response:
+    # プールから再利用したkeep-alive接続をサーバーが閉じていると、レスポンスを受け取る前に
+    # ReadError / RemoteProtocolError になる。リクエストは処理されていないため、POSTでも送り直せる
+    events: set[str] = set()
+
+    async def trace(name: str, info: dict) -> None:
+        events.add(name)
+
+    try:
+        return await _get_client().request(method, url, extensions={"trace": trace}, **kwargs)
+    except (httpx.ReadError, httpx.WriteError, httpx.RemoteProtocolError) as e:
+        reused = not any(name.startswith("connection.connect_tcp") for name in events)
+        responded = any(name.endswith("receive_response_headers.complete") for name in events)
+        if not reused or responded:
+            raise
+        logger.info("Mattermost %s %s: reused connection was closed (%r); resending on a new connection", method, url, e)
+    # プール内の他の接続も同じく閉じられている可能性があるため、使い捨てのクライアントで新しく接続する
+    async with _new_client() as client:
+        return await client.request(method, url, **kwargs)
+
+
+def _is_retryable(method: str, error: BaseException) -> bool:
+    if method != "POST":
+        return ratelimit.is_retryable(error)
+    # 投稿のPOSTは冪等でないため、サーバーに届いていないことが確実な接続エラーと429だけリトライする
+    # (5xx・読み取りタイムアウトでは投稿が作られている可能性があり、リトライすると二重に投稿される)
+    return ratelimit.is_rate_limited(error) or isinstance(
+        error, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+    )
@@ -0,0 +1,182 @@
+import contextlib
+import contextvars
+import logging
+import time
+import uuid
+from collections.abc import Iterator
+
+from prometheus_client import Counter, Gauge, Histogram
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from prometheus_client.registry import REGISTRY, Collector
+
+import config
+from services import ratelimit
+
+try:
+    from opentelemetry import trace as _otel_trace
+except ImportError:  # OpenTelemetryは任意
+    _otel_trace = None
+
+logger = logging.getLogger(__name__)
+
+# Webhook受信から返信投稿までを追跡するためのリクエストID。
+# ジョブキューは投入時のcontextvarsを引き継いでハンドラを実行するため、バックグラウンド処理にも伝わる
+request_id: contextvars.ContextVar[str] = contextvars.ContextVar("request_id", default="-")
+
+STAGE_SECONDS = Histogram(
+    "rag_stage_duration_seconds",
+    "Latency of each RAG pipeline stage",
+    ["stage"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),
+)
+GEMINI_REQUESTS = Counter(
+    "gemini_requests_total",
+    "Gemini API calls by purpose and outcome (ok / rate_limited / error)",
+    ["kind", "outcome"],
+)
+GEMINI_TOKENS = Counter(
+    "gemini_tokens_total",
+    "Gemini tokens by purpose and direction (input / cached / output; embedding input is estimated from characters)",
+    ["kind", "direction"],
+)
+IMPORT_ROWS = Counter(
+    "import_rows_total",
+    "Imported rows by result (new / updated / unchanged / error)",
+    ["result"],
+)
+IMPORT_SECONDS = Counter("import_duration_seconds_total", "Total time spent importing")
+HEALTH_PROBE_SECONDS = Histogram(
+    "health_probe_duration_seconds",
+    "Latency of background dependency health probes by outcome (up / down)",
+    ["dependency", "outcome"],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+DEPENDENCY_UP = Gauge("dependency_up", "Result of the latest health probe (1 = up, 0 = down)", ["dependency"])
+
+_tracer = _otel_trace.get_tracer("estimate-rag") if _otel_trace is not None else None
+
+
+def new_request_id(value: str | None = None) -> str:
+    """現在のコンテキストにリクエストIDを設定して返す。"""
+    rid = value or uuid.uuid4().hex[:16]
+    request_id.set(rid)
+    return rid
+
+
+@contextlib.contextmanager
+def stage(name: str) -> Iterator[None]:
+    """処理段階の所要時間をヒストグラムに記録し、OpenTelemetryが有効ならスパンを作る。"""
+    start = time.perf_counter()
+    with _span(name):
+        try:
+            yield
+        finally:
+            STAGE_SECONDS.labels(name).observe(time.perf_counter() - start)
+
+
+@contextlib.contextmanager
+def span(name: str) -> Iterator[None]:
+    """ヒストグラムには記録せず、トレースのスパンだけを作る (ジョブ全体など)。"""
+    with _span(name):
+        yield
+
+
+def record_gemini(kind: str, outcome: str, usage=None, input_tokens: int | None = None) -> None:
+    """Gemini呼び出しの結果とトークン数を記録する。usageはレスポンスのusage_metadata。"""
+    GEMINI_REQUESTS.labels(kind, outcome).inc()
+    prompt = getattr(usage, "prompt_token_count", None) if usage is not None else input_tokens
+    output = getattr(usage, "candidates_token_count", None) if usage is not None else None
+    # コンテキストキャッシュから読まれたトークン (inputの内数)
+    cached = getattr(usage, "cached_content_token_count", None) if usage is not None else None
+    if prompt:
+        GEMINI_TOKENS.labels(kind, "input").inc(prompt)
+    if cached:
+        GEMINI_TOKENS.labels(kind, "cached").inc(cached)
+    if output:
+        GEMINI_TOKENS.labels(kind, "output").inc(output)
+
+
+def gemini_outcome(error: BaseException | None) -> str:
+    """Gemini呼び出しの結果ラベル。"""
+    if error is None:
+        return "ok"
+    return "rate_limited" if ratelimit.is_rate_limited(error) else "error"
+
+
+def record_import(new: int, updated: int, unchanged: int, errors: int, seconds: float) -> None:
+    """取り込み1回分の件数と所要時間を記録する (rows/s は rate(import_rows_total) / rate(import_duration_seconds_total))。"""
+    IMPORT_ROWS.labels("new").inc(new)
+    IMPORT_ROWS.labels("updated").inc(updated)
+    IMPORT_ROWS.labels("unchanged").inc(unchanged)
+    IMPORT_ROWS.labels("error").inc(errors)
+    IMPORT_SECONDS.inc(seconds)
+
+
+def record_health_probe(dependency: str, up: bool, seconds: float) -> None:
+    """依存サービスのヘルスチェック1回分の結果とレイテンシを記録する。"""
+    HEALTH_PROBE_SECONDS.labels(dependency, "up" if up else "down").observe(seconds)
+    DEPENDENCY_UP.labels(dependency).set(1 if up else 0)
+
+
+def setup_tracing() -> None:
+    """OTEL_ENABLEDの場合、OTLPエクスポーターでスパンを送信するよう設定する。
+
+    エクスポート先は OpenTelemetry標準の環境変数 (OTEL_EXPORTER_OTLP_ENDPOINT など) で指定する。
+    要 `pip install opentelemetry-sdk opentelemetry-exporter-otlp`。
+    """
+    if not config.OTEL_ENABLED:
+        return
+    try:
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor
+    except ImportError:
+        logger.warning("OTEL_ENABLED is set but opentelemetry-sdk / exporter is not installed")
+        return
+    provider = TracerProvider(resource=Resource.create({"service.name": config.OTEL_SERVICE_NAME}))
+    provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+    _otel_trace.set_tracer_provider(provider)
+    logger.info("OpenTelemetry tracing enabled")
+
+
+class RequestIdLogFilter(logging.Filter):
+    """ログレコードにリクエストIDを付与する。"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = request_id.get()
+        return True
+
+
+class _JobQueueCollector(Collector):
+    """ジョブキューの深さ・実行中件数などをスクレイプ時に読み出す。"""
+
+    def collect(self):
+        from services import jobs
+
+        depth = GaugeMetricFamily("job_queue_depth", "Jobs waiting in the queue", labels=["queue"])
+        running = GaugeMetricFamily("job_queue_running", "Jobs currently running", labels=["queue"])
+        outcomes = CounterMetricFamily(
+            "job_queue_jobs", "Jobs by outcome (completed / failed / rejected / deduplicated)",
+            labels=["queue", "outcome"],
+        )
+        for name, s in jobs.stats().items():
+            depth.add_metric([name], s["depth"])
+            running.add_metric([name], s["running"])
+            for outcome in ("completed", "failed", "rejected", "deduplicated"):
+                outcomes.add_metric([name, outcome], s[outcome])
+        yield depth
+        yield running
+        yield outcomes
+
+
+REGISTRY.register(_JobQueueCollector())
+
+
+@contextlib.contextmanager
+def _span(name: str) -> Iterator[None]:
+    if _tracer is None or not config.OTEL_ENABLED:
+        yield
+        return
+    with _tracer.start_as_current_span(name, attributes={"request_id": request_id.get()}):
+        yield
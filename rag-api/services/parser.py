@@ -1,61 +1,225 @@
-import io
+from collections.abc import Iterator
 from datetime import date
+from typing import BinaryIO
 
+import numpy as np
 import pandas as pd
-from pydantic import ValidationError
+from pydantic import TypeAdapter, ValidationError
 
 from models.estimate import EstimateRecord
 
 
 REQUIRED_COLUMNS = {"id", "name", "material", "diameter_mm", "length_mm", "application", "price"}
 
+_INT_COLUMNS = ("id", "price", "quantity", "unit_price")
+_FLOAT_COLUMNS = ("diameter_mm", "length_mm", "weight_kg")
+_STR_COLUMNS = ("name", "material", "application", "grade", "customer", "notes")
+_DATE_COLUMN = "estimate_date"
 
-def parse_file(content: bytes, filename: str) -> tuple[list[EstimateRecord], list[str]]:
-    """CSV/Excelファイルをパースし、バリデーション済みレコードとエラーリストを返す。"""
+# float64を経由して整数に変換しても精度が落ちない範囲
+_MAX_SAFE_INT = 2**53
+
+# 一括バリデーションの単位。失敗したチャンクだけを行単位の処理に回す
+_VALIDATE_CHUNK_SIZE = 1000
+
+_records_adapter = TypeAdapter(list[EstimateRecord])
+
+
+def iter_file_chunks(
+    source: BinaryIO, filename: str, chunk_size: int
+) -> Iterator[tuple[list[EstimateRecord], list[str]]]:
+    """CSV/Excelファイルをchunk_size行ずつ読み込み、(レコード, エラー) を順に返す。
+
+    ファイル全体をDataFrameに載せないため、メモリ使用量はファイルサイズに依存しない。
+    """
     if filename.endswith(".xlsx"):
-        df = pd.read_excel(io.BytesIO(content), sheet_name=0)
+        frames = _iter_excel_frames(source, chunk_size)
     else:
         # UTF-8 BOMあり/なし両対応
-        try:
-            text = content.decode("utf-8-sig")
-        except UnicodeDecodeError:
-            text = content.decode("utf-8")
-        df = pd.read_csv(io.StringIO(text))
+        frames = pd.read_csv(source, encoding="utf-8-sig", chunksize=chunk_size)
 
-    # カラム名の正規化（前後の空白除去）
-    df.columns = [col.strip() for col in df.columns]
+    for i, df in enumerate(frames):
+        # カラム名の正規化（前後の空白除去）
+        df.columns = [str(col).strip() for col in df.columns]
 
-    # 必須列チェック
-    missing = REQUIRED_COLUMNS - set(df.columns)
-    if missing:
-        return [], [f"必須列が不足しています: {', '.join(sorted(missing))}"]
+        # 必須列チェック（ヘッダーは全チャンク共通のため先頭で1回だけ）
+        if i == 0:
+            missing = REQUIRED_COLUMNS - set(df.columns)
+            if missing:
+                yield [], [f"必須列が不足しています: {', '.join(sorted(missing))}"]
+                return
 
-    records: list[EstimateRecord] = []
-    errors: list[str] = []
+        yield _parse_dataframe(df)
+
+
+def _iter_excel_frames(source: BinaryIO, chunk_size: int) -> Iterator[pd.DataFrame]:
+    """1シート目を読み取り専用モードで1行ずつ読み、chunk_size行ごとのDataFrameにする。"""
+    from openpyxl import load_workbook
+
+    workbook = load_workbook(source, read_only=True, data_only=True)
+    try:
+        rows = workbook.worksheets[0].iter_rows(values_only=True)
+        header = next(rows, None)
+        if header is None:
+            return
+        columns = ["" if col is None else col for col in header]
+
+        buffer: list[tuple] = []
+        labels: list[int] = []
+        # indexはシート上の行番号 - 2（エラーメッセージの行番号がCSVと同じ規則になる）
+        for label, row in enumerate(rows):
+            if all(value is None for value in row):
+                continue
+            buffer.append(tuple(row[: len(columns)]) + (None,) * (len(columns) - len(row)))
+            labels.append(label)
+            if len(buffer) >= chunk_size:
+                yield pd.DataFrame(buffer, columns=columns, index=labels)
+                buffer, labels = [], []
+        if buffer:
+            yield pd.DataFrame(buffer, columns=columns, index=labels)
+    finally:
+        workbook.close()
+
+
+def _parse_dataframe(df: pd.DataFrame) -> tuple[list[EstimateRecord], list[str]]:
+    """DataFrameを列単位で型変換し、レコードを一括生成する。
+
+    型変換・日付解析は列ごとに1回だけ行い、確実に変換できない行はマスクで検出して
+    行単位の処理 (_parse_row) に回す。エラーメッセージは行単位の処理と同一になる。
+    """
+    fast = np.ones(len(df), dtype=bool)
+    columns: dict[str, list] = {}
+
+    for col in _INT_COLUMNS + _FLOAT_COLUMNS:
+        if col in df.columns:
+            values, ok = _coerce_numeric(
+                df[col], integer=col in _INT_COLUMNS, required=col in REQUIRED_COLUMNS
+            )
+            columns[col] = values
+            fast &= ok
+
+    for col in _STR_COLUMNS:
+        if col in df.columns:
+            series = df[col]
+            notna = series.notna().to_numpy()
+            columns[col] = series.astype(object).where(notna, None).tolist()
+            if col in REQUIRED_COLUMNS:
+                fast &= notna
+
+    if _DATE_COLUMN in df.columns:
+        values, ok = _coerce_dates(df[_DATE_COLUMN])
+        columns[_DATE_COLUMN] = values
+        fast &= ok
+
+    keys = list(columns)
+    arrays = [np.array(columns[k], dtype=object) for k in keys]
+    fast_positions = np.flatnonzero(fast)
+
+    parsed: dict[int, EstimateRecord] = {}
+    slow_positions = set(np.flatnonzero(~fast).tolist())
+
+    for i in range(0, len(fast_positions), _VALIDATE_CHUNK_SIZE):
+        chunk = fast_positions[i : i + _VALIDATE_CHUNK_SIZE]
+        rows = [dict(zip(keys, vals)) for vals in zip(*(arr[chunk].tolist() for arr in arrays))]
+        try:
+            records = _records_adapter.validate_python(rows)
+        except ValidationError:
+            slow_positions.update(chunk.tolist())
+            continue
+        parsed.update(zip(chunk.tolist(), records))
 
-    for idx, row in df.iterrows():
-        row_num = idx + 2  # ヘッダー行 + 0-indexed → 実際の行番号
+    errors: list[str] = []
+    for p in sorted(slow_positions):
+        row_num = df.index[p] + 2  # ヘッダー行 + 0-indexed → 実際の行番号
         try:
-            raw = row.where(pd.notna(row), None).to_dict()
-            # 型変換
-            raw["id"] = int(raw["id"])
-            raw["price"] = int(raw["price"])
-            raw["diameter_mm"] = float(raw["diameter_mm"])
-            raw["length_mm"] = float(raw["length_mm"])
-            if raw.get("weight_kg") is not None:
-                raw["weight_kg"] = float(raw["weight_kg"])
-            if raw.get("quantity") is not None:
-                raw["quantity"] = int(raw["quantity"])
-            if raw.get("unit_price") is not None:
-                raw["unit_price"] = int(raw["unit_price"])
-            if raw.get("estimate_date") is not None:
-                val = raw["estimate_date"]
-                if not isinstance(val, date):
-                    raw["estimate_date"] = pd.to_datetime(str(val)).date()
-
-            record = EstimateRecord(**raw)
-            records.append(record)
+            parsed[p] = _parse_row(df.iloc[p])
         except (ValidationError, ValueError, TypeError) as e:
             errors.append(f"行{row_num}: {e}")
 
+    records = [parsed[p] for p in sorted(parsed)]
     return records, errors
+
+
+def _coerce_numeric(
+    series: pd.Series, integer: bool, required: bool
+) -> tuple[list, np.ndarray]:
+    """数値列を一括変換する。(値リスト, 一括処理してよい行のマスク) を返す。"""
+    notna = series.notna().to_numpy()
+
+    if pd.api.types.is_numeric_dtype(series) and not pd.api.types.is_bool_dtype(series):
+        numeric = series
+        exact = np.ones(len(series), dtype=bool)
+    else:
+        # 文字列などが混在する列: int()/float() と同じ結果になると確信できる値だけ一括変換
+        text = series.astype("string")
+        numeric = pd.to_numeric(text, errors="coerce")
+        if integer:
+            exact = text.str.fullmatch(r"\s*[+-]?\d+\s*").fillna(False).to_numpy(dtype=bool)
+        else:
+            exact = numeric.notna().to_numpy()
+
+    arr = numeric.to_numpy(dtype="float64", na_value=np.nan)
+    finite = np.isfinite(arr)
+    convertible = exact & finite
+    if integer:
+        convertible &= np.abs(np.where(finite, arr, 0)) < _MAX_SAFE_INT
+
+    ok = convertible if required else (~notna | convertible)
+
+    if integer:
+        if pd.api.types.is_integer_dtype(numeric) and not numeric.isna().any():
+            values = numeric.tolist()
+        else:
+            # int() と同様に0方向へ切り捨て
+            values = np.where(convertible, arr, 0).astype(np.int64).tolist()
+    else:
+        values = arr.tolist()
+
+    if not notna.all():
+        values = [v if present else None for v, present in zip(values, notna)]
+    return values, ok
+
+
+def _coerce_dates(series: pd.Series) -> tuple[list, np.ndarray]:
+    """日付列を一括で解析する。(値リスト, 一括処理してよい行のマスク) を返す。"""
+    notna = series.notna().to_numpy()
+    empty: list = [None] * len(series)
+
+    if pd.api.types.is_datetime64_any_dtype(series):
+        # 時刻成分を持つdatetimeはdate型として受け付けられないため行単位の処理に回す
+        ok = ~notna | (series == series.dt.normalize()).to_numpy()
+        return series.dt.date.astype(object).where(notna, None).tolist(), ok
+
+    if pd.api.types.is_numeric_dtype(series):
+        return empty, ~notna
+
+    try:
+        parsed = pd.to_datetime(series, errors="coerce")
+    except (ValueError, TypeError):
+        return empty, ~notna
+
+    parsed_ok = parsed.notna().to_numpy()
+    values = parsed.dt.date.astype(object).where(parsed_ok, None).tolist()
+    return values, ~notna | parsed_ok
+
+
+def _parse_row(row: pd.Series) -> EstimateRecord:
+    """1行分のデータを型変換してレコードを生成する。"""
+    raw = row.where(pd.notna(row), None).to_dict()
+    # 型変換
+    raw["id"] = int(raw["id"])
+    raw["price"] = int(raw["price"])
+    raw["diameter_mm"] = float(raw["diameter_mm"])
+    raw["length_mm"] = float(raw["length_mm"])
+    if raw.get("weight_kg") is not None:
+        raw["weight_kg"] = float(raw["weight_kg"])
+    if raw.get("quantity") is not None:
+        raw["quantity"] = int(raw["quantity"])
+    if raw.get("unit_price") is not None:
+        raw["unit_price"] = int(raw["unit_price"])
+    if raw.get("estimate_date") is not None:
+        val = raw["estimate_date"]
+        if not isinstance(val, date):
+            raw["estimate_date"] = pd.to_datetime(str(val)).date()
+
+    return EstimateRecord(**raw)
@@ -1,86 +1,763 @@
+import asyncio
+import contextlib
+import logging
+import re
+import time
+from collections.abc import AsyncIterator
+from dataclasses import dataclass
+from datetime import datetime, timezone
+
 from qdrant_client import AsyncQdrantClient
 from qdrant_client.models import (
+    BinaryQuantization,
+    BinaryQuantizationConfig,
+    CollectionInfo,
+    CollectionStatus,
+    CreateAlias,
+    CreateAliasOperation,
+    DeleteAlias,
+    DeleteAliasOperation,
+    Disabled,
     Distance,
     Filter,
+    Fusion,
+    FusionQuery,
+    HnswConfigDiff,
+    Modifier,
+    OptimizersConfigDiff,
+    PayloadSchemaType,
+    PointIdsList,
     PointStruct,
+    Prefetch,
+    QuantizationSearchParams,
+    QueryRequest,
+    Sample,
+    SampleQuery,
+    ScalarQuantization,
+    ScalarQuantizationConfig,
+    ScalarType,
+    SearchParams,
+    SetPayload,
+    SetPayloadOperation,
+    SnapshotDescription,
+    SnapshotPriority,
+    SparseVectorParams,
     VectorParams,
+    VectorParamsDiff,
 )
 
 import config
+from services import embedding, sparse
+
+logger = logging.getLogger(__name__)
 
-_client = AsyncQdrantClient(host=config.QDRANT_HOST, port=config.QDRANT_PORT)
+# アプリ全体で共有するクライアント (lifespanのstart/closeで生成・破棄する)
+_client: AsyncQdrantClient | None = None
 
 _UPSERT_BATCH_SIZE = 100
+_RETRIEVE_BATCH_SIZE = 1000
+
+# コレクションが疎ベクトルを持つか (ensure_collectionで判定)
+_sparse_enabled = False
+
+# エイリアスの切り替え中に処理を待たせるための状態 (同一プロセス内のみ有効なため、エイリアスの切り替えは
+# 取り込みを行うrag-apiのプロセスでだけ行う。CLIからはAPIに依頼する)。
+# エイリアス経由の書き込みは reindex の最終追い上げから切り替えまで、検索などの読み込みは
+# エイリアス導入前のコレクションをエイリアスに置き換える間だけ止める
+_writes_open = asyncio.Event()
+_writes_open.set()
+_writes_idle = asyncio.Event()
+_writes_idle.set()
+_active_writes = 0
+_reads_open = asyncio.Event()
+_reads_open.set()
+
+# バージョン付きコレクションの状態 (コレクションのmetadataの "status")
+BUILDING = "building"
+READY = "ready"
+FAILED = "failed"
+
+# フィルタ検索 (extract_filters) で絞り込むpayloadフィールドのインデックス
+_PAYLOAD_INDEXES: dict[str, PayloadSchemaType] = {
+    "material": PayloadSchemaType.KEYWORD,
+    "diameter_mm": PayloadSchemaType.FLOAT,
+    "length_mm": PayloadSchemaType.FLOAT,
+    "weight_kg": PayloadSchemaType.FLOAT,
+}
+
+# ストレージプロファイル: 量子化ベクトルをRAMに置き、元ベクトルで再スコアリングする
+_STORAGE_PROFILES: dict[str, ScalarQuantization | BinaryQuantization | None] = {
+    "default": None,
+    "scalar": ScalarQuantization(
+        scalar=ScalarQuantizationConfig(type=ScalarType.INT8, quantile=0.99, always_ram=True)
+    ),
+    "binary": BinaryQuantization(binary=BinaryQuantizationConfig(always_ram=True)),
+}
+
+
+async def start() -> None:
+    """共有クライアントを作成する (接続はまだ行わない)。"""
+    global _client
+    if _client is None:
+        _client = _new_client()
+
+
+async def close() -> None:
+    """共有クライアントを閉じる。"""
+    global _client
+    if _client is not None:
+        client, _client = _client, None
+        await client.close()
+
+
+def _new_client() -> AsyncQdrantClient:
+    if config.QDRANT_LOCATION == ":memory:":
+        return AsyncQdrantClient(location=":memory:")
+    if config.QDRANT_LOCATION:
+        return AsyncQdrantClient(path=config.QDRANT_LOCATION)
+    # バージョン確認の同期リクエストを生成時に行わない (Qdrantの起動待ちで止まらないように)。
+    # サーバーとクライアントのバージョン不一致の警告も出なくなるため、docker-composeでサーバーのバージョンを
+    # requirements.txt の qdrant-client に合わせて固定している
+    return AsyncQdrantClient(host=config.QDRANT_HOST, port=config.QDRANT_PORT, check_compatibility=False)
+
+
+def _get_client() -> AsyncQdrantClient:
+    # lifespan外 (スクリプトなど) から呼ばれた場合も使えるよう、未作成なら作る
+    global _client
+    if _client is None:
+        _client = _new_client()
+    return _client
 
 
 async def ensure_collection() -> None:
-    """コレクションが存在しなければ作成する。"""
-    collections = [c.name for c in (await _client.get_collections()).collections]
-    if config.QDRANT_COLLECTION not in collections:
-        await _client.create_collection(
-            collection_name=config.QDRANT_COLLECTION,
-            vectors_config=VectorParams(
-                size=config.EMBEDDING_DIMENSION,
-                distance=Distance.COSINE,
-            ),
+    """コレクションのスキーマを設定に合わせる（起動時のマイグレーション）。
+
+    QDRANT_COLLECTION はバージョン付きコレクション ("<名前>_v<N>") を指すエイリアスとし、
+    どちらもなければ "_v1" を作成してエイリアスを張る。エイリアス導入前の同名コレクションはそのまま使う
+    (再インデックスの最初に "_v<N>" へ移してエイリアスに置き換える)。
+    エイリアスの指すコレクションが別のEmbeddingモデルで作られている場合は、現在のモデルで作られた
+    検証済みのバージョンに、その後の変更を追い上げてから切り替える (なければ起動を中止する)。
+    その上で、HNSW/オプティマイザ設定とpayloadインデックスの差分を検出して設定に揃える。
+    """
+    active = await active_collection()
+    if active == config.QDRANT_COLLECTION:
+        collections = [c.name for c in (await _get_client().get_collections()).collections]
+        if active not in collections:
+            active = await create_version(1)
+            await _set_alias(active)
+    else:
+        active = await _ensure_model_matches(active)
+
+    await _reconcile_collection(active)
+
+
+async def _ensure_model_matches(active: str) -> str:
+    built_with = (await collection_metadata(active)).get("embedding_model")
+    if built_with in (None, embedding.model_name()):
+        return active
+    for version in reversed(await list_versions()):
+        if version["status"] == READY and version["embedding_model"] == embedding.model_name():
+            logger.info(
+                "'%s' was built with %s; switching '%s' to '%s' built with %s",
+                active, built_with, config.QDRANT_COLLECTION, version["collection"], embedding.model_name(),
+            )
+            # 再インデックスの完了後に古いバージョンへ取り込まれた変更・削除を反映してから切り替える
+            # (reindex は qdrant を使うため、循環importを避けてここで読み込む)
+            from services import reindex
+
+            caught_up = await reindex.catch_up_and_switch(active, version["collection"])
+            logger.info("Caught up %d points changed in '%s' since the reindex", caught_up, active)
+            return version["collection"]
+    raise RuntimeError(
+        f"Collection '{active}' was built with embedding model {built_with}, "
+        f"but the configured model is {embedding.model_name()}. "
+        "Run `python -m services.reindex run` with the new settings first, or switch the settings back."
+    )
+
+
+async def _reconcile_collection(name: str) -> None:
+    """既存コレクションと設定の差分 (drift) を検出し、変更可能なものは揃える。"""
+    global _sparse_enabled
+
+    info = await _get_client().get_collection(name)
+    params = info.config.params
+
+    dimension = embedding.dimension()
+    if params.vectors.size != dimension:
+        raise RuntimeError(
+            f"Collection '{name}' has vector size {params.vectors.size}, "
+            f"but embedding backend '{config.EMBEDDING_BACKEND}' produces {dimension}. "
+            "Reindex the collection or switch the backend back "
+            "(EMBEDDING_OUTPUT_DIMENSION also changes the vector size)."
+        )
+
+    has_sparse = config.SPARSE_VECTOR_NAME in (params.sparse_vectors or {})
+    if config.HYBRID_SEARCH and not has_sparse:
+        # 既存コレクションに名前付きベクトルは追加できないため、再インデックスするまで密ベクトルのみで検索する
+        logger.warning(
+            "Collection '%s' has no sparse vector '%s'; hybrid search is disabled until it is reindexed",
+            name,
+            config.SPARSE_VECTOR_NAME,
         )
+    _sparse_enabled = config.HYBRID_SEARCH and has_sparse
+
+    hnsw = _hnsw_config()
+    if _drifted(hnsw, info.config.hnsw_config):
+        logger.info("Updating HNSW config of '%s': %s", name, hnsw)
+        await _get_client().update_collection(name, hnsw_config=hnsw)
+
+    optimizers = _optimizers_config()
+    if _drifted(optimizers, info.config.optimizer_config):
+        logger.info("Updating optimizer config of '%s': %s", name, optimizers)
+        await _get_client().update_collection(name, optimizers_config=optimizers)
+
+    # ストレージプロファイル: 量子化と元ベクトルのディスク配置は既存コレクションにも適用できる
+    # （適用後、Qdrantがバックグラウンドでセグメントを再構築する）
+    quantization = _quantization_config()
+    if _quantization_kind(quantization) != _quantization_kind(info.config.quantization_config):
+        logger.info("Applying storage profile '%s' to '%s'", config.QDRANT_STORAGE_PROFILE, name)
+        await _get_client().update_collection(name, quantization_config=quantization or Disabled.DISABLED)
+
+    if bool(params.vectors.on_disk) != config.QDRANT_VECTORS_ON_DISK:
+        logger.info("Setting on_disk=%s for vectors of '%s'", config.QDRANT_VECTORS_ON_DISK, name)
+        await _get_client().update_collection(
+            name, vectors_config={"": VectorParamsDiff(on_disk=config.QDRANT_VECTORS_ON_DISK)}
+        )
+
+    await _ensure_payload_indexes(name, info.payload_schema or {})
+
+
+async def _ensure_payload_indexes(name: str, schema: dict) -> None:
+    for field_name, field_type in _PAYLOAD_INDEXES.items():
+        current = schema.get(field_name)
+        if current is not None and current.data_type == field_type:
+            continue
+        if current is not None:
+            logger.info("Recreating payload index '%s' as %s", field_name, field_type.value)
+            await _get_client().delete_payload_index(name, field_name)
+        else:
+            logger.info("Creating payload index '%s' (%s)", field_name, field_type.value)
+        await _get_client().create_payload_index(name, field_name=field_name, field_schema=field_type, wait=True)
+
+
+def version_name(version: int) -> str:
+    """バージョン番号に対応するコレクション名 ("<QDRANT_COLLECTION>_v<N>")。"""
+    return f"{config.QDRANT_COLLECTION}_v{version}"
+
+
+async def active_collection() -> str:
+    """QDRANT_COLLECTION のエイリアスが指すコレクション名。エイリアスがなければ QDRANT_COLLECTION そのもの。"""
+    for alias in (await _get_client().get_aliases()).aliases:
+        if alias.alias_name == config.QDRANT_COLLECTION:
+            return alias.collection_name
+    return config.QDRANT_COLLECTION
+
+
+async def collection_info(name: str) -> CollectionInfo:
+    """コレクションの情報 (設定・件数など)。"""
+    return await _get_client().get_collection(name)
+
+
+async def collection_metadata(name: str) -> dict:
+    """コレクションのmetadata (Embeddingモデル・状態など)。エイリアス導入前のコレクションでは空。"""
+    return (await _get_client().get_collection(name)).config.metadata or {}
+
+
+async def list_versions() -> list[dict]:
+    """バージョン付きコレクションの一覧をバージョン順に返す。"""
+    active = await active_collection()
+    pattern = re.compile(re.escape(config.QDRANT_COLLECTION) + r"_v(\d+)")
+    versions = []
+    for collection in (await _get_client().get_collections()).collections:
+        match = pattern.fullmatch(collection.name)
+        if match is None:
+            continue
+        info = await _get_client().get_collection(collection.name)
+        metadata = info.config.metadata or {}
+        versions.append({
+            "version": int(match[1]),
+            "collection": collection.name,
+            "active": collection.name == active,
+            "status": metadata.get("status"),
+            "embedding_model": metadata.get("embedding_model"),
+            "points": info.points_count,
+            "created_at": metadata.get("created_at"),
+            "recall": metadata.get("recall"),
+        })
+    return sorted(versions, key=lambda v: v["version"])
+
+
+async def create_version(version: int, building: bool = False, legacy_dimension: int | None = None) -> str:
+    """現在の設定でバージョン付きコレクションを作成し、その名前を返す。
+
+    building=True の場合は一括投入用にインデックス構築を止めて作る (finish_version で有効にする)。
+    legacy_dimension を指定すると、エイリアス導入前のコレクションをベクトルごと移すためのコレクションとして
+    その次元数で作る。作成したEmbeddingモデルは不明 (embedding_model が None) として記録する。
+    """
+    name = version_name(version)
+    dimension = legacy_dimension or embedding.dimension()
+    optimizers = _optimizers_config()
+    if building:
+        optimizers = optimizers.model_copy(update={"indexing_threshold": 0})
+    logger.info("Creating collection '%s'", name)
+    await _get_client().create_collection(
+        collection_name=name,
+        vectors_config=VectorParams(
+            size=dimension,
+            distance=Distance.COSINE,
+            on_disk=config.QDRANT_VECTORS_ON_DISK,
+        ),
+        sparse_vectors_config=_sparse_vectors_config(),
+        hnsw_config=_hnsw_config(),
+        optimizers_config=optimizers,
+        quantization_config=_quantization_config(),
+        metadata={
+            "status": BUILDING if building else READY,
+            "embedding_model": None if legacy_dimension else embedding.model_name(),
+            "dimension": dimension,
+            "created_at": datetime.now(timezone.utc).isoformat(),
+        },
+    )
+    # payloadインデックスは投入前に作る (投入後に作るとセグメントを走査し直すため)
+    await _ensure_payload_indexes(name, {})
+    return name
+
+
+async def finish_version(name: str, timeout: float) -> None:
+    """一括投入を終えたコレクションのインデックス構築を有効にし、最適化が終わる (green) まで待つ。"""
+    await _get_client().update_collection(name, optimizers_config=_optimizers_config())
+    deadline = time.monotonic() + timeout
+    # 設定の反映直後はまだgreenのままのことがあるため、少し待ってから確認する
+    await asyncio.sleep(1)
+    while (await _get_client().get_collection(name)).status != CollectionStatus.GREEN:
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"Indexing of '{name}' did not finish within {timeout:.0f}s")
+        await asyncio.sleep(5)
+
+
+async def set_version_metadata(name: str, **metadata) -> None:
+    """コレクションのmetadataを更新する (指定したキーのみ)。"""
+    await _get_client().update_collection(name, metadata=metadata)
+
+
+async def switch_alias(name: str) -> str:
+    """QDRANT_COLLECTION のエイリアスを name に切り替え、切り替え前のコレクション名を返す。
+
+    エイリアスの付け替えは1回のリクエストで行うため、検索が途中の状態を見ることはない。
+    切り替え後のコレクションについて、疎ベクトルの有無などを取り直す。
+    """
+    previous = await active_collection()
+    await _set_alias(name)
+    await _reconcile_collection(name)
+    return previous
+
+
+async def replace_legacy(name: str) -> None:
+    """エイリアス導入前の QDRANT_COLLECTION を削除し、同名のエイリアスで name (ベクトルごと移したコピー) を指す。
+
+    同名のコレクションとエイリアスは共存できないため、削除からエイリアス作成までの間は
+    このプロセスの検索・件数取得などを待たせる。
+    """
+    global _sparse_enabled
+    if await active_collection() != config.QDRANT_COLLECTION:
+        raise RuntimeError(f"'{config.QDRANT_COLLECTION}' is already an alias")
+    info = await _get_client().get_collection(name)
+    _reads_open.clear()
+    try:
+        logger.warning("Replacing legacy collection '%s' with an alias to '%s'", config.QDRANT_COLLECTION, name)
+        await _get_client().delete_collection(config.QDRANT_COLLECTION)
+        await _get_client().update_collection_aliases(change_aliases_operations=[_create_alias(name)])
+    finally:
+        _reads_open.set()
+    _sparse_enabled = config.HYBRID_SEARCH and config.SPARSE_VECTOR_NAME in (info.config.params.sparse_vectors or {})
+    logger.info("Alias '%s' now points to '%s'", config.QDRANT_COLLECTION, name)
+
+
+@contextlib.asynccontextmanager
+async def pause_writes() -> AsyncIterator[None]:
+    """このプロセスからのエイリアス経由の書き込みを止め、実行中の書き込みが終わるのを待つ。
+
+    reindex が最終の追い上げとエイリアスの切り替えを行う間に使う。止めた書き込みは抜けた後に
+    (切り替え後のコレクションへ) 行われる。
+    """
+    _writes_open.clear()
+    try:
+        await _writes_idle.wait()
+        yield
+    finally:
+        _writes_open.set()
+
+
+@contextlib.asynccontextmanager
+async def _alias_write(collection: str) -> AsyncIterator[None]:
+    global _active_writes
+    if collection != config.QDRANT_COLLECTION:
+        yield
+        return
+    while not _writes_open.is_set():
+        await _writes_open.wait()
+    _active_writes += 1
+    _writes_idle.clear()
+    try:
+        yield
+    finally:
+        _active_writes -= 1
+        if _active_writes == 0:
+            _writes_idle.set()
+
+
+async def _alias_read(collection: str = config.QDRANT_COLLECTION) -> None:
+    if collection == config.QDRANT_COLLECTION:
+        await _reads_open.wait()
+
+
+def _create_alias(name: str) -> CreateAliasOperation:
+    return CreateAliasOperation(create_alias=CreateAlias(collection_name=name, alias_name=config.QDRANT_COLLECTION))
+
+
+async def _set_alias(name: str) -> None:
+    operations = [_create_alias(name)]
+    if await active_collection() != config.QDRANT_COLLECTION:
+        operations.insert(0, DeleteAliasOperation(delete_alias=DeleteAlias(alias_name=config.QDRANT_COLLECTION)))
+    elif config.QDRANT_COLLECTION in [c.name for c in (await _get_client().get_collections()).collections]:
+        # エイリアス導入前のコレクションは、再インデックス (replace_legacy) でだけ置き換える
+        raise RuntimeError(
+            f"'{config.QDRANT_COLLECTION}' is a collection created before versioning; "
+            "run a reindex first to move it into a versioned collection"
+        )
+    await _get_client().update_collection_aliases(change_aliases_operations=operations)
+    logger.info("Alias '%s' now points to '%s'", config.QDRANT_COLLECTION, name)
+
+
+async def delete_version(name: str) -> None:
+    """バージョン付きコレクションを削除する。エイリアスが指しているものは削除しない。"""
+    if name == await active_collection():
+        raise ValueError(f"'{name}' is the active collection")
+    logger.info("Deleting collection '%s'", name)
+    await _get_client().delete_collection(name)
+
+
+async def sample_recall(name: str, samples: int, limit: int = config.SEARCH_LIMIT) -> float | None:
+    """ランダムに選んだポイントのベクトルで検索し、本番と同じ検索設定 (HNSW・量子化) の結果が
+    全件探索の結果とどれだけ一致するか (Recall@limit の平均) を返す。ポイントがなければ None。
+    """
+    sampled = await _get_client().query_points(
+        name, query=SampleQuery(sample=Sample.RANDOM), limit=samples, with_vectors=True, with_payload=False
+    )
+    vectors = [p.vector[""] if isinstance(p.vector, dict) else p.vector for p in sampled.points]
+    if not vectors:
+        return None
+    exact = SearchParams(exact=True, quantization=QuantizationSearchParams(ignore=True))
+    responses = await _get_client().query_batch_points(
+        name,
+        requests=[QueryRequest(query=v, params=_search_params(), limit=limit) for v in vectors]
+        + [QueryRequest(query=v, params=exact, limit=limit) for v in vectors],
+    )
+    recalls = []
+    for approximate, truth in zip(responses[: len(vectors)], responses[len(vectors) :]):
+        expected = {p.id for p in truth.points}
+        recalls.append(len(expected & {p.id for p in approximate.points}) / len(expected))
+    return sum(recalls) / len(recalls)
+
+
+def _quantization_config() -> ScalarQuantization | BinaryQuantization | None:
+    if config.QDRANT_STORAGE_PROFILE not in _STORAGE_PROFILES:
+        raise ValueError(f"Unknown QDRANT_STORAGE_PROFILE: {config.QDRANT_STORAGE_PROFILE}")
+    return _STORAGE_PROFILES[config.QDRANT_STORAGE_PROFILE]
+
+
+def _quantization_kind(quantization) -> str | None:
+    if isinstance(quantization, ScalarQuantization):
+        return "scalar"
+    if isinstance(quantization, BinaryQuantization):
+        return "binary"
+    return None
+
+
+def _search_params() -> SearchParams | None:
+    """量子化プロファイルでは、候補をoversamplingして元ベクトルで再スコアリングする。"""
+    if _quantization_config() is None:
+        return None
+    return SearchParams(
+        quantization=QuantizationSearchParams(
+            rescore=config.QUANTIZATION_RESCORE,
+            oversampling=config.QUANTIZATION_OVERSAMPLING,
+        )
+    )
+
+
+def _hnsw_config() -> HnswConfigDiff:
+    return HnswConfigDiff(
+        m=config.HNSW_M,
+        ef_construct=config.HNSW_EF_CONSTRUCT,
+        full_scan_threshold=config.HNSW_FULL_SCAN_THRESHOLD,
+    )
+
+
+def _optimizers_config() -> OptimizersConfigDiff:
+    return OptimizersConfigDiff(
+        indexing_threshold=config.QDRANT_INDEXING_THRESHOLD,
+        default_segment_number=config.QDRANT_DEFAULT_SEGMENT_NUMBER,
+    )
+
+
+def _drifted(desired, current) -> bool:
+    """desiredで指定された項目のうち、currentと値が異なるものがあるか。"""
+    if current is None:
+        return True
+    return any(
+        getattr(current, key, None) != value
+        for key, value in desired.model_dump(exclude_none=True).items()
+    )
+
+
+def _sparse_vectors_config() -> dict[str, SparseVectorParams] | None:
+    if not config.HYBRID_SEARCH:
+        return None
+    return {config.SPARSE_VECTOR_NAME: SparseVectorParams(modifier=Modifier.IDF)}
+
+
+def _has_sparse(collection: str) -> bool:
+    # 再インデックス中の新しいバージョンは現在の設定 (HYBRID_SEARCH) で作られている
+    return _sparse_enabled if collection == config.QDRANT_COLLECTION else config.HYBRID_SEARCH
+
+
+def _vector_schema(collection: str = config.QDRANT_COLLECTION) -> str:
+    """ポイントが持つベクトルの種類。変わった場合はベクトルを作り直す必要がある。"""
+    return "dense+sparse" if _has_sparse(collection) else "dense"
 
 
 async def upsert_points(
-    ids: list[int], vectors: list[list[float]], payloads: list[dict]
+    ids: list[int],
+    vectors: list[list[float]],
+    payloads: list[dict],
+    concurrency: int = 1,
+    collection: str = config.QDRANT_COLLECTION,
 ) -> None:
-    """ポイントをバッチ分割してupsertする。"""
-    for i in range(0, len(ids), _UPSERT_BATCH_SIZE):
-        batch_ids = ids[i : i + _UPSERT_BATCH_SIZE]
-        batch_vectors = vectors[i : i + _UPSERT_BATCH_SIZE]
-        batch_payloads = payloads[i : i + _UPSERT_BATCH_SIZE]
-        points = [
-            PointStruct(id=id_, vector=vector, payload=payload)
-            for id_, vector, payload in zip(batch_ids, batch_vectors, batch_payloads)
-        ]
-        await _client.upsert(collection_name=config.QDRANT_COLLECTION, points=points)
+    """ポイントをバッチ分割してupsertする。疎ベクトルはpayloadのtextから生成する。
+
+    concurrency > 1 の場合は最大その数のバッチを並行して送る。
+    """
+    schema = _vector_schema(collection)
+    with_sparse = _has_sparse(collection)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def upsert_batch(i: int) -> None:
+        async with semaphore:
+            points = [
+                PointStruct(
+                    id=id_,
+                    vector=_point_vectors(vector, payload, with_sparse),
+                    payload={**payload, "vector_schema": schema},
+                )
+                for id_, vector, payload in zip(
+                    ids[i : i + _UPSERT_BATCH_SIZE],
+                    vectors[i : i + _UPSERT_BATCH_SIZE],
+                    payloads[i : i + _UPSERT_BATCH_SIZE],
+                )
+            ]
+            await _get_client().upsert(collection_name=collection, points=points)
+
+    async with _alias_write(collection), asyncio.TaskGroup() as tg:
+        for i in range(0, len(ids), _UPSERT_BATCH_SIZE):
+            tg.create_task(upsert_batch(i))
+
+
+async def delete_points(ids: list[int], collection: str = config.QDRANT_COLLECTION) -> None:
+    """指定IDのポイントを削除する。"""
+    async with _alias_write(collection):
+        for i in range(0, len(ids), _UPSERT_BATCH_SIZE):
+            await _get_client().delete(
+                collection_name=collection, points_selector=PointIdsList(points=ids[i : i + _UPSERT_BATCH_SIZE])
+            )
+
+
+def _point_vectors(vector: list[float], payload: dict, with_sparse: bool):
+    if not with_sparse:
+        return vector
+    return {"": vector, config.SPARSE_VECTOR_NAME: sparse.sparse_vector(payload["text"])}
+
+
+@dataclass
+class SearchQuery:
+    """query_batch_pointsでまとめて実行する検索1件分。"""
+
+    vector: list[float]
+    limit: int = config.SEARCH_LIMIT
+    query_filter: Filter | None = None
+    text: str | None = None
 
 
 async def search(
     vector: list[float],
     limit: int = config.SEARCH_LIMIT,
     query_filter: Filter | None = None,
+    text: str | None = None,
 ) -> list[dict]:
-    """ベクトル類似検索を行い結果を返す。"""
-    results = await _client.query_points(
+    """ベクトル類似検索を行い結果を返す。
+
+    textが与えられ、コレクションが疎ベクトルを持つ場合は、密ベクトル検索とキーワード
+    (疎ベクトル) 検索の候補を1回のクエリ内でRRF融合する。
+    """
+    return (await search_batch([SearchQuery(vector, limit, query_filter, text)]))[0]
+
+
+async def search_batch(queries: list[SearchQuery]) -> list[list[dict]]:
+    """複数の検索を1回のリクエスト (query_batch_points) で実行し、クエリ順に結果を返す。"""
+    if not queries:
+        return []
+    await _alias_read()
+    responses = await _get_client().query_batch_points(
         collection_name=config.QDRANT_COLLECTION,
-        query=vector,
-        query_filter=query_filter,
-        limit=limit,
-        with_payload=True,
+        requests=[_query_request(q) for q in queries],
     )
     return [
-        {"id": point.id, "score": point.score, **point.payload}
-        for point in results.points
+        [{"id": point.id, "score": point.score, **point.payload} for point in response.points]
+        for response in responses
     ]
 
 
-async def count() -> int:
-    """コレクション内のポイント数を返す。"""
-    info = await _client.get_collection(config.QDRANT_COLLECTION)
+def _query_request(q: SearchQuery) -> QueryRequest:
+    if q.text and _sparse_enabled:
+        candidates = q.limit * config.HYBRID_PREFETCH_FACTOR
+        return QueryRequest(
+            prefetch=[
+                Prefetch(
+                    query=q.vector, filter=q.query_filter, params=_search_params(), limit=candidates
+                ),
+                Prefetch(
+                    query=sparse.sparse_vector(q.text),
+                    using=config.SPARSE_VECTOR_NAME,
+                    filter=q.query_filter,
+                    limit=candidates,
+                ),
+            ],
+            query=FusionQuery(fusion=Fusion.RRF),
+            limit=q.limit,
+            with_payload=True,
+        )
+    return QueryRequest(
+        query=q.vector,
+        filter=q.query_filter,
+        params=_search_params(),
+        limit=q.limit,
+        with_payload=True,
+    )
+
+
+async def scroll_points(
+    batch_size: int = 1000, collection: str = config.QDRANT_COLLECTION, with_vectors: bool = True
+) -> AsyncIterator[list[tuple[int, list[float] | None, dict]]]:
+    """全ポイントを (id, 密ベクトル, payload) のバッチで順に返す (scrollでページングする)。
+
+    with_vectors=False の場合、ベクトルは None。
+    """
+    await _alias_read(collection)
+    offset = None
+    while True:
+        points, offset = await _get_client().scroll(
+            collection_name=collection,
+            limit=batch_size,
+            offset=offset,
+            with_payload=True,
+            with_vectors=with_vectors,
+        )
+        if points:
+            yield [
+                # 疎ベクトルを持つコレクションでは密ベクトルは名前なし ("") のベクトル
+                (p.id, p.vector[""] if isinstance(p.vector, dict) else p.vector, p.payload or {})
+                for p in points
+            ]
+        if offset is None:
+            return
+
+
+async def create_snapshot() -> SnapshotDescription:
+    """Qdrantのネイティブスナップショットを作成する (Qdrantのストレージ内に保存される)。"""
+    name = await active_collection()
+    snapshot = await _get_client().create_snapshot(name, wait=True)
+    logger.info("Created snapshot %s of '%s'", snapshot.name, name)
+    return snapshot
+
+
+async def list_snapshots() -> list[SnapshotDescription]:
+    """コレクションのスナップショット一覧を返す。"""
+    return await _get_client().list_snapshots(await active_collection())
+
+
+async def recover_snapshot(location: str) -> None:
+    """スナップショット (Qdrantから見たURLまたは file:// パス) からコレクションを復元する。
+
+    エイリアスの指すコレクションに復元し、起動時と同じスキーマの調整を行う。
+    """
+    name = await active_collection()
+    logger.info("Recovering '%s' from snapshot %s", name, location)
+    await _get_client().recover_snapshot(name, location, priority=SnapshotPriority.SNAPSHOT, wait=True)
+    await _reconcile_collection(name)
+
+
+async def count(collection: str = config.QDRANT_COLLECTION, exact: bool = False) -> int:
+    """コレクション内のポイント数を返す。exact=False ではコレクション情報の (概算の) 件数。"""
+    await _alias_read(collection)
+    if exact:
+        return (await _get_client().count(collection, exact=True)).count
+    info = await _get_client().get_collection(collection)
     return info.points_count
 
 
-async def get_existing_ids(ids: list[int]) -> set[int]:
-    """指定IDリストのうち、既にQdrantに存在するIDのセットを返す。"""
-    try:
-        results = await _client.retrieve(
-            collection_name=config.QDRANT_COLLECTION, ids=ids
+async def distinct_values(key: str, limit: int = 10000) -> list[str]:
+    """payloadフィールドの値の一覧を返す (keywordインデックスのfacetを使う)。"""
+    await _alias_read()
+    response = await _get_client().facet(
+        collection_name=config.QDRANT_COLLECTION, key=key, limit=limit, exact=True
+    )
+    return [str(hit.value) for hit in response.hits]
+
+
+async def get_fingerprints(
+    ids: list[int], collection: str = config.QDRANT_COLLECTION
+) -> dict[int, tuple[str | None, str | None]]:
+    """指定IDのうち既存ポイントについて、{id: (text_hash, payload_hash)} を返す。
+
+    フィンガープリント導入前に登録されたポイントや、ベクトルの種類が現在の設定と
+    異なるポイントは text_hash が None となり、再Embedding対象になる。
+    """
+    await _alias_read(collection)
+    schema = _vector_schema(collection)
+    fingerprints: dict[int, tuple[str | None, str | None]] = {}
+    # コレクションがまだない場合だけ既存ポイントなしとする。通信エラーなどは呼び出し元に伝える
+    # (全件を新規として扱うと、カタログ全体を再Embeddingし件数も誤るため)
+    if not await _get_client().collection_exists(collection):
+        return fingerprints
+    for i in range(0, len(ids), _RETRIEVE_BATCH_SIZE):
+        points = await _get_client().retrieve(
+            collection_name=collection,
+            ids=ids[i : i + _RETRIEVE_BATCH_SIZE],
+            with_payload=["text_hash", "payload_hash", "vector_schema"],
+            with_vectors=False,
         )
-        return {point.id for point in results}
-    except Exception:
-        return set()
+        for point in points:
+            payload = point.payload or {}
+            text_hash = payload.get("text_hash") if payload.get("vector_schema") == schema else None
+            fingerprints[point.id] = (text_hash, payload.get("payload_hash"))
+    return fingerprints
 
 
-async def is_healthy() -> bool:
-    """Qdrantへの接続が正常か確認する。"""
-    try:
-        await _client.get_collections()
-        return True
-    except Exception:
-        return False
+async def update_payloads(ids: list[int], payloads: list[dict]) -> None:
+    """ベクトルはそのままに、payloadのフィールドだけをバッチで書き換える。"""
+    async with _alias_write(config.QDRANT_COLLECTION):
+        for i in range(0, len(ids), _UPSERT_BATCH_SIZE):
+            operations = [
+                SetPayloadOperation(set_payload=SetPayload(payload=payload, points=[id_]))
+                for id_, payload in zip(
+                    ids[i : i + _UPSERT_BATCH_SIZE], payloads[i : i + _UPSERT_BATCH_SIZE]
+                )
+            ]
+            await _get_client().batch_update_points(
+                collection_name=config.QDRANT_COLLECTION, update_operations=operations
+            )
+
+
+async def ping() -> None:
+    """Qdrantに接続できるか確認する (ヘルスチェック用)。接続できなければ例外。"""
+    await _get_client().get_collections()
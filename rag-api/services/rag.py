@@ -1,92 +1,558 @@
+import asyncio
 import logging
+import time
+from collections.abc import AsyncIterator, Iterator
+from dataclasses import dataclass, field
+from typing import Awaitable, TypeVar
 
 from qdrant_client.models import FieldCondition, Filter, MatchValue
 
+import config
 from models.estimate import EstimateRecord, ImportResult
-from services import embedding, llm, qdrant
-from services.filter import extract_filters
+from services import answer_cache, embedding, llm, metrics, qdrant, rerank
+from services.filter import (
+    build_filter,
+    canonical_material,
+    extract_by_rules,
+    extract_filters,
+    matches,
+    refresh_materials,
+)
 
 logger = logging.getLogger(__name__)
 
+T = TypeVar("T")
+
+NO_RESULTS_MESSAGE = "該当するデータが見つかりませんでした。"
+
+# フィルタ付き検索の結果がこれより少ない場合、フィルタなしの結果で補う
+_MIN_FILTERED_RESULTS = 2
+
+
+@dataclass
+class Retrieval:
+    """回答生成の前段 (Embedding・フィルタ抽出・ベクトル検索) の結果。"""
+
+    query: str
+    vector: list[float]
+    filter: Filter | None
+    results: list[dict]
+    timings: dict[str, float]
+    # 類似案件の単価の統計 (rerank.price_stats)
+    price_stats: dict | None = None
+    # 規則で確定できなかったフィルタ抽出を回答生成の呼び出しにまとめた (LLM_COMBINED_MODE)
+    filter_deferred: bool = False
+
 
 async def search(query: str, limit: int = 5, material_filter: str | None = None) -> dict:
     """クエリテキストで類似検索し、LLMで回答を生成する。"""
-    query_vector = await embedding.embed_text(query)
-    query_filter = await extract_filters(query)
-
-    # 明示的なmaterialパラメータがある場合、フィルタに追加/上書き
-    if material_filter:
-        material_cond = FieldCondition(key="material", match=MatchValue(value=material_filter))
-        if query_filter and query_filter.must:
-            # 既存のmaterial条件を除去して上書き
-            query_filter.must = [c for c in query_filter.must if getattr(c, 'key', None) != 'material']
-            query_filter.must.append(material_cond)
-        else:
-            query_filter = Filter(must=[material_cond])
-    logger.info("Extracted filter: %s", query_filter)
-    results = await qdrant.search(query_vector, limit=limit, query_filter=query_filter)
+    retrieval = await retrieve(
+        query, limit=limit, material_filter=material_filter, defer_filters=config.LLM_COMBINED_MODE
+    )
+    timings = retrieval.timings
 
-    # フィルタ付きで結果が少ない場合、フィルタなしで再検索
-    if len(results) < 2 and query_filter is not None:
-        logger.info("Too few results with filter, retrying without filter")
-        results = await qdrant.search(query_vector, limit=limit)
-
-    if not results:
+    if not retrieval.results:
+        logger.info("Search timings (ms): %s", timings)
         return {
             "results": [],
-            "answer": "該当するデータが見つかりませんでした。",
+            "price_stats": None,
+            "answer": NO_RESULTS_MESSAGE,
+            "timings": timings,
         }
 
-    context = _build_context(results)
-    answer = await llm.generate_answer(query, context)
+    answer = await answer_retrieval(retrieval)
+    logger.info("Search timings (ms): %s", timings)
 
     return {
-        "results": results,
+        "results": retrieval.results,
+        "price_stats": retrieval.price_stats,
         "answer": answer,
+        "timings": timings,
     }
 
 
-async def import_records(records: list[EstimateRecord]) -> ImportResult:
-    """レコードリストをEmbedding化してQdrantにupsertする。"""
+async def retrieve(
+    query: str,
+    limit: int = 5,
+    material_filter: str | None = None,
+    defer_filters: bool = False,
+) -> Retrieval:
+    """クエリをEmbeddingし、抽出したフィルタ条件で類似検索する (回答生成の手前まで)。
+
+    Embeddingとフィルタ抽出は互いに独立しているため並行実行する。
+    フィルタ抽出が失敗・タイムアウトした場合はフィルタなしで検索を続行する。
+    defer_filtersの場合、規則で確定できないクエリはLLMでのフィルタ抽出を行わずにフィルタなしで
+    検索し、条件の抽出は回答生成と同じ呼び出しで行う (answer_retrieval)。
+    """
+    timings: dict[str, float] = {}
+    deferred = defer_filters and not material_filter and extract_by_rules(query) is None
+
+    embed_task = asyncio.create_task(
+        _run_stage("embed", embedding.embed_text(query), config.EMBED_TIMEOUT, timings)
+    )
+    filter_task = None
+    if not deferred:
+        filter_task = asyncio.create_task(
+            _run_stage(
+                "extract_filters",
+                extract_filters(query),
+                config.FILTER_EXTRACTION_TIMEOUT,
+                timings,
+            )
+        )
+
+    try:
+        query_vector = await embed_task
+    except BaseException:
+        # ベクトルがなければ検索できないため、フィルタ抽出も打ち切る
+        if filter_task is not None:
+            filter_task.cancel()
+        raise
+
+    query_filter = None
+    if filter_task is not None:
+        try:
+            query_filter = await filter_task
+        except Exception:
+            logger.warning("Filter extraction failed, continuing without filter", exc_info=True)
+
+    query_filter = _with_material(query_filter, material_filter)
+    logger.info("Extracted filter: %s", query_filter)
+    [candidates] = await _run_stage(
+        "qdrant.search",
+        _search([(query, query_vector, query_filter)], _candidate_limit(limit)),
+        config.QDRANT_SEARCH_TIMEOUT,
+        timings,
+    )
+
+    with metrics.stage("rerank"):
+        results, stats = _rerank(candidates, query_filter, limit)
+    return Retrieval(query, query_vector, query_filter, results, timings, stats, deferred)
+
+
+async def retrieve_batch(
+    queries: list[str], limit: int = 5, material_filter: str | None = None
+) -> list[Retrieval]:
+    """複数のクエリをまとめて検索する (回答生成の手前まで)。
+
+    Embeddingは1回のバッチ呼び出し、フィルタ抽出は並行実行 (LLM呼び出しは
+    SEARCH_BATCH_CONCURRENCYまで)、Qdrant検索 (フィルタなしの補完分を含む) は
+    1回のquery_batch_pointsで行う。
+    timingsの各ステージはバッチ全体の所要時間。
+    """
+    timings: dict[str, float] = {}
+    if not queries:
+        return []
+    semaphore = asyncio.Semaphore(config.SEARCH_BATCH_CONCURRENCY)
+
+    async def extract(query: str) -> Filter | None:
+        async with semaphore:
+            try:
+                return await asyncio.wait_for(extract_filters(query), config.FILTER_EXTRACTION_TIMEOUT)
+            except Exception:
+                logger.warning("Filter extraction failed, continuing without filter", exc_info=True)
+                return None
+
+    async def extract_all() -> list[Filter | None]:
+        return await asyncio.gather(*(extract(q) for q in queries))
+
+    # タイムアウトはバッチ数・LLMの同時呼び出し数に応じて延ばす
+    embed_task = asyncio.create_task(
+        _run_stage(
+            "embed",
+            embedding.embed_texts(queries),
+            config.EMBED_TIMEOUT * -(-len(queries) // config.EMBEDDING_BATCH_SIZE),
+            timings,
+        )
+    )
+    filter_task = asyncio.create_task(
+        _run_stage(
+            "extract_filters",
+            extract_all(),
+            config.FILTER_EXTRACTION_TIMEOUT * -(-len(queries) // config.SEARCH_BATCH_CONCURRENCY),
+            timings,
+        )
+    )
+
+    try:
+        vectors = await embed_task
+    except BaseException:
+        filter_task.cancel()
+        raise
+
+    filters = [_with_material(f, material_filter) for f in await filter_task]
+
+    all_candidates = await _run_stage(
+        "qdrant.search",
+        _search(list(zip(queries, vectors, filters)), _candidate_limit(limit)),
+        config.QDRANT_SEARCH_TIMEOUT,
+        timings,
+    )
+
+    retrievals = []
+    with metrics.stage("rerank"):
+        for q, v, f, candidates in zip(queries, vectors, filters, all_candidates):
+            results, stats = _rerank(candidates, f, limit)
+            retrievals.append(Retrieval(q, v, f, results, dict(timings), stats))
+    return retrievals
+
+
+async def answer_retrieval(retrieval: Retrieval) -> str:
+    """検索結果からLLMで回答を生成する。同じ条件・同じ検索結果の回答がキャッシュにあれば返す。
+
+    LLM_COMBINED_MODE で回答と同時に抽出した条件は回答と一緒にキャッシュし、ヒット時にも適用する
+    (キャッシュの有無で filter_matched や並び順が変わらないように)。
+    """
+    cached = answer_cache.lookup(
+        retrieval.query, retrieval.vector, retrieval.filter, retrieval.results,
+        retrieval.price_stats,
+    )
+    if cached is not None:
+        logger.info("Answer cache hit")
+        answer, refined = cached
+        if refined and retrieval.filter_deferred:
+            _apply_refined_filter(retrieval, dict(refined))
+        return answer
+    context = _build_context(retrieval.results, retrieval.price_stats)
+    refined: dict = {}
+    if retrieval.filter_deferred:
+        answer, refined = await _run_stage(
+            "generate_answer",
+            llm.generate_answer_with_filters(retrieval.query, context),
+            config.LLM_TIMEOUT,
+            retrieval.timings,
+        )
+    else:
+        answer = await _run_stage(
+            "generate_answer",
+            llm.generate_answer(retrieval.query, context),
+            config.LLM_TIMEOUT,
+            retrieval.timings,
+        )
+    answer_cache.store(
+        retrieval.query, retrieval.vector, retrieval.filter, retrieval.results, answer,
+        retrieval.price_stats, refined or None,
+    )
+    if refined:
+        _apply_refined_filter(retrieval, dict(refined))
+    return answer
+
+
+def _apply_refined_filter(retrieval: Retrieval, raw: dict) -> None:
+    """回答と同時に抽出した条件で、検索結果に filter_matched を付けて一致するものを先頭にする。"""
+    if raw.get("material"):
+        raw["material"] = canonical_material(raw["material"])
+    refined = build_filter(raw)
+    if refined is None:
+        return
+    logger.info("Refined filter from the answer call: %s", refined)
+    retrieval.filter = refined
+    marked = [{**r, "filter_matched": matches(raw, r)} for r in retrieval.results]
+    retrieval.results = sorted(marked, key=lambda r: not r["filter_matched"])
+
+
+async def stream_answer(retrieval: Retrieval) -> AsyncIterator[str]:
+    """LLM回答をストリーミング生成し、断片が届くたびにそれまでの全文を返す。
+
+    回答キャッシュにヒットした場合は全文を1回だけ返す。全体の生成時間はLLM_TIMEOUTで打ち切る。
+    """
+    cached = answer_cache.lookup(
+        retrieval.query, retrieval.vector, retrieval.filter, retrieval.results,
+        retrieval.price_stats,
+    )
+    if cached is not None:
+        logger.info("Answer cache hit")
+        yield cached[0]
+        return
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + config.LLM_TIMEOUT
+    start = time.perf_counter()
+    stream = llm.stream_answer(
+        retrieval.query, _build_context(retrieval.results, retrieval.price_stats)
+    )
+    answer = ""
+    try:
+        while True:
+            try:
+                chunk = await asyncio.wait_for(anext(stream), deadline - loop.time())
+            except StopAsyncIteration:
+                break
+            if not answer:
+                retrieval.timings["generate_answer.first_chunk"] = round(
+                    (time.perf_counter() - start) * 1000, 1
+                )
+            answer += chunk
+            yield answer
+    finally:
+        elapsed = time.perf_counter() - start
+        retrieval.timings["generate_answer"] = round(elapsed * 1000, 1)
+        metrics.STAGE_SECONDS.labels("generate_answer").observe(elapsed)
+        await stream.aclose()
+    if answer:
+        answer_cache.store(
+            retrieval.query, retrieval.vector, retrieval.filter, retrieval.results, answer,
+            retrieval.price_stats,
+        )
+
+
+async def _search(
+    items: list[tuple[str, list[float], Filter | None]], limit: int
+) -> list[list[dict]]:
+    """(クエリ, ベクトル, フィルタ) ごとに検索する。全件を1回のquery_batch_pointsで実行する。
+
+    フィルタがある場合はフィルタなしの検索も同じリクエストに含め、フィルタ付きの
+    結果が _MIN_FILTERED_RESULTS 件未満ならフィルタなしの結果で補う (_merge_fallback)。
+    """
+    requests = []
+    for query, vector, query_filter in items:
+        requests.append(qdrant.SearchQuery(vector, limit, query_filter, query))
+        if query_filter is not None:
+            requests.append(qdrant.SearchQuery(vector, limit, text=query))
+    responses = iter(await qdrant.search_batch(requests))
+
+    merged = []
+    for _, _, query_filter in items:
+        results = next(responses)
+        if query_filter is not None:
+            results = _merge_fallback(results, next(responses), limit)
+        merged.append(results)
+    return merged
+
+
+def _merge_fallback(filtered: list[dict], unfiltered: list[dict], limit: int) -> list[dict]:
+    """フィルタ付きの結果を先頭に、不足分をフィルタなしの結果で補う。
+
+    各結果には条件に一致したかを filter_matched として付ける。
+    """
+    matched = [{**r, "filter_matched": True} for r in filtered]
+    if len(matched) >= _MIN_FILTERED_RESULTS:
+        return matched
+    logger.info("Too few results with filter, filling with unfiltered results")
+    ids = {r["id"] for r in filtered}
+    rest = [{**r, "filter_matched": False} for r in unfiltered if r["id"] not in ids]
+    return (matched + rest)[:limit]
+
+
+def _candidate_limit(limit: int) -> int:
+    return max(limit, config.RERANK_CANDIDATES)
+
+
+def _rerank(
+    candidates: list[dict], query_filter: Filter | None, limit: int
+) -> tuple[list[dict], dict | None]:
+    """候補を寸法の近さを加味して並べ替え、上位limit件と価格統計を返す。"""
+    size_targets = rerank.targets(query_filter)
+    ranked = rerank.rerank(candidates, size_targets)
+    stats = None
+    if config.PRICE_STATS_SIZE > 0:
+        stats = rerank.price_stats(ranked[: config.PRICE_STATS_SIZE], size_targets)
+    return ranked[:limit], stats
+
+
+def _with_material(query_filter: Filter | None, material: str | None) -> Filter | None:
+    """明示的なmaterialパラメータがある場合、フィルタに追加/上書きする。"""
+    if not material:
+        return query_filter
+    material_cond = FieldCondition(key="material", match=MatchValue(value=material))
+    if query_filter and query_filter.must:
+        # 既存のmaterial条件を除去して上書き
+        query_filter.must = [c for c in query_filter.must if getattr(c, 'key', None) != 'material']
+        query_filter.must.append(material_cond)
+        return query_filter
+    return Filter(must=[material_cond])
+
+
+async def _run_stage(
+    name: str, coro: Awaitable[T], timeout: float, timings: dict[str, float]
+) -> T:
+    """パイプラインの1ステージをタイムアウト付きで実行し、所要時間(ms)を記録する。"""
+    start = time.perf_counter()
+    try:
+        with metrics.stage(name):
+            return await asyncio.wait_for(coro, timeout)
+    finally:
+        timings[name] = round((time.perf_counter() - start) * 1000, 1)
+
+
+async def import_stream(
+    chunks: Iterator[tuple[list[EstimateRecord], list[str]]],
+) -> ImportResult:
+    """パース済みチャンクを parse → embed → upsert のパイプラインで差分取り込みする。
+
+    各段は有界キューでつながっており、チャンクN+1のEmbedding中にチャンクNをupsertする。
+    下流が詰まると上流のパースも止まるため、メモリ使用量はファイルサイズに依存しない。
+    """
+    start = time.perf_counter()
     result = ImportResult()
+    parsed: asyncio.Queue = asyncio.Queue(maxsize=config.IMPORT_PIPELINE_DEPTH)
+    embedded: asyncio.Queue = asyncio.Queue(maxsize=config.IMPORT_PIPELINE_DEPTH)
+
+    async def parse_stage() -> None:
+        while (chunk := await asyncio.to_thread(next, chunks, None)) is not None:
+            await parsed.put(chunk)
+        await parsed.put(None)
+
+    async def embed_stage() -> None:
+        while (chunk := await parsed.get()) is not None:
+            records, errors = chunk
+            result.errors.extend(errors)
+            plan = await _plan_import(records, result)
+            await embedded.put((plan, await _embed_plan(plan)))
+        await embedded.put(None)
 
-    # 既存IDチェック（一括取得でN+1を回避）
-    ids = [r.id for r in records]
-    existing_ids = await qdrant.get_existing_ids(ids)
-    result.updated_count = len(existing_ids)
-    result.new_count = len(ids) - result.updated_count
+    async def upsert_stage() -> None:
+        while (item := await embedded.get()) is not None:
+            await _write_plan(*item)
 
-    # Embedding生成
-    texts = [r.to_embedding_text() for r in records]
-    vectors = await embedding.embed_texts(texts)
+    async with asyncio.TaskGroup() as tg:
+        tg.create_task(parse_stage())
+        tg.create_task(embed_stage())
+        tg.create_task(upsert_stage())
 
-    # Qdrant upsert
-    payloads = [r.to_payload() for r in records]
-    await qdrant.upsert_points(ids, vectors, payloads)
+    # 新しい材質がフィルタ抽出の規則で使えるよう辞書を更新する
+    await refresh_materials()
+    _record_import(result, start)
 
     result.total_count = await qdrant.count()
     return result
 
 
-def _build_context(results: list[dict]) -> str:
-    """検索結果をLLMプロンプト用のテキストに変換する。"""
-    lines = []
+def _record_import(result: ImportResult, start: float) -> None:
+    elapsed = time.perf_counter() - start
+    rows = result.new_count + result.updated_count + result.unchanged_count
+    metrics.record_import(
+        result.new_count, result.updated_count, result.unchanged_count, len(result.errors), elapsed
+    )
+    logger.info("Imported %d rows in %.1fs (%.0f rows/s)", rows, elapsed, rows / elapsed if elapsed else 0)
+
+
+@dataclass
+class _ImportPlan:
+    """1チャンク分の差分取り込み計画。"""
+
+    to_embed: list[EstimateRecord] = field(default_factory=list)
+    payload_only: list[EstimateRecord] = field(default_factory=list)
+
+
+async def _plan_import(records: list[EstimateRecord], result: ImportResult) -> _ImportPlan:
+    """既存ポイントのフィンガープリントと比較し、処理が必要なレコードを振り分ける。
+
+    Embedding対象テキストが変わったレコードだけを再Embeddingし、それ以外のフィールド
+    だけが変わったレコードはpayloadのみを書き換える。変化のないレコードはスキップする。
+    """
+    plan = _ImportPlan()
+    if not records:
+        return plan
+
+    # 既存フィンガープリントを一括取得（N+1を回避）
+    existing = await qdrant.get_fingerprints([r.id for r in records])
+
+    for record in records:
+        fingerprint = existing.get(record.id)
+        if fingerprint is None:
+            result.new_count += 1
+            plan.to_embed.append(record)
+        elif fingerprint[0] != record.text_fingerprint():
+            result.updated_count += 1
+            plan.to_embed.append(record)
+        elif fingerprint[1] != record.payload_fingerprint():
+            result.updated_count += 1
+            plan.payload_only.append(record)
+        else:
+            result.unchanged_count += 1
+
+    logger.info(
+        "Import diff: rows=%d, embed=%d, payload only=%d",
+        len(records),
+        len(plan.to_embed),
+        len(plan.payload_only),
+    )
+    return plan
+
+
+async def _embed_plan(plan: _ImportPlan) -> list[list[float]]:
+    if not plan.to_embed:
+        return []
+    return await embedding.embed_texts([r.to_embedding_text() for r in plan.to_embed])
+
+
+async def _write_plan(plan: _ImportPlan, vectors: list[list[float]]) -> None:
+    if plan.to_embed:
+        await qdrant.upsert_points(
+            [r.id for r in plan.to_embed], vectors, [r.to_payload() for r in plan.to_embed]
+        )
+    if plan.payload_only:
+        await qdrant.update_payloads(
+            [r.id for r in plan.payload_only], [r.to_payload() for r in plan.payload_only]
+        )
+
+
+_CONTEXT_HEADER = "No|品名|材質|外径×長さmm|重量kg|用途|等級|単価円|数量|備考"
+# 備考はこの文字数で切り詰める
+_NOTES_MAX_CHARS = 40
+
+
+def _build_context(results: list[dict], price_stats: dict | None = None) -> str:
+    """検索結果と価格統計をLLMプロンプト用のテキストに変換する。
+
+    検索結果は1件1行の表形式にし、LLM_CONTEXT_CHAR_BUDGET (文字数) を超える分は省く。
+    価格統計は常に含める。
+    """
+    lines = _price_stats_lines(price_stats) + [""] if price_stats else []
+    lines.append(_CONTEXT_HEADER)
+    budget = config.LLM_CONTEXT_CHAR_BUDGET or float("inf")
+    used = sum(len(line) for line in lines)
     for i, r in enumerate(results, 1):
-        parts = [
-            r.get("name", ""),
-            r.get("material", ""),
-            f"Φ{r.get('diameter_mm', '')}×{r.get('length_mm', '')}mm",
-        ]
-        if r.get("weight_kg"):
-            parts.append(f"{r['weight_kg']}kg")
-        parts.append(r.get("application", ""))
-        if r.get("grade"):
-            parts.append(r["grade"])
-        if r.get("unit_price"):
-            parts.append(f"単価{r['unit_price']:,}円")
-        elif r.get("price"):
-            parts.append(f"{r['price']:,}円")
-        if r.get("notes"):
-            parts.append(r["notes"])
-        lines.append(f"{i}. {' '.join(str(p) for p in parts)}")
+        row = _context_row(i, r)
+        if used + len(row) > budget and i > 1:
+            lines.append(f"(ほか{len(results) - i + 1}件は省略)")
+            break
+        lines.append(row)
+        used += len(row)
     return "\n".join(lines)
+
+
+def _context_row(i: int, r: dict) -> str:
+    if r.get("unit_price"):
+        price = r["unit_price"]
+    elif r.get("price") and r.get("quantity"):
+        price = round(r["price"] / r["quantity"])
+    else:
+        price = r.get("price")
+    # 検索条件 (材質・寸法) に一致せず、フィルタなしの検索で補った結果
+    mark = "[条件外]" if r.get("filter_matched") is False else ""
+    cells = [
+        str(i),
+        mark + (r.get("name") or ""),
+        r.get("material") or "",
+        f"{_num(r.get('diameter_mm'))}×{_num(r.get('length_mm'))}",
+        _num(r.get("weight_kg")),
+        r.get("application") or "",
+        r.get("grade") or "",
+        f"{price:,}" if price else "",
+        _num(r.get("quantity")),
+        (r.get("notes") or "")[:_NOTES_MAX_CHARS],
+    ]
+    return "|".join(c.replace("|", "/") for c in cells)
+
+
+def _num(value) -> str:
+    return "" if value is None else f"{value:g}"
+
+
+def _price_stats_lines(stats: dict) -> list[str]:
+    """価格統計のプロンプト用テキスト。LLMには計算させず、この数値をそのまま使わせる。"""
+    lines = [
+        f"価格統計 (類似{stats['count']}件から計算済み):",
+        f"- 単価の中央値: {stats['unit_price_median']:,}円"
+        f" (四分位範囲 {stats['unit_price_q1']:,}〜{stats['unit_price_q3']:,}円)",
+    ]
+    if "price_per_kg_median" in stats:
+        lines.append(f"- kgあたり単価の中央値: {stats['price_per_kg_median']:,}円/kg")
+    if "estimated_unit_price" in stats:
+        lines.append(
+            f"- 指定寸法での推定単価: {stats['estimated_unit_price']:,}円"
+            f" (サイズΦ²×Lに対する単価の傾き {stats['size_exponent']})"
+        )
+    return lines
@@ -0,0 +1,142 @@
+import asyncio
+import random
+import re
+import sys
+import time
+
+import httpx
+
+
+class TokenBucket:
+    """1分あたりの上限を持つトークンバケット。rate_per_minuteが0以下なら制限しない。"""
+
+    def __init__(self, rate_per_minute: float) -> None:
+        self._capacity = float(rate_per_minute)
+        self._rate = self._capacity / 60.0
+        self._tokens = self._capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, amount: float = 1.0) -> None:
+        """amount分のトークンが貯まるまで待ってから消費する。"""
+        if self._capacity <= 0:
+            return
+        # バケット容量を超える要求は満杯になった時点で通す（永久に待たないため）
+        amount = min(amount, self._capacity)
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self._capacity, self._tokens + (now - self._updated) * self._rate)
+                self._updated = now
+                if self._tokens >= amount:
+                    self._tokens -= amount
+                    return
+                await asyncio.sleep((amount - self._tokens) / self._rate)
+
+
+class AdaptiveLimiter:
+    """同時実行数をAIMDで調整するリミッタ。
+
+    成功するたびに上限を少しずつ引き上げ、レートリミットを受けたら半減させる。
+    """
+
+    def __init__(self, max_limit: int, min_limit: int = 1) -> None:
+        self._max = max(max_limit, min_limit)
+        self._min = min_limit
+        self._limit = float(self._max)
+        self._in_flight = 0
+        self._condition = asyncio.Condition()
+
+    @property
+    def limit(self) -> int:
+        return int(self._limit)
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    async def __aenter__(self) -> "AdaptiveLimiter":
+        async with self._condition:
+            await self._condition.wait_for(lambda: self._in_flight < int(self._limit))
+            self._in_flight += 1
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        async with self._condition:
+            self._in_flight -= 1
+            self._condition.notify_all()
+
+    def on_success(self) -> None:
+        self._limit = min(self._max, self._limit + 1.0 / self._limit)
+
+    def on_rate_limited(self) -> None:
+        self._limit = max(self._min, self._limit / 2)
+
+
+_RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+_RETRY_DELAY_PATTERN = re.compile(r"^([\d.]+)s$")
+
+
+def is_rate_limited(error: BaseException) -> bool:
+    """レートリミット (429) エラーかどうか。"""
+    return _status_code(error) == 429
+
+
+def is_retryable(error: BaseException) -> bool:
+    """リトライで回復しうるエラーかどうか。"""
+    status = _status_code(error)
+    if status is not None:
+        return status in _RETRYABLE_STATUS
+    return isinstance(error, httpx.TransportError)
+
+
+def _status_code(error: BaseException) -> int | None:
+    # Gemini APIのエラーと、httpxで直接呼ぶAPI (Mattermost) のエラーを同じに扱う
+    if _is_genai_error(error):
+        return error.code
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code
+    return None
+
+
+def retry_delay(error: BaseException, attempt: int, base_delay: float, max_delay: float) -> float:
+    """次のリトライまでの待ち時間 (秒)。
+
+    サーバーの指示 (Retry-Afterヘッダー / RetryInfo) があればそれに従い、
+    なければ指数バックオフ + フルジッタで決める。
+    """
+    hint = _retry_after_hint(error)
+    if hint is not None:
+        return min(max_delay, hint) + random.uniform(0, base_delay)
+    return random.uniform(0, min(max_delay, base_delay * 2**attempt))
+
+
+def _retry_after_hint(error: BaseException) -> float | None:
+    if not (_is_genai_error(error) or isinstance(error, httpx.HTTPStatusError)):
+        return None
+
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if headers:
+        value = headers.get("retry-after")
+        if value:
+            try:
+                return float(value)
+            except ValueError:
+                pass
+
+    if not _is_genai_error(error):
+        return None
+    details = error.details if isinstance(error.details, dict) else {}
+    for detail in details.get("error", {}).get("details", []) or []:
+        if isinstance(detail, dict) and detail.get("@type", "").endswith("RetryInfo"):
+            match = _RETRY_DELAY_PATTERN.match(str(detail.get("retryDelay", "")))
+            if match:
+                return float(match.group(1))
+    return None
+
+
+def _is_genai_error(error: BaseException) -> bool:
+    # google.genai は遅延して読み込むため、まだ読み込まれていなければGemini APIのエラーではない
+    errors = sys.modules.get("google.genai.errors")
+    return errors is not None and isinstance(error, errors.APIError)
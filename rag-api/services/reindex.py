@@ -0,0 +1,426 @@
+import argparse
+import asyncio
+import json
+import logging
+import time
+from datetime import datetime, timezone
+
+import httpx
+from pydantic import ValidationError
+
+import config
+from models.estimate import EstimateRecord
+from services import embedding, qdrant
+from services.filter import refresh_materials
+
+logger = logging.getLogger(__name__)
+
+# CLIからAPIに再インデックスを依頼したときの進捗の確認間隔 (秒)
+_POLL_INTERVAL = 5.0
+
+_lock = asyncio.Lock()
+_task: asyncio.Task | None = None
+# 実行中または直近の再インデックスの進捗
+_progress: dict = {}
+
+
+async def reindex(switch: bool = True) -> dict:
+    """現在のEmbedding設定で新しいバージョンのコレクションを作り、検証してからエイリアスを切り替える。
+
+    0. エイリアス導入前のコレクションが使われている場合は、まずベクトルごと "<名前>_v<N>" に移して検証し、
+       エイリアスに置き換える (移したバージョンがロールバック先として残る)
+    1. "<名前>_v<N+1>" をインデックス構築を止めた状態で作成し、現在のコレクションの全ポイントを
+       payloadから作り直して (to_embedding_text の変更も反映する) Embedding・upsertする
+    2. 投入中に取り込まれた変更・削除を追いかけて反映し、インデックス構築を有効にして完了を待つ
+    3. サンプルでの Recall@SEARCH_LIMIT (本番と同じ検索設定 対 全件探索) を検証する
+    4. 切り替え前と同じEmbeddingモデルなら、このプロセスからの書き込みを止めて最後の追い上げを行い、
+       件数が一致することを確かめてからエイリアスを切り替える。モデルが異なる (または不明な) 場合は
+       切り替えず、新しい設定で起動した rag-api が起動時に追い上げてから切り替える (検索に別のベクトル空間が混ざらないように)
+
+    検証に失敗したバージョンは status=failed として残し、エイリアスは変えない。
+    """
+    if _lock.locked():
+        raise RuntimeError("A reindex is already running")
+    async with _lock:
+        _progress.clear()
+        source = await qdrant.active_collection()
+        if source == config.QDRANT_COLLECTION:
+            source = await _migrate_legacy()
+
+        version = max((v["version"] for v in await qdrant.list_versions()), default=0) + 1
+        target = await qdrant.create_version(version, building=True)
+        _progress.clear()
+        _progress.update(
+            version=version,
+            collection=target,
+            source=source,
+            stage="copy",
+            total=await qdrant.count(source),
+            copied=0,
+            started_at=datetime.now(timezone.utc).isoformat(),
+        )
+        start = time.perf_counter()
+        switching = False
+        try:
+            await _copy(source, target)
+            _progress["stage"] = "catch_up"
+            await _catch_up(source, target)
+            _progress["stage"] = "indexing"
+            await qdrant.finish_version(target, config.REINDEX_INDEX_TIMEOUT)
+            _progress["stage"] = "verify"
+            recall = await _verify_recall(target)
+            built_with = (await qdrant.collection_metadata(source)).get("embedding_model")
+            switching = switch and built_with == embedding.model_name()
+            if switching:
+                _progress["stage"] = "switch"
+                async with qdrant.pause_writes():
+                    # 検証の間に取り込まれた変更を反映し、書き込みを止めた時点の件数で確かめてから切り替える
+                    await _catch_up(source, target)
+                    points = await _verify_count(source, target)
+                    await qdrant.set_version_metadata(target, status=qdrant.READY, recall=recall)
+                    await qdrant.switch_alias(target)
+            else:
+                points = await _verify_count(source, target)
+        except Exception as e:
+            _progress.update(stage="failed", error=str(e) or type(e).__name__)
+            await qdrant.set_version_metadata(target, status=qdrant.FAILED, error=_progress["error"])
+            raise
+
+        if switching:
+            await refresh_materials()
+        else:
+            await qdrant.set_version_metadata(target, status=qdrant.READY, recall=recall)
+            if not switch:
+                logger.info("Reindexed into '%s'; the alias was left on '%s'", target, source)
+            elif built_with is None:
+                # エイリアス導入前のコレクションから移したバージョンは、作成時のモデルが分からない
+                logger.info(
+                    "Reindexed into '%s'; '%s' was built with an unknown model, run `activate %d` to switch",
+                    target, source, version,
+                )
+            else:
+                logger.info(
+                    "Reindexed into '%s' with %s; restart rag-api with the same settings to switch to it",
+                    target,
+                    embedding.model_name(),
+                )
+        result = {
+            "version": version,
+            "collection": target,
+            "source": source,
+            "points": points,
+            "recall": recall,
+            "seconds": round(time.perf_counter() - start, 1),
+            "switched": switching,
+        }
+        await _prune(keep=target, previous=source)
+        _progress.update(stage="done", result=result)
+        return result
+
+
+async def activate(version: int) -> dict:
+    """検証済みのバージョンにエイリアスを切り替える (ロールバック・切り替えの保留分の適用)。
+
+    現在のEmbeddingモデルで作られたバージョンのみ指定できる。
+    """
+    versions = {v["version"]: v for v in await qdrant.list_versions()}
+    if version not in versions:
+        raise LookupError(f"Version {version} does not exist")
+    target = versions[version]
+    if target["status"] != qdrant.READY:
+        raise ValueError(f"Version {version} is not ready (status: {target['status']})")
+    # エイリアス導入前のコレクションから移したバージョン (モデル不明) は、起動時と同様に互換とみなす
+    if target["embedding_model"] not in (None, embedding.model_name()):
+        raise ValueError(
+            f"Version {version} was built with {target['embedding_model']}, "
+            f"but the configured model is {embedding.model_name()}"
+        )
+    if _lock.locked():
+        raise RuntimeError("A reindex is running")
+    previous = await _activate(target["collection"])
+    return {"active": target["collection"], "previous": previous}
+
+
+async def rollback() -> dict:
+    """現在より前の、現在のEmbeddingモデルで作られた検証済みバージョンのうち最新のものに戻す。"""
+    versions = await qdrant.list_versions()
+    active = next((v["version"] for v in versions if v["active"]), None)
+    if active is None:
+        raise LookupError("The collection is not versioned yet")
+    for v in reversed(versions):
+        if (
+            v["version"] < active
+            and v["status"] == qdrant.READY
+            and v["embedding_model"] in (None, embedding.model_name())
+        ):
+            return await activate(v["version"])
+    raise LookupError("No earlier version to roll back to")
+
+
+async def catch_up_and_switch(source: str, target: str) -> int:
+    """source の変更・追加と削除を target に反映し、件数が一致することを確かめてから target に切り替える。
+
+    別のEmbeddingモデルで作ったバージョンに起動時に切り替える際に使う。再インデックスの完了から
+    再起動までに source に取り込まれた分を、現在のモデルでEmbeddingし直して追いかける。
+    反映したポイント数を返す。
+    """
+    async with _lock:
+        _progress.clear()
+        _progress.update(
+            collection=target,
+            source=source,
+            stage="catch_up",
+            copied=0,
+            started_at=datetime.now(timezone.utc).isoformat(),
+        )
+        try:
+            await _catch_up(source, target)
+            async with qdrant.pause_writes():
+                await _catch_up(source, target)
+                await _verify_count(source, target)
+                await qdrant.switch_alias(target)
+        except Exception as e:
+            _progress.update(stage="failed", error=str(e) or type(e).__name__)
+            raise
+        _progress["stage"] = "done"
+        return _progress["copied"]
+
+
+def start() -> None:
+    """再インデックスをバックグラウンドで開始する。実行中なら RuntimeError。"""
+    global _task
+    if _lock.locked() or (_task is not None and not _task.done()):
+        raise RuntimeError("A reindex is already running")
+    _task = asyncio.create_task(reindex())
+    _task.add_done_callback(_log_failure)
+
+
+def status() -> dict:
+    """実行中または直近の再インデックスの進捗。"""
+    return {"running": _lock.locked() or (_task is not None and not _task.done()), **_progress}
+
+
+async def _activate(collection: str) -> str:
+    previous = await qdrant.switch_alias(collection)
+    await refresh_materials()
+    return previous
+
+
+async def _migrate_legacy() -> str:
+    """エイリアス導入前のコレクションを、ベクトルもpayloadもそのまま新しいバージョンに移して検証し、
+    エイリアスに置き換える。移したバージョンの名前を返す。
+    """
+    legacy = config.QDRANT_COLLECTION
+    info = await qdrant.collection_info(legacy)
+    version = max((v["version"] for v in await qdrant.list_versions()), default=0) + 1
+    target = await qdrant.create_version(version, building=True, legacy_dimension=info.config.params.vectors.size)
+    _progress.update(
+        version=version,
+        collection=target,
+        source=legacy,
+        stage="migrate",
+        total=info.points_count,
+        copied=0,
+        started_at=datetime.now(timezone.utc).isoformat(),
+    )
+    try:
+        await _copy(legacy, target, verbatim=True)
+        await qdrant.finish_version(target, config.REINDEX_INDEX_TIMEOUT)
+        async with qdrant.pause_writes():
+            await _catch_up(legacy, target, verbatim=True)
+            await _verify_count(legacy, target)
+            await qdrant.set_version_metadata(target, status=qdrant.READY)
+            await qdrant.replace_legacy(target)
+    except Exception as e:
+        _progress.update(stage="failed", error=str(e) or type(e).__name__)
+        await qdrant.set_version_metadata(target, status=qdrant.FAILED, error=_progress["error"])
+        raise
+    logger.info("Moved legacy collection '%s' into '%s'", legacy, target)
+    return target
+
+
+async def _copy(source: str, target: str, changed_only: bool = False, verbatim: bool = False) -> None:
+    """sourceの全ポイントをpayloadから作り直してEmbeddingし、targetに書き込む。
+
+    changed_only の場合は、targetにないか payload_hash が異なるポイントだけを書き込む。
+    verbatim の場合は作り直さず、ベクトルとpayloadをそのまま書き込む (エイリアス導入前のコレクションの移行)。
+    次のバッチのEmbeddingと前のバッチのupsertは並行して行う。
+    """
+    pending: asyncio.Task | None = None
+    try:
+        async for batch in qdrant.scroll_points(config.REINDEX_BATCH_SIZE, source, with_vectors=verbatim):
+            ids = [id_ for id_, _, _ in batch]
+            if verbatim:
+                payloads = [{k: v for k, v in raw.items() if k != "vector_schema"} for _, _, raw in batch]
+            else:
+                payloads = [_rebuild_payload(id_, payload) for id_, _, payload in batch]
+            unreadable = sum(p is None for p in payloads)
+            if unreadable:
+                # 現在のモデルで読めないpayloadは、保存されているテキストのまま移す
+                logger.warning("%d points do not match EstimateRecord; copying their payloads as is", unreadable)
+                payloads = [
+                    p if p is not None else {k: v for k, v in raw.items() if k != "vector_schema"}
+                    for p, (_, _, raw) in zip(payloads, batch)
+                ]
+            indices = range(len(ids))
+            if changed_only:
+                existing = await qdrant.get_fingerprints(ids, target)
+                indices = [
+                    i for i, (id_, payload) in enumerate(zip(ids, payloads))
+                    if existing.get(id_, (None, None))[1] != payload.get("payload_hash")
+                ]
+                if not indices:
+                    continue
+            ids, payloads = [ids[i] for i in indices], [payloads[i] for i in indices]
+            if verbatim:
+                vectors = [batch[i][1] for i in indices]
+            else:
+                vectors = await embedding.embed_texts([p["text"] for p in payloads])
+            if pending is not None:
+                await pending
+            pending = asyncio.create_task(
+                qdrant.upsert_points(
+                    ids, vectors, payloads, concurrency=config.REINDEX_UPSERT_CONCURRENCY, collection=target
+                )
+            )
+            _progress["copied"] += len(ids)
+        if pending is not None:
+            await pending
+    finally:
+        if pending is not None and not pending.done():
+            pending.cancel()
+
+
+async def _catch_up(source: str, target: str, verbatim: bool = False) -> None:
+    """コピー開始後のsourceの変更・追加と削除をtargetに反映する。"""
+    await _copy(source, target, changed_only=True, verbatim=verbatim)
+    removed = 0
+    async for batch in qdrant.scroll_points(config.REINDEX_BATCH_SIZE, target, with_vectors=False):
+        ids = [id_ for id_, _, _ in batch]
+        existing = await qdrant.get_fingerprints(ids, source)
+        deleted = [id_ for id_ in ids if id_ not in existing]
+        if deleted:
+            await qdrant.delete_points(deleted, target)
+            removed += len(deleted)
+    if removed:
+        logger.info("Removed %d points deleted from '%s' during the copy", removed, source)
+
+
+def _rebuild_payload(id_: int, payload: dict) -> dict | None:
+    try:
+        return EstimateRecord.model_validate({**payload, "id": id_}).to_payload()
+    except ValidationError:
+        return None
+
+
+async def _verify_count(source: str, target: str) -> int:
+    expected = await qdrant.count(source, exact=True)
+    points = await qdrant.count(target, exact=True)
+    if points != expected:
+        raise RuntimeError(f"'{target}' has {points} points, but '{source}' has {expected}")
+    return points
+
+
+async def _verify_recall(target: str) -> float | None:
+    recall = await qdrant.sample_recall(target, config.REINDEX_VERIFY_SAMPLES)
+    if recall is not None and recall < config.REINDEX_MIN_RECALL:
+        raise RuntimeError(f"Sample recall of '{target}' is {recall:.3f} (< {config.REINDEX_MIN_RECALL})")
+    logger.info("Verified '%s': sample recall %s", target, recall)
+    return recall
+
+
+async def _prune(keep: str, previous: str) -> None:
+    """作成したバージョン・現在のバージョンと、ロールバック用の REINDEX_KEEP_VERSIONS 件の検証済み
+    バージョン (切り替え前のものを優先し、あとは新しい順) 以外を削除する。
+    """
+    active = await qdrant.active_collection()
+    versions = sorted(
+        await qdrant.list_versions(), key=lambda v: (v["collection"] == previous, v["version"]), reverse=True
+    )
+    kept = 0
+    for v in versions:
+        if v["collection"] in (keep, active):
+            continue
+        if v["status"] == qdrant.READY and kept < config.REINDEX_KEEP_VERSIONS:
+            kept += 1
+            continue
+        await qdrant.delete_version(v["collection"])
+
+
+def _log_failure(task: asyncio.Task) -> None:
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("Reindex failed", exc_info=task.exception())
+
+
+async def _build_for_new_model() -> dict:
+    # 稼働中のrag-apiとは別のプロセスで作るため、エイリアスは切り替えない (書き込みを止められない)。
+    # 作ったバージョンへは、新しい設定で起動したrag-apiが追い上げてから切り替える (catch_up_and_switch)
+    if await qdrant.active_collection() == config.QDRANT_COLLECTION:
+        raise RuntimeError(
+            f"'{config.QDRANT_COLLECTION}' was created before versioning; "
+            "reindex it once through the API with the current settings first"
+        )
+    return await reindex(switch=False)
+
+
+async def _call_api(api_url: str, method: str, path: str) -> dict:
+    async with httpx.AsyncClient(base_url=api_url, timeout=60.0) as client:
+        resp = await client.request(method, f"/api/v1/data{path}")
+        if resp.is_error:
+            raise RuntimeError(f"{method} {path} failed ({resp.status_code}): {resp.text}")
+        if path != "/reindex":
+            return resp.json()
+        # 完了するまで進捗を確認する
+        while True:
+            await asyncio.sleep(_POLL_INTERVAL)
+            resp = await client.get("/api/v1/data/collections")
+            resp.raise_for_status()
+            progress = resp.json()["reindex"]
+            if not progress["running"]:
+                if progress.get("stage") == "failed":
+                    raise RuntimeError(f"Reindex failed: {progress.get('error')}")
+                return progress.get("result", {})
+            logger.info("Reindex %s: %s/%s", progress.get("stage"), progress.get("copied"), progress.get("total"))
+
+
+def main() -> None:
+    """コマンドラインからの再インデックス・切り替え。rag-api ディレクトリで実行する:
+
+        python -m services.reindex run [--api-url URL]
+        python -m services.reindex list
+        python -m services.reindex activate <version> [--api-url URL]
+        python -m services.reindex rollback [--api-url URL]
+
+    書き込みを止めてからエイリアスを切り替える必要があるため、run・activate・rollback は稼働中の
+    rag-api のAPIに依頼する。ただし、指定した環境変数のEmbeddingモデルが現在のバージョンと異なる場合の run は、
+    このプロセスで新しいバージョンを作るだけで切り替えない (新しい設定で再起動したrag-apiが切り替える)。
+    """
+    ap = argparse.ArgumentParser(prog="python -m services.reindex")
+    ap.add_argument("command", choices=["run", "list", "activate", "rollback"])
+    ap.add_argument("version", nargs="?", type=int)
+    ap.add_argument("--api-url", default="http://localhost:8000", help="稼働中のrag-apiのURL")
+    args = ap.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    async def run():
+        if args.command == "run":
+            active = await qdrant.active_collection()
+            built_with = None
+            if active != config.QDRANT_COLLECTION:
+                built_with = (await qdrant.collection_metadata(active)).get("embedding_model")
+            if built_with not in (None, embedding.model_name()):
+                return await _build_for_new_model()
+            return await _call_api(args.api_url, "POST", "/reindex")
+        if args.command == "activate":
+            if args.version is None:
+                ap.error("activate requires a version")
+            return await _call_api(args.api_url, "POST", f"/collections/{args.version}/activate")
+        if args.command == "rollback":
+            return await _call_api(args.api_url, "POST", "/collections/rollback")
+        return await qdrant.list_versions()
+
+    print(json.dumps(asyncio.run(run()), ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
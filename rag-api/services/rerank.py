@@ -0,0 +1,109 @@
+import math
+
+import numpy as np
+from qdrant_client.models import Filter
+
+import config
+
+# 再ランキングで目標値との距離を測る寸法
+_DIMENSIONS = ("diameter_mm", "length_mm", "weight_kg")
+
+
+def targets(query_filter: Filter | None) -> dict[str, float]:
+    """フィルタの範囲条件から寸法の目標値を取り出す (範囲の中央。片側だけならその値)。"""
+    found: dict[str, float] = {}
+    if query_filter is None or not query_filter.must:
+        return found
+    for condition in query_filter.must:
+        key = getattr(condition, "key", None)
+        bounds = getattr(condition, "range", None)
+        if key not in _DIMENSIONS or bounds is None:
+            continue
+        values = [b for b in (bounds.gte, bounds.lte) if b is not None]
+        if values:
+            found[key] = sum(values) / len(values)
+    return found
+
+
+def rerank(
+    results: list[dict], size_targets: dict[str, float], weight: float = config.RERANK_SIZE_WEIGHT
+) -> list[dict]:
+    """ベクトル類似度と寸法の近さを合成したスコアで並べ替える。
+
+    類似度は候補内で0〜1に正規化し、寸法の近さは目標値に対する相対誤差 (1で打ち切り) から求める。
+    合成スコア = (1 - weight) * 類似度 + weight * 近さ。目標値がなければ元の順序のまま返す。
+    フィルタなしの検索で補った結果 (filter_matched=False) は常に条件に一致した結果の後に置く。
+    """
+    if not results or not size_targets:
+        return results
+
+    scores = np.array([r["score"] for r in results], dtype=np.float64)
+    spread = np.ptp(scores)
+    similarity = (scores - scores.min()) / spread if spread > 0 else np.ones_like(scores)
+
+    distances = []
+    for key, target in size_targets.items():
+        values = _column(results, key)
+        relative = np.abs(values - target) / max(abs(target), 1e-9)
+        # 値のない結果は最も遠いものとして扱う
+        distances.append(np.nan_to_num(np.minimum(relative, 1.0), nan=1.0))
+    closeness = 1.0 - np.mean(distances, axis=0)
+
+    combined = (1 - weight) * similarity + weight * closeness
+    unmatched = np.array([r.get("filter_matched") is False for r in results])
+    order = np.lexsort((-combined, unmatched))
+    return [{**results[i], "rerank_score": round(float(combined[i]), 4)} for i in order]
+
+
+def price_stats(results: list[dict], size_targets: dict[str, float]) -> dict | None:
+    """類似案件の単価の統計を計算する。単価の分かる結果がなければ None。
+
+    - 単価の中央値と四分位範囲
+    - kgあたり単価の中央値 (重量の分かる結果のみ)
+    - サイズ (Φ²×L) に対する単価の両対数回帰の傾き。目標の外径・長さがあればその寸法での推定単価
+    """
+    prices = np.array([_unit_price(r) for r in results], dtype=np.float64)
+    valid = np.isfinite(prices) & (prices > 0)
+    if not valid.any():
+        return None
+
+    q1, median, q3 = np.percentile(prices[valid], [25, 50, 75])
+    stats: dict = {
+        "count": int(valid.sum()),
+        "unit_price_median": round(float(median)),
+        "unit_price_q1": round(float(q1)),
+        "unit_price_q3": round(float(q3)),
+    }
+
+    weights = _column(results, "weight_kg")
+    with_weight = valid & np.isfinite(weights) & (weights > 0)
+    if with_weight.any():
+        stats["price_per_kg_median"] = round(float(np.median(prices[with_weight] / weights[with_weight])))
+
+    volumes = _column(results, "diameter_mm") ** 2 * _column(results, "length_mm")
+    with_size = valid & np.isfinite(volumes) & (volumes > 0)
+    if with_size.sum() >= 3:
+        x = np.log(volumes[with_size])
+        if np.ptp(x) > 0:
+            slope, intercept = np.polyfit(x, np.log(prices[with_size]), 1)
+            stats["size_exponent"] = round(float(slope), 2)
+            d, length = size_targets.get("diameter_mm"), size_targets.get("length_mm")
+            if d and length:
+                stats["estimated_unit_price"] = round(
+                    math.exp(intercept + slope * math.log(d * d * length))
+                )
+    return stats
+
+
+def _unit_price(r: dict) -> float:
+    if r.get("unit_price"):
+        return float(r["unit_price"])
+    if r.get("price") and r.get("quantity"):
+        return r["price"] / r["quantity"]
+    return float(r["price"]) if r.get("price") else math.nan
+
+
+def _column(results: list[dict], key: str) -> np.ndarray:
+    return np.array(
+        [r[key] if r.get(key) is not None else math.nan for r in results], dtype=np.float64
+    )
@@ -0,0 +1,41 @@
+import math
+import re
+import unicodedata
+import zlib
+from collections import Counter
+
+from qdrant_client.models import SparseVector
+
+# 品番・材質記号 (SUS316L, S45C, A5052 など) を1語として扱うためのパターン
+_ALNUM_TOKEN = re.compile(r"[a-z0-9][a-z0-9.\-]*[a-z0-9]|[a-z0-9]")
+_NGRAM_RANGE = (2, 3)
+
+
+def features(text: str) -> Counter[str]:
+    """テキストから語彙特徴 (英数字トークン + 文字n-gram) を抽出する。
+
+    日本語は分かち書きせずに文字2〜3gramで表現し、英数字の記号は完全一致で効くよう
+    トークン全体も特徴に加える。
+    """
+    normalized = " ".join(unicodedata.normalize("NFKC", text).lower().split())
+    counts: Counter[str] = Counter()
+
+    for token in _ALNUM_TOKEN.findall(normalized):
+        counts[f"w:{token}"] += 1
+
+    lo, hi = _NGRAM_RANGE
+    for chunk in normalized.split(" "):
+        for n in range(lo, hi + 1):
+            for i in range(len(chunk) - n + 1):
+                counts[f"c:{chunk[i : i + n]}"] += 1
+    return counts
+
+
+def sparse_vector(text: str) -> SparseVector:
+    """テキストをQdrantの疎ベクトルに変換する。重みは 1 + log(tf)、IDFはQdrant側で掛ける。"""
+    weights: dict[int, float] = {}
+    for feature, tf in features(text).items():
+        index = zlib.crc32(feature.encode("utf-8"))
+        weights[index] = weights.get(index, 0.0) + 1.0 + math.log(tf)
+    indices = sorted(weights)
+    return SparseVector(indices=indices, values=[weights[i] for i in indices])
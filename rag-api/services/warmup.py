@@ -0,0 +1,92 @@
+import asyncio
+import logging
+import time
+
+import grpc
+import httpx
+from qdrant_client.http.exceptions import ResponseHandlingException
+
+import config
+from services import embedding, qdrant
+from services.filter import refresh_materials
+from services.gemini_client import get_client
+
+logger = logging.getLogger(__name__)
+
+# Qdrantに接続できるまでの再試行間隔の上限 (秒)
+_RETRY_MAX_DELAY = 30.0
+
+_done = asyncio.Event()
+_status: dict = {"ready": False, "stage": "starting", "error": None, "seconds": None}
+
+
+def start() -> asyncio.Task:
+    """起動後の準備 (コレクションの確認・材質辞書・クライアントの生成) をバックグラウンドで開始する。"""
+    return asyncio.create_task(_run())
+
+
+def status() -> dict:
+    """readinessの状態。準備中は stage に現在の段階、失敗時は error に理由が入る。"""
+    return dict(_status)
+
+
+async def wait_ready() -> None:
+    """準備が終わるまで待つ。準備に失敗していれば RuntimeError。"""
+    await _done.wait()
+    if not _status["ready"]:
+        raise RuntimeError(f"Startup failed: {_status['error']}")
+
+
+async def _run() -> None:
+    start = time.perf_counter()
+    try:
+        _status["stage"] = "qdrant"
+        await _ensure_collection()
+        _status["stage"] = "materials"
+        await refresh_materials()
+        _status["stage"] = "clients"
+        await asyncio.to_thread(_create_clients)
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        logger.exception("Startup failed during %s", _status["stage"])
+        _status.update(stage="failed", error=str(e) or type(e).__name__)
+        _done.set()
+        return
+    _status.update(ready=True, stage="ready", error=None, seconds=round(time.perf_counter() - start, 2))
+    _done.set()
+    logger.info("Ready in %.2fs", _status["seconds"])
+
+
+async def _ensure_collection() -> None:
+    attempt = 0
+    while True:
+        try:
+            await qdrant.ensure_collection()
+            return
+        except Exception as e:
+            # 再試行するのはQdrantのコンテナがまだ起動していない場合などの通信エラーだけ。
+            # 次元数・Embeddingモデルの不一致や EMBEDDING_BACKEND などの設定の誤りは再試行しても直らないため、すぐに失敗させる
+            if not _is_unreachable(e):
+                raise
+            delay = min(_RETRY_MAX_DELAY, 2.0**attempt)
+            attempt += 1
+            _status["error"] = str(e) or type(e).__name__
+            logger.warning("Qdrant is not reachable (%s); retrying in %.0fs", _status["error"], delay)
+            await asyncio.sleep(delay)
+
+
+def _is_unreachable(error: BaseException) -> bool:
+    if isinstance(error, (httpx.TransportError, ResponseHandlingException, ConnectionError)):
+        return True
+    if isinstance(error, grpc.aio.AioRpcError):
+        return error.code() in (grpc.StatusCode.UNAVAILABLE, grpc.StatusCode.DEADLINE_EXCEEDED)
+    return False
+
+
+def _create_clients() -> None:
+    # 初回の問い合わせでモジュールの読み込みやモデルのロードを待たないよう、ここで済ませておく
+    embedding.backend()
+    if config.GEMINI_API_KEY:
+        get_client()
+        import google.genai.types  # noqa: F401
@@ -0,0 +1,94 @@
+import asyncio
+
+import httpx
+import pytest
+
+from services import mattermost
+
+_RESPONSE = b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nContent-Length: 2\r\n\r\n{}"
+
+
+async def _read_request(reader: asyncio.StreamReader) -> bytes:
+    head = await reader.readuntil(b"\r\n\r\n")
+    length = 0
+    for line in head.split(b"\r\n"):
+        if line.lower().startswith(b"content-length:"):
+            length = int(line.split(b":", 1)[1])
+    return head + await reader.readexactly(length)
+
+
+async def _serve_then_drop_idle(received: list[tuple[int, bytes]]) -> asyncio.Server:
+    """1本目の接続は最初のリクエストに応答した後、アイドル中に閉じられたように振る舞うサーバー。
+
+    keep-alive接続をサーバー (やプロキシ) がアイドルタイムアウトで閉じた直後に、クライアントが
+    その接続を再利用した場合と同じく、2つ目のリクエストは応答せずに接続を切る。
+    """
+    connections = 0
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        nonlocal connections
+        connections += 1
+        number = connections
+        try:
+            while True:
+                request = await _read_request(reader)
+                if number == 1 and any(n == 1 for n, _ in received):
+                    return
+                received.append((number, request))
+                writer.write(_RESPONSE)
+                await writer.drain()
+        except asyncio.IncompleteReadError:
+            return
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, "127.0.0.1", 0)
+
+
+@pytest.fixture
+def client_reset():
+    yield
+    asyncio.run(mattermost.close())
+
+
+def test_post_is_resent_when_idle_keepalive_connection_was_closed(client_reset):
+    async def run() -> list[tuple[int, bytes]]:
+        received: list[tuple[int, bytes]] = []
+        server = await _serve_then_drop_idle(received)
+        port = server.sockets[0].getsockname()[1]
+        url = f"http://127.0.0.1:{port}/hooks/test"
+        await mattermost.start()
+        try:
+            await mattermost._request("POST", url, json={"text": "first"})
+            await mattermost._request("POST", url, json={"text": "second"})
+        finally:
+            await mattermost.close()
+            server.close()
+            await server.wait_closed()
+        return received
+
+    received = asyncio.run(run())
+
+    # 2つ目の投稿は閉じられた接続では処理されず、新しい接続で1回だけ届く
+    assert [n for n, _ in received] == [1, 2]
+    assert b'"second"' in received[1][1]
+
+
+def test_post_is_not_resent_when_new_connection_fails(client_reset):
+    async def run() -> None:
+        async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+            await _read_request(reader)
+            writer.close()
+
+        server = await asyncio.start_server(handle, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        await mattermost.start()
+        try:
+            with pytest.raises(httpx.RemoteProtocolError):
+                await mattermost._request("POST", f"http://127.0.0.1:{port}/hooks/test", json={"text": "x"})
+        finally:
+            await mattermost.close()
+            server.close()
+            await server.wait_closed()
+
+    asyncio.run(run())